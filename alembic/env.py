@@ -1,10 +1,13 @@
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 
 from alembic import context
+from filescan.config import load_environment
 from filescan.sqlalchemy_store import (
+    DB_URL_ENV,
     Model,
     Archive,
     TokenPos,
@@ -33,6 +36,12 @@ target_metadata = Model.metadata
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
+# The same environment variable that selects filescan's database
+# also selects the one to migrate, so SQLite files can be upgraded.
+load_environment()
+if os.environ.get(DB_URL_ENV):
+    config.set_main_option("sqlalchemy.url", os.environ[DB_URL_ENV])
+
 
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
@@ -52,6 +61,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        render_as_batch=url.startswith("sqlite"),
     )
 
     with context.begin_transaction():
@@ -72,7 +82,12 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            # SQLite can only ALTER a table by copying it
+            render_as_batch=connection.dialect.name == "sqlite",
+        )
 
         with context.begin_transaction():
             context.run_migrations()
@@ -19,8 +19,18 @@ depends_on: Union[str, Sequence[str], None] = None
 
 
 def upgrade() -> None:
-    op.execute("ALTER TABLE location ALTER COLUMN filesize TYPE bigint USING filesize")
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute(
+            "ALTER TABLE location ALTER COLUMN filesize TYPE bigint USING filesize"
+        )
+    else:
+        with op.batch_alter_table("location") as batch_op:
+            batch_op.alter_column("filesize", type_=sa.BigInteger())
 
 
 def downgrade() -> None:
-    op.execute("ALTER TABLE location ALTER COLUMN filesize TYPE int USING filesize")
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("ALTER TABLE location ALTER COLUMN filesize TYPE int USING filesize")
+    else:
+        with op.batch_alter_table("location") as batch_op:
+            batch_op.alter_column("filesize", type_=sa.Integer())
@@ -20,13 +20,14 @@ depends_on: Union[str, Sequence[str], None] = None
 
 def upgrade() -> None:
     # ### commands auto generated by Alembic - please adjust! ###
-    op.add_column("archive", sa.Column("runlog_id", sa.Integer(), nullable=True))
-    op.create_index(
-        op.f("ix_archive_runlog_id"), "archive", ["runlog_id"], unique=False
-    )
-    op.create_foreign_key(
-        op.f("fk_archive_runlog_id_runlog"), "archive", "runlog", ["runlog_id"], ["id"]
-    )
+    with op.batch_alter_table("archive") as batch_op:
+        batch_op.add_column(sa.Column("runlog_id", sa.Integer(), nullable=True))
+        batch_op.create_index(
+            batch_op.f("ix_archive_runlog_id"), ["runlog_id"], unique=False
+        )
+        batch_op.create_foreign_key(
+            batch_op.f("fk_archive_runlog_id_runlog"), "runlog", ["runlog_id"], ["id"]
+        )
     op.add_column("runlog", sa.Column("when_finished", sa.DateTime(), nullable=True))
     # ### end Alembic commands ###
 
@@ -34,9 +35,10 @@ def upgrade() -> None:
 def downgrade() -> None:
     # ### commands auto generated by Alembic - please adjust! ###
     op.drop_column("runlog", "when_finished")
-    op.drop_constraint(
-        op.f("fk_archive_runlog_id_runlog"), "archive", type_="foreignkey"
-    )
-    op.drop_index(op.f("ix_archive_runlog_id"), table_name="archive")
-    op.drop_column("archive", "runlog_id")
+    with op.batch_alter_table("archive") as batch_op:
+        batch_op.drop_constraint(
+            batch_op.f("fk_archive_runlog_id_runlog"), type_="foreignkey"
+        )
+        batch_op.drop_index(batch_op.f("ix_archive_runlog_id"))
+        batch_op.drop_column("runlog_id")
     # ### end Alembic commands ###
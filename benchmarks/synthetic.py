@@ -0,0 +1,279 @@
+"""
+Benchmark scan_directory against reproducible synthetic trees.
+
+Each run builds a tree from a TreeSpec, then times three phases:
+a cold scan into an empty store, a warm scan with nothing changed,
+and a scan after a fraction of the files has been modified, created
+and deleted, recording the time spent in each part of the scanner
+for every phase. Results are written as JSON and may be compared with a
+stored baseline, in which case any metric that regresses by more
+than the tolerance is reported and the exit status is 1.
+
+    python -m benchmarks.synthetic --files 5000 --output bench.json
+    python -m benchmarks.synthetic --save-baseline benchmarks/baseline.json
+    python -m benchmarks.synthetic --baseline benchmarks/baseline.json
+
+Timings depend on the machine, so baselines aren't committed: the
+first run with --baseline records one if there is none.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, fields
+
+from sqlalchemy import event
+
+from filescan import scan_directory
+from filescan.metrics import RunMetrics
+from filescan.memory_store import URL_SCHEME as MEMORY_URL_SCHEME, MemoryDatabase
+from filescan.sqlalchemy_store import Database
+
+MAX_FILE_SIZE = 16 * 1024 * 1024
+PHASES = ("cold", "warm", "churn")
+# Metrics where bigger is better; the rest regress by growing
+THROUGHPUT_METRICS = ("files_per_s", "mb_hashed_per_s", "tokens_per_s")
+COST_METRICS = ("statements_per_file",)
+
+
+@dataclass
+class TreeSpec:
+    depth: int = 3
+    fanout: int = 4
+    files: int = 2000
+    median_size: int = 4096
+    size_sigma: float = 1.5  # Of the log-normal file size distribution
+    python_fraction: float = 0.3
+    churn: float = 0.05  # Fraction of files modified, and again created/deleted
+    seed: int = 1
+
+
+def directories(root, spec: TreeSpec):
+    dirs = [root]
+    level = [root]
+    for _ in range(spec.depth):
+        level = [
+            os.path.join(parent, f"d{i:02d}")
+            for parent in level
+            for i in range(spec.fanout)
+        ]
+        dirs.extend(level)
+    return dirs
+
+
+def python_source(rng: random.Random, size: int) -> bytes:
+    lines = []
+    length = 0
+    while length < size:
+        name = f"name_{rng.randrange(500)}"
+        other = f"value_{rng.randrange(500)}"
+        line = f"{name} = {other} + {rng.randrange(1000)}  # {'x' * rng.randrange(40)}"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines).encode()[:size]
+
+
+def file_content(rng: random.Random, spec: TreeSpec, python: bool) -> bytes:
+    size = min(
+        int(rng.lognormvariate(0, spec.size_sigma) * spec.median_size), MAX_FILE_SIZE
+    )
+    return python_source(rng, size) if python else rng.randbytes(size)
+
+
+def make_tree(root, spec: TreeSpec) -> list[str]:
+    """Create the tree described by `spec` under `root`; return its files."""
+    rng = random.Random(spec.seed)
+    dirs = directories(root, spec)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    paths = []
+    for i in range(spec.files):
+        python = rng.random() < spec.python_fraction
+        path = os.path.join(rng.choice(dirs), f"f{i:06d}{'.py' if python else '.dat'}")
+        with open(path, "wb") as f:
+            f.write(file_content(rng, spec, python))
+        paths.append(path)
+    return paths
+
+
+def churn_tree(root, spec: TreeSpec, paths: list[str]) -> list[str]:
+    """Modify, delete and create files as `spec.churn` requires."""
+    rng = random.Random(spec.seed + 1)
+    count = int(len(paths) * spec.churn)
+    paths = list(paths)
+    for path in rng.sample(paths, count):
+        with open(path, "wb") as f:
+            f.write(file_content(rng, spec, path.endswith(".py")))
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    for path in rng.sample(paths, count):
+        os.unlink(path)
+        paths.remove(path)
+    dirs = directories(root, spec)
+    for i in range(count):
+        python = rng.random() < spec.python_fraction
+        path = os.path.join(rng.choice(dirs), f"n{i:06d}{'.py' if python else '.dat'}")
+        with open(path, "wb") as f:
+            f.write(file_content(rng, spec, python))
+        paths.append(path)
+    return paths
+
+
+class StatementCounter:
+    """Counts the SQL statements a store's engine executes."""
+
+    def __init__(self, db):
+        self.statements = 0
+        if hasattr(db, "engine"):
+            event.listen(db.engine, "before_cursor_execute", self.count)
+
+    def count(self, *args):
+        self.statements += 1
+
+
+def open_store(url, workdir):
+    if url is None:
+        url = f"sqlite:///{workdir}/bench.sqlite"
+    if url.startswith(MEMORY_URL_SCHEME):
+        return MemoryDatabase.from_url(url)
+    return Database(url=url, temporary=True)
+
+
+def run_phase(db, counter, root, files):
+    counter.statements = 0
+    metrics = RunMetrics()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with db.begin():
+            scan_directory(root, db, metrics)
+    elapsed = time.perf_counter() - started
+    bytes_hashed, tokens = metrics.counts["bytes_hashed"], metrics.counts["tokens"]
+    return dict(
+        seconds=round(elapsed, 4),
+        files=files,
+        bytes_hashed=bytes_hashed,
+        tokens=tokens,
+        statements=counter.statements,
+        files_per_s=round(files / elapsed, 1),
+        mb_hashed_per_s=round(bytes_hashed / elapsed / 1e6, 2),
+        tokens_per_s=round(tokens / elapsed, 1),
+        statements_per_file=round(counter.statements / max(files, 1), 3),
+        times={phase: round(t, 4) for phase, t in metrics.times.items()},
+        # Peak for the whole process so far; KiB on Linux
+        max_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    )
+
+
+def run_benchmark(spec: TreeSpec, url=None) -> dict:
+    with tempfile.TemporaryDirectory(prefix="filescan-bench-") as workdir:
+        root = os.path.join(workdir, "tree")
+        paths = make_tree(root, spec)
+        db = open_store(url, workdir)
+        counter = StatementCounter(db)
+        phases = {}
+        phases["cold"] = run_phase(db, counter, root, len(paths))
+        phases["warm"] = run_phase(db, counter, root, len(paths))
+        paths = churn_tree(root, spec, paths)
+        phases["churn"] = run_phase(db, counter, root, len(paths))
+    return dict(
+        spec=asdict(spec),
+        store=type(db).__name__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        phases=phases,
+    )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Return a description of each metric worse than baseline by more
+    than the tolerance. A baseline may set its own tolerance for each
+    phase in its "thresholds" mapping.
+    """
+    regressions = []
+    for phase in PHASES:
+        now, then = result["phases"][phase], baseline["phases"].get(phase, {})
+        limit = baseline.get("thresholds", {}).get(phase, tolerance)
+        for metric in THROUGHPUT_METRICS + COST_METRICS:
+            if not then.get(metric):
+                continue
+            change = (now[metric] - then[metric]) / then[metric]
+            if metric in THROUGHPUT_METRICS:
+                change = -change
+            if change > limit:
+                regressions.append(
+                    f"{phase} {metric}: {now[metric]} vs baseline {then[metric]}"
+                    f" ({change:+.0%} worse)"
+                )
+    return regressions
+
+
+def report(result: dict):
+    print(
+        f"{'phase':6s} {'files/s':>10s} {'MB/s':>8s} {'tokens/s':>10s} {'stmts/file':>10s}"
+    )
+    for phase, m in result["phases"].items():
+        print(
+            f"{phase:6s} {m['files_per_s']:10,.0f} {m['mb_hashed_per_s']:8.2f}"
+            f" {m['tokens_per_s']:10,.0f} {m['statements_per_file']:10.2f}"
+        )
+
+
+def save_baseline(result: dict, path: str, tolerance: float):
+    thresholds = {phase: tolerance for phase in PHASES}
+    with open(path, "w") as f:
+        json.dump(dict(result, thresholds=thresholds), f, indent=2)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    for f in fields(TreeSpec):
+        parser.add_argument(
+            f"--{f.name.replace('_', '-')}", type=f.type, default=f.default
+        )
+    parser.add_argument("--db-url", help="store to benchmark (default: SQLite file)")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument(
+        "--baseline",
+        help="compare with results saved earlier (saving them if there are none)",
+    )
+    parser.add_argument("--save-baseline", help="write the results as a new baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="fractional slowdown tolerated before failing (default 0.25)",
+    )
+    options = parser.parse_args(args)
+    spec = TreeSpec(**{f.name: getattr(options, f.name) for f in fields(TreeSpec)})
+    result = run_benchmark(spec, options.db_url)
+    report(result)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if options.save_baseline:
+        save_baseline(result, options.save_baseline, options.tolerance)
+    if options.baseline and not os.path.exists(options.baseline):
+        save_baseline(result, options.baseline, options.tolerance)
+        print(f"No baseline yet: saved these results as {options.baseline}")
+    elif options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if (baseline["spec"], baseline["store"]) != (result["spec"], result["store"]):
+            sys.exit("Baseline was recorded with a different tree spec or store")
+        regressions = compare(result, baseline, options.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,18 @@
+from contextlib import nullcontext
+from datetime import datetime
+
 import mongoengine
+from pymongo import UpdateOne
+
+from filescan.backend import (
+    DirTotals,
+    FileEntry,
+    LocationRecord,
+    Reference,
+    file_checksum,
+)
+
+LOCATION_FIELDS = [f for f in LocationRecord.__dataclass_fields__]
 
 
 class FileRecord(mongoengine.Document):
@@ -8,6 +22,8 @@ class FileRecord(mongoengine.Document):
     checksum = mongoengine.StringField()
     seen = mongoengine.BooleanField()
     filesize = mongoengine.IntField()
+    device = mongoengine.IntField(null=True)
+    inode = mongoengine.IntField(null=True)
 
 
 class TokenPos(mongoengine.Document):
@@ -15,10 +31,31 @@ class TokenPos(mongoengine.Document):
     name = mongoengine.StringField()
     line = mongoengine.IntField()
     pos = mongoengine.IntField()
+    ttype = mongoengine.IntField(default=1)
 
 
-class Connection:
+class RunLog(mongoengine.Document):
+    when_run = mongoengine.DateTimeField()
+    when_finished = mongoengine.DateTimeField()
+    rootdir = mongoengine.StringField()
+    files = mongoengine.IntField(default=0)
+    known = mongoengine.IntField(default=0)
+    updated = mongoengine.IntField(default=0)
+    unchanged = mongoengine.IntField(default=0)
+    new_files = mongoengine.IntField(default=0)
+    deleted = mongoengine.IntField(default=0)
+    metrics = mongoengine.DictField()
+    hot_spots = mongoengine.ListField()
 
+
+class Archive(mongoengine.Document):
+    reason = mongoengine.StringField()
+    rectype = mongoengine.StringField()
+    data = mongoengine.DictField()
+    runlog = mongoengine.ReferenceField(RunLog)
+
+
+class Connection:
     DoesNotExist = mongoengine.DoesNotExist
 
     def __init__(self, dbname="test", document_class=FileRecord, create=False):
@@ -30,56 +67,171 @@ class Connection:
             except mongoengine.OperationError:
                 pass
 
+    def begin(self):
+        return nullcontext(self)
+
     def commit(self):
         pass
 
-    def clear_seen_bits(self, prefix):
-        self.document_class.objects(dirpath__startswith=prefix).update(seen=False)
+    def rollback(self):
+        pass  # Writes are not transactional
+
+    def _under(self, prefix, subtree=True):
+        if subtree:
+            return self.document_class.objects(dirpath__startswith=prefix)
+        return self.document_class.objects(dirpath=prefix)
 
-    def hash_for(self, hash):
-        return len(FileRecord.objects(checksum=hash)[:1]) == 1
+    def clear_seen_bits(self, prefix, subtree=True):
+        self._under(prefix, subtree).update(seen=False)
 
-    def save_reference(self, hash, name, line, pos):
-        TokenPos(checksum=hash, name=name, line=line, pos=pos).save()
+    def mark_subtree_seen(self, prefix):
+        self._under(prefix).update(seen=True)
+
+    def save_reference(self, hash, name, line, pos, ttype=1):
+        TokenPos(checksum=hash, name=name, line=line, pos=pos, ttype=ttype).save()
 
     def location_for(self, dir_path, file_path):
-        fieldnames = ["id", "modified", "checksum", "seen"]
-        result = self.document_class.objects.only(*fieldnames).get(
-            dirpath=dir_path, filename=file_path
-        )
-        return tuple(getattr(result, fld) for fld in fieldnames)
+        try:
+            return self.lookup_many(dir_path, [file_path])[file_path]
+        except KeyError:
+            raise self.DoesNotExist(f"{dir_path}{file_path}")
 
-    def update_details(self, id, modified, hash, seen=True):
-        return self.document_class.objects(pk=id).update(
-            modified=modified, checksum=hash, seen=seen
-        )
+    def all_file_count(self, prefix=""):
+        return self.document_class.objects(dirpath__startswith=prefix).count()
+
+    def total_size(self, prefix):
+        sizes = {}
+        docs = self.document_class.objects(dirpath__startswith=prefix)
+        for doc in docs.only("filesize", "device", "inode"):
+            key = doc.pk if doc.inode is None else (doc.device, doc.inode)
+            sizes[key] = doc.filesize or 0
+        return sum(sizes.values())
+
+    def unseen_location_count(self, prefix=""):
+        docs = self.document_class.objects(seen=False, dirpath__startswith=prefix)
+        return docs.count()
 
-    def update_seen(self, id):
-        self.document_class.objects(pk=id).update(seen=True)
+    # Storage protocol (see filescan.backend)
 
-    def insert_location(self, file_path, dirpath, modified, hash):
-        rec = self.document_class(
-            filename=file_path,
-            dirpath=dirpath,
-            modified=modified,
-            checksum=hash,
-            seen=True,
+    def flush(self):
+        pass
+
+    def register_hash(self, file_path):
+        return file_checksum(file_path)
+
+    def register_hashes(self, file_paths, throttle=None):
+        return [file_checksum(file_path, throttle) for file_path in file_paths]
+
+    def register_digests(self, digests):
+        return list(digests)
+
+    def block_digests(self, checksum):
+        return None  # Not kept: grown large files are hashed whole
+
+    def save_block_digests(self, checksum, digests):
+        pass
+
+    def add_references_bulk(self, hash, refs):
+        docs = [TokenPos(checksum=hash, **Reference(*ref)._asdict()) for ref in refs]
+        if docs:
+            TokenPos.objects.insert(docs, load_bulk=False)
+
+    def _record(self, doc):
+        return LocationRecord(**{fld: getattr(doc, fld) for fld in LOCATION_FIELDS})
+
+    def lookup_many(self, dirpath, filenames):
+        docs = self.document_class.objects(
+            dirpath=dirpath, filename__in=list(filenames)
+        )
+        return {doc.filename: self._record(doc) for doc in docs}
+
+    def upsert_locations(self, dirpath, entries):
+        entries = [FileEntry(*entry) for entry in entries]
+        if entries:
+            self.document_class._get_collection().bulk_write(
+                [
+                    UpdateOne(
+                        {"dirpath": dirpath, "filename": e.filename},
+                        {"$set": dict(e._asdict(), seen=True)},
+                        upsert=True,
+                    )
+                    for e in entries
+                ],
+                ordered=False,
+            )
+        written = self.lookup_many(dirpath, (e.filename for e in entries))
+        return [written[e.filename] for e in entries]
+
+    def mark_seen(self, locations):
+        ids = [loc.id for loc in locations]
+        if ids:
+            self.document_class.objects(pk__in=ids).update(seen=True)
+
+    def mark_deleted(self, prefix, limit=None, subtree=True):
+        unseen = self._under(prefix, subtree).filter(seen=False)
+        deleted = [self._record(doc) for doc in unseen.limit(limit or 0)]
+        self.document_class.objects(pk__in=[loc.id for loc in deleted]).delete()
+        return deleted
+
+    def save_directory_totals(self, dirpath, totals, checksums=()):
+        pass  # No rollups kept: totals are summed from the file records
+
+    def remove_unseen_directories(self, prefix):
+        return 0
+
+    def directory_totals(self, dirpath):
+        docs = self.document_class.objects(dirpath__startswith=dirpath)
+        files, size, newest = 0, 0, None
+        for doc in docs.only("filesize", "modified"):
+            files += 1
+            size += doc.filesize or 0
+            if newest is None or doc.modified > newest:
+                newest = doc.modified
+        return DirTotals(files, size, newest) if files else None
+
+    def child_directories(self, dirpath):
+        return {}
+
+    def scanned_directories(self, prefix):
+        dirpaths = self.document_class.objects(dirpath__startswith=prefix).distinct(
+            "dirpath"
         )
-        rec.save()
+        return {dirpath: None for dirpath in dirpaths}  # Times not kept
 
-    def all_file_count(self):
-        return self.document_class.objects.count()
+    def refresh_directory_digests(self):
+        pass
+
+    def directory_digest(self, dirpath):
+        return None  # Not kept: directories can't be compared
+
+    def directory_entries(self, dirpath):
+        docs = self.document_class.objects(dirpath=dirpath).only("filename", "checksum")
+        return {doc.filename: doc.checksum for doc in docs}, {}
+
+    def start_run(self, rootdir):
+        return RunLog(when_run=datetime.now(), rootdir=rootdir).save()
+
+    def end_run(self, run, files, known, updated, unchanged, new_files, deleted):
+        run.update(
+            files=files,
+            known=known,
+            updated=updated,
+            unchanged=unchanged,
+            new_files=new_files,
+            deleted=deleted,
+            when_finished=datetime.now(),
+        )
 
-    def unseen_location_count(self):
-        return self.document_class.objects(seen=False).count()
+    def record_metrics(self, run, metrics):
+        run.update(metrics=metrics)
 
-    def dir_files_not_seen(self):
-        fieldnames = ["dirpath", "filename"]
-        result = self.document_class.objects(seen=False).only(*fieldnames)
-        return [tuple(getattr(rec, fld) for fld in fieldnames) for rec in result]
+    def record_hot_spots(self, run, hot_spots):
+        run.update(hot_spots=[list(hot_spot) for hot_spot in hot_spots])
 
-    def delete_unseen_locations(self):
-        self.document_class.objects(seen=False).delete()
+    def archive_record(self, reason, rectype, record, runlog):
+        data = record.to_dict()
+        data["id"] = str(data["id"])
+        Archive(reason=reason, rectype=rectype, data=data, runlog=runlog).save()
 
 
 if __name__ == "__main__":
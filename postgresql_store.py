@@ -1,6 +1,28 @@
 from datetime import datetime
 
 import psycopg2
+from psycopg2.extras import execute_values
+
+from filescan.backend import (
+    DirTotals,
+    FileEntry,
+    LocationRecord,
+    Reference,
+    chunked,
+    file_checksum,
+)
+
+LOCATION_COLUMNS = (
+    "id, dirpath, filename, modified, checksum, seen, filesize, device, inode"
+)
+
+
+def _under(subtree):
+    return "dirpath LIKE %s" if subtree else "dirpath = %s"
+
+
+def _pattern(prefix, subtree):
+    return f"{prefix}%" if subtree else prefix
 
 
 class Connection:
@@ -18,6 +40,9 @@ class Connection:
             self.curs.execute(
                 "CREATE TABLE tokenpos (id SERIAL PRIMARY KEY, checksum CHAR(64), name VARCHAR, line INTEGER, pos INTEGER)"
             )
+            self.curs.execute(
+                "ALTER TABLE tokenpos ADD COLUMN ttype INTEGER NOT NULL DEFAULT 1"
+            )
             self.curs.execute("DROP TABLE IF EXISTS location")
             self.curs.execute(
                 "CREATE TABLE location ("
@@ -26,7 +51,9 @@ class Connection:
                 "modified DOUBLE PRECISION, checksum CHAR(64), "
                 "seen BOOLEAN)"
             )
-            self.curs.execute("ALTER TABLE location ADD COLUMN filesize INTEGER")
+            self.curs.execute("ALTER TABLE location ADD COLUMN filesize BIGINT")
+            self.curs.execute("ALTER TABLE location ADD COLUMN device BIGINT")
+            self.curs.execute("ALTER TABLE location ADD COLUMN inode BIGINT")
             self.curs.execute("DROP TABLE IF EXISTS runlog")
             self.curs.execute(
                 "CREATE TABLE runlog ("
@@ -49,103 +76,200 @@ class Connection:
         m_curs.execute(f"CREATE DATABASE {self.dbname}")
         m_conn.close()
 
+    def begin(self):
+        return self.conn  # Commits on success, rolls back on error
+
     def commit(self):
         return self.conn.commit()
 
-    def hash_for(self, checksum):
+    def rollback(self):
+        return self.conn.rollback()
+
+    def save_reference(self, checksum, name, line, pos, ttype=1):
         self.curs.execute(
-            "SELECT id FROM tokenpos WHERE checksum = %s LIMIT 1", (checksum,)
+            "INSERT INTO tokenpos (checksum, name, line, pos, ttype) VALUES(%s, %s, %s, %s, %s)",
+            (checksum, name, line, pos, ttype),
         )
-        return len(self.curs.fetchall()) > 0
 
-    def save_reference(self, checksum, name, line, pos):
+    def clear_seen_bits(self, prefix, subtree=True):
         self.curs.execute(
-            "INSERT INTO tokenpos (checksum, name, line, pos) VALUES(%s, %s, %s, %s)",
-            (checksum, name, line, pos),
+            f"UPDATE location SET seen=FALSE WHERE {_under(subtree)}",
+            (_pattern(prefix, subtree),),
         )
 
-    def clear_seen_bits(self, prefix):
+    def mark_subtree_seen(self, prefix):
         self.curs.execute(
-            "UPDATE location SET seen=FALSE WHERE dirpath LIKE (%s || '%%')", (prefix,)
+            "UPDATE location SET seen=TRUE WHERE dirpath LIKE %s", (f"{prefix}%",)
         )
 
     def location_for(self, dir_path, file_path):
+        try:
+            return self.lookup_many(dir_path, [file_path])[file_path]
+        except KeyError:
+            raise Connection.DoesNotExist(f"{dir_path}{file_path}")
+
+    def all_file_count(self, prefix):
         self.curs.execute(
-            """
-        SELECT id, modified, checksum, seen FROM location
-        WHERE dirpath=%s AND filename=%s""",
-            (dir_path, file_path),
+            "SELECT count(*) FROM location WHERE dirpath LIKE %s", (f"{prefix}%",)
         )
-        result = self.curs.fetchone()
-        if result:
-            return result
-        else:
-            raise Connection.DoesNotExist()
+        return self.curs.fetchone()[0]
 
-    def update_details(self, id, modified, checksum, seen=True):
+    def total_size(self, prefix):
         self.curs.execute(
-            """
-        UPDATE location \
-        SET modified=%s, checksum=%s, seen=%s \
-                WHERE id=%s""",
-            (modified, checksum, seen, id),
+            "SELECT coalesce(sum(filesize), 0) FROM ("
+            " SELECT max(filesize) AS filesize FROM location WHERE dirpath LIKE %s"
+            " GROUP BY coalesce(device, -id), inode) AS link_groups",
+            (f"{prefix}%",),
         )
+        return self.curs.fetchone()[0]
 
-    def update_seen(self, id):
+    def unseen_location_count(self, prefix):
         self.curs.execute(
-            """
-        UPDATE location SET seen=TRUE
-                WHERE id=%s""",
-            (id,),
+            """SELECT count(*) FROM location WHERE NOT seen AND dirpath LIKE %s""",
+            (f"{prefix}%",),
+        )
+        return self.curs.fetchone()[0]
+
+    # Storage protocol (see filescan.backend)
+
+    def flush(self):
+        pass
+
+    def register_hash(self, file_path):
+        return file_checksum(file_path)
+
+    def register_hashes(self, file_paths, throttle=None):
+        return [file_checksum(file_path, throttle) for file_path in file_paths]
+
+    def register_digests(self, digests):
+        return list(digests)
+
+    def block_digests(self, checksum):
+        return None  # Not kept: grown large files are hashed whole
+
+    def save_block_digests(self, checksum, digests):
+        pass
+
+    def add_references_bulk(self, checksum, refs):
+        execute_values(
+            self.curs,
+            "INSERT INTO tokenpos (checksum, name, line, pos, ttype) VALUES %s",
+            [(checksum, *Reference(*ref)) for ref in refs],
         )
 
-    def insert_location(self, file_path, dir_path, disk_modified, checksum, size):
+    def lookup_many(self, dirpath, filenames):
+        result = {}
+        for names in chunked(list(filenames)):
+            self.curs.execute(
+                f"SELECT {LOCATION_COLUMNS} FROM location "
+                "WHERE dirpath=%s AND filename = ANY(%s)",
+                (dirpath, list(names)),
+            )
+            for row in self.curs.fetchall():
+                loc = LocationRecord(*row)
+                result[loc.filename] = loc
+        return result
+
+    def upsert_locations(self, dirpath, entries):
+        entries = [FileEntry(*entry) for entry in entries]
+        existing = self.lookup_many(dirpath, (e.filename for e in entries))
+        updates = [
+            (existing[e.filename].id, *e[1:]) for e in entries if e.filename in existing
+        ]
+        if updates:
+            execute_values(
+                self.curs,
+                "UPDATE location SET modified=v.modified, checksum=v.checksum, "
+                "filesize=v.filesize, device=v.device, inode=v.inode, seen=TRUE "
+                "FROM (VALUES %s) AS v (id, modified, checksum, filesize, device, inode) "
+                "WHERE location.id = v.id",
+                updates,
+                # Typed, as columns of NULLs would otherwise be text
+                template="(%s::integer, %s::double precision, %s, %s::bigint, "
+                "%s::bigint, %s::bigint)",
+            )
+        inserts = [(dirpath, *e) for e in entries if e.filename not in existing]
+        if inserts:
+            execute_values(
+                self.curs,
+                "INSERT INTO location (dirpath, filename, modified, checksum, filesize, device, inode, seen) VALUES %s",
+                inserts,
+                template="(%s, %s, %s, %s, %s, %s, %s, TRUE)",
+            )
+        written = self.lookup_many(dirpath, (e.filename for e in entries))
+        return [written[e.filename] for e in entries]
+
+    def mark_seen(self, locations):
+        ids = [loc.id for loc in locations]
+        if ids:
+            self.curs.execute(
+                "UPDATE location SET seen=TRUE WHERE id = ANY(%s)", (ids,)
+            )
+
+    def mark_deleted(self, prefix, limit=None, subtree=True):
         self.curs.execute(
-            """
-        INSERT INTO location (filename, dirpath, modified, checksum, seen, filesize)
-        VALUES (%s, %s, %s, %s, TRUE, %s)""",
-            (file_path, dir_path, disk_modified, checksum, size),
+            f"DELETE FROM location WHERE id IN ("
+            f" SELECT id FROM location WHERE NOT seen AND {_under(subtree)} LIMIT %s)"
+            f" RETURNING {LOCATION_COLUMNS}",
+            (_pattern(prefix, subtree), limit),
         )
+        return [LocationRecord(*row) for row in self.curs.fetchall()]
 
-    def all_file_count(self, prefix):
+    def save_directory_totals(self, dirpath, totals, checksums=()):
+        pass  # No rollups kept: totals are summed from location
+
+    def remove_unseen_directories(self, prefix):
+        return 0
+
+    def directory_totals(self, dirpath):
         self.curs.execute(
-            "SELECT count(*) FROM location WHERE dirpath LIKE %s", (f"{prefix}%",)
+            "SELECT count(*), coalesce(sum(filesize), 0), max(modified)"
+            " FROM location WHERE dirpath LIKE %s",
+            (f"{dirpath}%",),
         )
-        return self.curs.fetchone()[0]
+        totals = DirTotals(*self.curs.fetchone())
+        return totals if totals.files else None
 
-    def unseen_location_count(self, prefix):
+    def child_directories(self, dirpath):
+        return {}
+
+    def scanned_directories(self, prefix):
         self.curs.execute(
-            """SELECT count(*) FROM location WHERE NOT seen AND dirpath LIKE %s""",
+            "SELECT DISTINCT dirpath FROM location WHERE dirpath LIKE %s",
             (f"{prefix}%",),
         )
-        return self.curs.fetchone()[0]
+        return {dirpath: None for (dirpath,) in self.curs.fetchall()}  # Not kept
+
+    def refresh_directory_digests(self):
+        pass
 
-    def dir_files_not_seen(self, prefix):
+    def directory_digest(self, dirpath):
+        return None  # Not kept: directories can't be compared
+
+    def directory_entries(self, dirpath):
         self.curs.execute(
-            """SELECT dirpath, filename FROM location WHERE dirpath LIKE %s AND NOT seen""",
-            (f"{prefix}%",),
+            "SELECT filename, checksum FROM location WHERE dirpath = %s", (dirpath,)
         )
-        return self.curs.fetchmany()
+        return dict(self.curs.fetchall()), {}
 
-    def delete_unseen_locations(self, prefix):
+    def start_run(self, rootdir):
         self.curs.execute(
-            """DELETE from location WHERE NOT seen AND dirpath LIKE %s""",
-            (f"{prefix}%",),
+            "INSERT INTO runlog (when_run, rootdir, files, known, updated, unchanged, new_files, deleted) VALUES (%s, %s, 0, 0, 0, 0, 0, 0) RETURNING id",
+            (datetime.now(), rootdir),
         )
+        return self.curs.fetchone()[0]
 
-    def record_run(
-        self,
-        when: datetime,
-        rootdir: str,
-        files: int,
-        known: int,
-        updated: int,
-        unchanged: int,
-        new: int,
-        deleted: int,
-    ):
+    def end_run(self, run, files, known, updated, unchanged, new_files, deleted):
         self.curs.execute(
-            "INSERT INTO runlog (when_run, rootdir, files, known, updated, unchanged, new_files, deleted) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (when, rootdir, files, known, updated, unchanged, new, deleted),
+            "UPDATE runlog SET files=%s, known=%s, updated=%s, unchanged=%s, new_files=%s, deleted=%s WHERE id=%s",
+            (files, known, updated, unchanged, new_files, deleted, run),
         )
-        self.commit()
+
+    def archive_record(self, reason, rectype, record, runlog):
+        pass  # This schema keeps no archive
+
+    def record_metrics(self, run, metrics):
+        pass  # ... nor any run metrics
+
+    def record_hot_spots(self, run, hot_spots):
+        pass  # ... nor any hot spots
@@ -1,78 +1,229 @@
 import sqlite3
+from datetime import datetime
+
+from filescan.backend import (
+    DirTotals,
+    FileEntry,
+    LocationRecord,
+    Reference,
+    chunked,
+    file_checksum,
+)
+
+LOCATION_COLUMNS = (
+    "id, dirpath, filename, modified, checksum, seen, filesize, device, inode"
+)
+
+
+def _under(subtree):
+    return "dirpath LIKE ?" if subtree else "dirpath = ?"
+
+
+def _pattern(prefix, subtree):
+    return f"{prefix}%" if subtree else prefix
 
 
 class Connection:
     class DoesNotExist(Exception):
         pass
 
-    def __init__(self, dbname="test", create=False):
-        self.conn = sqlite3.connect(f"/Users/sholden/Desktop/{dbname}.sqlite")
+    def __init__(self, dbname="test", create=False, path=None):
+        self.conn = sqlite3.connect(path if path is not None else f"{dbname}.sqlite")
         if create:
             self.conn.execute("DROP TABLE IF EXISTS location")
             self.conn.execute(
                 "CREATE TABLE location (id INTEGER PRIMARY KEY, filename VARCHAR, dirpath varchar, modified number, checksum integer, seen boolean)"
             )
             self.conn.execute("ALTER TABLE location ADD COLUMN filesize INTEGER")
+            self.conn.execute("ALTER TABLE location ADD COLUMN device INTEGER")
+            self.conn.execute("ALTER TABLE location ADD COLUMN inode INTEGER")
+            self.conn.execute("DROP TABLE IF EXISTS tokenpos")
+            self.conn.execute(
+                "CREATE TABLE tokenpos (id INTEGER PRIMARY KEY, checksum CHAR(64), ttype INTEGER, name VARCHAR, line INTEGER, pos INTEGER)"
+            )
+            self.conn.execute("DROP TABLE IF EXISTS runlog")
+            self.conn.execute(
+                "CREATE TABLE runlog (id INTEGER PRIMARY KEY, when_run TIMESTAMP, rootdir VARCHAR, files INTEGER, known INTEGER, updated INTEGER, unchanged INTEGER, new_files INTEGER, deleted INTEGER)"
+            )
+
+    def begin(self):
+        return self.conn  # Commits on success, rolls back on error
 
     def commit(self):
         return self.conn.commit()
 
-    def clear_seen_bits(self, prefix):
+    def rollback(self):
+        return self.conn.rollback()
+
+    def flush(self):
+        pass
+
+    def clear_seen_bits(self, prefix, subtree=True):
+        self.conn.execute(
+            f"UPDATE location SET seen=FALSE WHERE {_under(subtree)}",
+            (_pattern(prefix, subtree),),
+        )
+
+    def mark_subtree_seen(self, prefix):
         self.conn.execute(
-            "UPDATE LOCATION SET seen=FALSE WHERE dirpath LIKE (%s || '%%')", (dirpath,)
+            "UPDATE location SET seen=TRUE WHERE dirpath LIKE ?", (f"{prefix}%",)
         )
 
-    def id_mod_seen(self, dir_path, file_path):
+    def all_file_count(self, prefix=""):
         curs = self.conn.execute(
-            """
-        SELECT id, modified, seen FROM location
-        WHERE dirpath=? AND filename=?""",
-            (dir_path, file_path),
+            "SELECT count(*) FROM location WHERE dirpath LIKE ?", (f"{prefix}%",)
         )
-        result = curs.fetchone()
-        if result:
-            return result
-        else:
-            raise Connection.DoesNotExist()
+        return curs.fetchone()[0]
 
-    def update_modified_hash_seen(self, id, modified, checksum, seen=True):
+    def total_size(self, prefix):
         curs = self.conn.execute(
-            """
-        UPDATE location \
-        SET modified=?, checksum=?, seen=? \
-                WHERE id=?""",
-            (modified, checksum, seen, id),
+            "SELECT coalesce(sum(filesize), 0) FROM ("
+            " SELECT max(filesize) AS filesize FROM location WHERE dirpath LIKE ?"
+            " GROUP BY coalesce(device, -id), inode) AS link_groups",
+            (f"{prefix}%",),
         )
+        return curs.fetchone()[0]
 
-    def update_seen(self, id):
+    def unseen_location_count(self, prefix=""):
         curs = self.conn.execute(
-            """
-        UPDATE location SET seen=TRUE
-                WHERE id=?""",
-            (id,),
+            "SELECT count(*) FROM location WHERE NOT seen AND dirpath LIKE ?",
+            (f"{prefix}%",),
         )
+        return curs.fetchone()[0]
 
-    def insert_location(self, file_path, dir_path, disk_modified, checksum):
-        self.conn.execute(
-            """
-        INSERT INTO location (filename, dirpath, modified, checksum, seen)
-        VALUES (?, ?, ?, ?, TRUE)""",
-            (file_path, dir_path, disk_modified, checksum),
+    # Storage protocol (see filescan.backend)
+
+    def register_hash(self, file_path):
+        return file_checksum(file_path)
+
+    def register_hashes(self, file_paths, throttle=None):
+        return [file_checksum(file_path, throttle) for file_path in file_paths]
+
+    def register_digests(self, digests):
+        return list(digests)
+
+    def block_digests(self, checksum):
+        return None  # Not kept: grown large files are hashed whole
+
+    def save_block_digests(self, checksum, digests):
+        pass
+
+    def save_reference(self, checksum, name, line, pos, ttype=1):
+        self.add_references_bulk(checksum, [(name, line, pos, ttype)])
+
+    def add_references_bulk(self, checksum, refs):
+        self.conn.executemany(
+            "INSERT INTO tokenpos (checksum, name, line, pos, ttype) VALUES (?, ?, ?, ?, ?)",
+            ((checksum, *Reference(*ref)) for ref in refs),
         )
 
-    def all_file_count(self):
-        curs = self.conn.execute("SELECT count(*) FROM location")
-        return curs.fetchone()[0]
+    def location_for(self, dirpath, filename):
+        try:
+            return self.lookup_many(dirpath, [filename])[filename]
+        except KeyError:
+            raise Connection.DoesNotExist(f"{dirpath}{filename}")
 
-    def unseen_location_count(self):
-        curs = self.conn.execute("""SELECT count(*) FROM location WHERE NOT seen""")
-        return curs.fetchone()[0]
+    def lookup_many(self, dirpath, filenames):
+        result = {}
+        for names in chunked(list(filenames)):
+            curs = self.conn.execute(
+                f"SELECT {LOCATION_COLUMNS} FROM location "
+                f"WHERE dirpath=? AND filename IN ({', '.join('?' * len(names))})",
+                (dirpath, *names),
+            )
+            for row in curs:
+                loc = LocationRecord(*row)
+                result[loc.filename] = loc
+        return result
+
+    def upsert_locations(self, dirpath, entries):
+        entries = [FileEntry(*entry) for entry in entries]
+        existing = self.lookup_many(dirpath, (e.filename for e in entries))
+        self.conn.executemany(
+            "UPDATE location SET modified=?, checksum=?, filesize=?, device=?, inode=?, seen=TRUE WHERE id=?",
+            (
+                (*e[1:], existing[e.filename].id)
+                for e in entries
+                if e.filename in existing
+            ),
+        )
+        self.conn.executemany(
+            "INSERT INTO location (dirpath, filename, modified, checksum, filesize, device, inode, seen) VALUES (?, ?, ?, ?, ?, ?, ?, TRUE)",
+            ((dirpath, *e) for e in entries if e.filename not in existing),
+        )
+        written = self.lookup_many(dirpath, (e.filename for e in entries))
+        return [written[e.filename] for e in entries]
+
+    def mark_seen(self, locations):
+        self.conn.executemany(
+            "UPDATE location SET seen=TRUE WHERE id=?",
+            ((loc.id,) for loc in locations),
+        )
+
+    def mark_deleted(self, prefix, limit=None, subtree=True):
+        curs = self.conn.execute(
+            f"DELETE FROM location WHERE id IN ("
+            f" SELECT id FROM location WHERE NOT seen AND {_under(subtree)} LIMIT ?)"
+            f" RETURNING {LOCATION_COLUMNS}",
+            (_pattern(prefix, subtree), -1 if limit is None else limit),
+        )
+        return [LocationRecord(*row) for row in curs.fetchall()]
+
+    def save_directory_totals(self, dirpath, totals, checksums=()):
+        pass  # No rollups kept: totals are summed from location
+
+    def remove_unseen_directories(self, prefix):
+        return 0
+
+    def directory_totals(self, dirpath):
+        curs = self.conn.execute(
+            "SELECT count(*), coalesce(sum(filesize), 0), max(modified)"
+            " FROM location WHERE dirpath LIKE ?",
+            (f"{dirpath}%",),
+        )
+        totals = DirTotals(*curs.fetchone())
+        return totals if totals.files else None
 
-    def dir_files_not_seen(self):
+    def child_directories(self, dirpath):
+        return {}
+
+    def scanned_directories(self, prefix):
+        curs = self.conn.execute(
+            "SELECT DISTINCT dirpath FROM location WHERE dirpath LIKE ?",
+            (f"{prefix}%",),
+        )
+        return {dirpath: None for (dirpath,) in curs.fetchall()}  # Times not kept
+
+    def refresh_directory_digests(self):
+        pass
+
+    def directory_digest(self, dirpath):
+        return None  # Not kept: directories can't be compared
+
+    def directory_entries(self, dirpath):
         curs = self.conn.execute(
-            """SELECT dirpath, filename FROM location WHERE NOT seen"""
+            "SELECT filename, checksum FROM location WHERE dirpath = ?", (dirpath,)
         )
-        return curs.fetchmany()
+        return dict(curs.fetchall()), {}
+
+    def start_run(self, rootdir):
+        curs = self.conn.execute(
+            "INSERT INTO runlog (when_run, rootdir, files, known, updated, unchanged, new_files, deleted) VALUES (?, ?, 0, 0, 0, 0, 0, 0)",
+            (datetime.now().isoformat(), rootdir),
+        )
+        return curs.lastrowid
+
+    def end_run(self, run, files, known, updated, unchanged, new_files, deleted):
+        self.conn.execute(
+            "UPDATE runlog SET files=?, known=?, updated=?, unchanged=?, new_files=?, deleted=? WHERE id=?",
+            (files, known, updated, unchanged, new_files, deleted, run),
+        )
+
+    def archive_record(self, reason, rectype, record, runlog):
+        pass  # This schema keeps no archive
+
+    def record_metrics(self, run, metrics):
+        pass  # ... nor any run metrics
 
-    def delete_unseen_locations(self):
-        curs = self.conn.execute("""DELETE from location WHERE NOT seen""")
+    def record_hot_spots(self, run, hot_spots):
+        pass  # ... nor any hot spots
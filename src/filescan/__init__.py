@@ -1,21 +1,46 @@
-import hashlib
+import argparse
+import functools
 import importlib
+import inspect
+import logging
 import os
+import pkgutil
 import sys
+import time
+from contextlib import nullcontext
 from datetime import datetime
+from time import perf_counter
 
-from dotenv import load_dotenv
-
-load_dotenv()
-
-from filescan.sqlalchemy_store import Checksum, Database
+from filescan import blocks
+from filescan.backend import (
+    BATCH_SIZE,
+    READ_ONCE_BUDGET,
+    READ_ONCE_SIZE,
+    Backend,
+    DirTotals,
+    FileEntry,
+    file_checksum,
+    read_once,
+)
+from filescan.config import (
+    COLLECTOR_TOKEN_ENV,
+    DB_URL_ENV,
+    IO_CONCURRENCY_ENV,
+    STAT_CACHE_ENV,
+    load_environment,
+)
+from filescan.iosched import DeviceScheduler, parse_limits
+from filescan.metrics import RunMetrics, ScanCounts
+from filescan.profile import TOP_N, HotSpots
+from filescan.progress import Progress
+from filescan.throttle import Throttle, set_idle_io_priority
+from filescan.walk import PSEUDO_FILESYSTEMS, Walker, parse_fs_types
+from filescan.memory_store import URL_SCHEME as MEMORY_URL_SCHEME, MemoryDatabase
 
 DEBUG = False  # Think _hard_ before enabling DEBUG
 
-import importlib
-import pkgutil
-
 DB_NAME = "alembic"
+PROGRESS_INTERVAL = 10.0  # Seconds between metrics file updates
 
 IGNORE_DIRS = {
     "__pycache__",
@@ -25,14 +50,49 @@ IGNORE_DIRS = {
     ".mypy_cache",
 }
 
-discovered_plugins = {
-    name: importlib.import_module(name)
-    for finder, name, ispkg in pkgutil.iter_modules()
-    if name.startswith("filescan_")
-}
-if discovered_plugins:
-    print("Plugins:", ", ".join(name for name in discovered_plugins))
-discovered_plugins = list(discovered_plugins.values())
+
+@functools.cache
+def discovered_plugins() -> list:
+    """
+    Import the plugins: top-level modules named "filescan_*", and
+    those shipped inside this package. Searching sys.path is slow,
+    so it is done only when a scan first needs the plugins.
+    """
+    names = {
+        name: name
+        for finder, name, ispkg in pkgutil.iter_modules()
+        if name.startswith("filescan_")
+    }
+    for finder, name, ispkg in pkgutil.iter_modules(__path__, f"{__name__}."):
+        short_name = name.rpartition(".")[2]
+        if short_name.startswith("filescan_"):
+            names.setdefault(short_name, name)  # Top-level modules take precedence
+    return [importlib.import_module(name) for name in names.values()]
+
+
+@functools.cache
+def takes_content(plugin) -> bool:
+    """
+    Whether `plugin.process` takes a `content` argument, the bytes of
+    a small file that the scanner has already read (None otherwise).
+    """
+    return "content" in inspect.signature(plugin.process).parameters
+
+
+def wants_content(plugins: list, filename: str) -> bool:
+    """Whether any of `plugins` takes the content of files named `filename`."""
+    return any(
+        takes_content(plugin)
+        and filename.endswith(tuple(getattr(plugin, "EXTENSIONS", [""])))
+        for plugin in plugins
+    )
+
+
+def run_plugin(plugin, db, loc, content: bytes | None = None) -> int | None:
+    """plugin.process(db, loc), handing it the file's content if it takes it."""
+    if takes_content(plugin):
+        return plugin.process(db, loc, content=content)
+    return plugin.process(db, loc)
 
 
 def debug(*args, **kwargs):
@@ -40,117 +100,1074 @@ def debug(*args, **kwargs):
         print(*args, **kwargs)
 
 
-def scan_directory(base_dir: str, db: Database):
+def _link_of(loc):
+    return None if loc.inode is None else (loc.device, loc.inode)
+
+
+def large_file_digests(path, size, loc, old, throttle=None):
+    """
+    Block digests for the large file at `path`, now `size` bytes long,
+    with the bytes read and whether it was hashed incrementally. If it
+    was at `loc` with block digests `old` at the last scan, and has
+    only grown since, a sample of its old blocks is checked and its new
+    tail hashed, rather than the whole file.
+    """
+    if old is not None and 0 < loc.filesize < size:
+        extended = blocks.extend_block_digests(path, old, loc.filesize, throttle)
+        if extended is not None:
+            digests, read = extended
+            return digests, read, True
+    return blocks.file_block_digests(path, throttle), size, False
+
+
+def _hash_large_files(
+    db: Backend, files: dict, metrics: RunMetrics, throttle, hot_spots=None
+):
+    """
+    Checksum handles for files of LARGE_FILE_SIZE or more, keyed as
+    `files` is. Those that have grown since the last scan have their
+    digests extended rather than rehashed in full, if the store kept
+    their block digests.
+    """
+    found = {}
+    for key, (path, stat, loc) in files.items():
+        started = perf_counter()
+        old = None
+        if loc is not None and loc.checksum is not None:
+            if 0 < loc.filesize < stat.st_size:
+                old = db.block_digests(loc.checksum)
+        digests, hashed, incremental = large_file_digests(
+            path, stat.st_size, loc, old, throttle
+        )
+        metrics.count("bytes_hashed", hashed)
+        if incremental:
+            metrics.count("incremental_hashes")
+        found[key] = digests
+        if hot_spots is not None:
+            hot_spots.add("hash", path, perf_counter() - started)
+    checksums = db.register_digests(
+        [None if d is None else blocks.root_digest(d) for d in found.values()]
+    )
+    for cs, digests in zip(checksums, found.values()):
+        if cs is not None:
+            db.save_block_digests(cs, digests)
+    return dict(zip(found, checksums))
+
+
+def scan_files(
+    db: Backend,
+    dirpath: str,
+    filenames: list[str],
+    runlog,
+    counts: ScanCounts,
+    metrics: RunMetrics,
+    links: dict,
+    plugins: list,
+    progress: Progress | None = None,
+    throttle: Throttle | None = None,
+    stats: dict[str, os.stat_result] | None = None,
+    scheduler: DeviceScheduler | None = None,
+    hot_spots: HotSpots | None = None,
+) -> dict[str, tuple]:
+    """
+    Scan the files directly in `dirpath` for a run: hash those that
+    are new or changed, write and archive their locations, mark the
+    rest seen and save the directory's totals. `links` maps the
+    (st_dev, st_ino) of files with several links to their checksums,
+    across the run's directories. Files the caller has already stat'ed
+    are given in `stats`. Small files that plugins want are read once,
+    and their content handed to the plugins. With a `scheduler`, files
+    below the large file size are read concurrently, as their devices
+    allow. The slowest files to hash and to process, and the time the
+    directory took, are noted in `hot_spots`, if given. Returns (stat,
+    checksum) for each file, by name.
+    """
+    started = perf_counter()
+    timer = metrics.timer
+    with timer("lookup"):
+        known = db.lookup_many(dirpath, filenames)
+    unchanged, changed = [], []
+    statted = {}
+    size, newest = 0, None  # Of the files directly in this directory
+    for i, filename in enumerate(filenames):
+        if progress is not None:
+            progress.update(dirpath, counts, pending=len(filenames) - i)
+        counts.files += 1
+        current_file_path = os.path.join(dirpath, filename)
+        if stats is None or (stat := stats.get(filename)) is None:
+            with timer("stat"):
+                if throttle is not None:
+                    throttle.stat()
+                stat = os.stat(current_file_path, follow_symlinks=False)
+        statted[filename] = stat
+        size += stat.st_size
+        if newest is None or stat.st_mtime > newest:
+            newest = stat.st_mtime
+        link = (stat.st_dev, stat.st_ino) if stat.st_nlink > 1 else None
+        loc = known.get(filename)
+        if loc is not None:  # Known file happy path
+            counts.known += 1
+            if stat.st_mtime == loc.modified:
+                counts.unchanged += 1
+                if link is not None:
+                    links.setdefault(link, loc.checksum)
+                if link == _link_of(loc):
+                    unchanged.append(loc)
+                else:  # Linked or unlinked since; content is the same
+                    changed.append((filename, stat, link, loc.checksum))
+                continue
+            counts.updated += 1  # Changed since last scan
+            debug("*UPDATED*", current_file_path)
+        else:  # New file
+            counts.new_files += 1
+            debug("*CREATED*", current_file_path)
+        changed.append((filename, stat, link, None))
+    with timer("hash"):
+        # Hash each inode once per run, however many links it has, reading
+        # small files that plugins want whole, once for both
+        to_hash, to_read, large = {}, {}, {}
+        buffered = 0
+        for filename, stat, link, cs in changed:
+            if cs is None and link not in links:
+                key = filename if link is None else link
+                if key in to_hash or key in to_read or key in large:
+                    continue
+                path = os.path.join(dirpath, filename)
+                if stat.st_size >= blocks.LARGE_FILE_SIZE:
+                    large[key] = (path, stat, known.get(filename))
+                    continue
+                if (
+                    stat.st_size < READ_ONCE_SIZE
+                    and buffered + stat.st_size <= READ_ONCE_BUDGET
+                    and wants_content(plugins, filename)
+                ):
+                    to_read[key] = (stat.st_dev, path, throttle)
+                    buffered += stat.st_size
+                else:
+                    to_hash[key] = (stat.st_dev, path, throttle)
+                metrics.count("bytes_hashed", stat.st_size)
+        hash_file = file_checksum if hot_spots is None else hot_spots.file_checksum
+        read_file = read_once if hot_spots is None else hot_spots.read_once
+        if scheduler is not None:
+            digests = scheduler.map(hash_file, to_hash.values())
+            read = scheduler.map(read_file, to_read.values())
+        else:
+            digests = [hash_file(path, throttle) for _, path, _ in to_hash.values()]
+            read = [read_file(path, throttle) for _, path, _ in to_read.values()]
+        checksums = db.register_digests(digests + [digest for digest, _ in read])
+        hashed = dict(zip([*to_hash, *to_read], checksums))
+        contents = {
+            key: data for key, (_, data) in zip(to_read, read) if data is not None
+        }
+        metrics.count("files_read_once", len(contents))
+        if large:
+            hashed.update(_hash_large_files(db, large, metrics, throttle, hot_spots))
+    entries = []
+    for filename, stat, link, cs in changed:
+        if cs is None:
+            if link is None:
+                cs = hashed[filename]
+            elif link in links:
+                cs = links[link]
+                metrics.count("links_reused")
+            else:
+                cs = links[link] = hashed[link]
+        device, inode = link or (None, None)
+        entries.append(
+            FileEntry(filename, stat.st_mtime, cs, stat.st_size, device, inode)
+        )
+    with timer("write"):
+        db.mark_seen(unchanged)
+        locs = db.upsert_locations(dirpath, entries)
+        db.save_directory_totals(
+            dirpath,
+            DirTotals(len(filenames), size, newest),
+            [(loc.filename, loc.checksum) for loc in unchanged]
+            + [(entry.filename, entry.checksum) for entry in entries],
+        )
+    for loc in locs:
+        content = contents.get(_link_of(loc) or loc.filename)
+        for plugin in plugins:
+            phase = f"plugin:{plugin.__name__}"
+            hot_spot = nullcontext()
+            if hot_spots is not None:
+                hot_spot = hot_spots.timer(phase, f"{dirpath}{loc.filename}")
+            with timer(phase), hot_spot:
+                metrics.count("tokens", run_plugin(plugin, db, loc, content) or 0)
+    with timer("flush"):
+        db.flush()
+    with timer("archive"):
+        for loc in locs:
+            reason = "UPDATED" if loc.filename in known else "CREATED"
+            db.archive_record(
+                reason=reason, rectype="location", record=loc, runlog=runlog
+            )
+    files = {loc.filename: (statted[loc.filename], loc.checksum) for loc in unchanged}
+    files.update(
+        (entry.filename, (statted[entry.filename], entry.checksum)) for entry in entries
+    )
+    if hot_spots is not None:
+        hot_spots.add("directory", dirpath, perf_counter() - started)
+    return files
+
+
+def delete_unseen(db: Backend, prefix: str, runlog, subtree: bool = True) -> int:
+    """
+    Delete and archive the unseen locations under `prefix` (or, with
+    `subtree` false, directly in it), returning how many there were.
+    """
+    count = 0
+    # In batches, so that a vanished subtree needn't fit in memory
+    while deleted := db.mark_deleted(prefix, limit=BATCH_SIZE, subtree=subtree):
+        count += len(deleted)
+        for loc in deleted:
+            debug(f"*DELETED* {loc.dirpath}{loc.filename}")
+            db.archive_record(
+                reason="DELETED", rectype="location", record=loc, runlog=runlog
+            )
+        db.flush()
+    return count
+
+
+def scan_directory(
+    base_dir: str,
+    db: Backend,
+    metrics: RunMetrics | None = None,
+    progress: Progress | None = None,
+    throttle: Throttle | None = None,
+    commit_every: int | None = None,
+    stat_cache=None,
+    walker: Walker | None = None,
+    scheduler: DeviceScheduler | None = None,
+    hot_spots: HotSpots | None = None,
+):
     """
     Recursively traverses a directory, noting which files
     are new since the last scan, which have been modified
-    and which have been deleted.
+    and which have been deleted. Time spent in each phase
+    of the scan, and the volume of work done, accumulate
+    in `metrics` and are stored with the run. A `progress`
+    object, if given, is kept informed as the scan runs, and a
+    `throttle` paces its stat calls and reads. With `commit_every`,
+    the store commits after that many directories rather than only
+    when the caller does, keeping transactions short on big trees.
+    With a `stat_cache` (see filescan.statcache), directories it
+    shows to be unchanged are passed over without asking the store;
+    the caller commits the cache once the run is committed. A
+    `walker` (see filescan.walk) decides which directories to enter;
+    the files indexed under any it could not list in time are kept.
+    A `scheduler` reads files concurrently (see filescan.iosched).
+    Given `hot_spots` (see filescan.profile), the run's slowest
+    directories and files are noted, stored with it and printed.
     """
     started: datetime = datetime.now()
-    file_count = known_files = updated_files = 0
-    unchanged_files = new_files = deleted_files = 0
+    if metrics is None:
+        metrics = RunMetrics()
+    timer = metrics.timer
+    counts = ScanCounts()
     base_dir = os.path.abspath(base_dir)
     if not base_dir.endswith("/"):
         base_dir += "/"
-    db.clear_seen_bits(base_dir)
+    cached = stat_cache is not None and stat_cache.valid
+    if progress is not None:
+        ct = stat_cache.file_count() if cached else db.all_file_count(base_dir)
+        progress.start(base_dir, metrics, expected_files=ct)
+    plugins = discovered_plugins()
+    links = {}  # (st_dev, st_ino) -> checksum, for files with several links
+    if not cached:  # Otherwise seen bits are cleared a directory at a time
+        db.clear_seen_bits(base_dir)
     runlog = db.start_run(base_dir)
-    db.session.flush()
+    db.flush()
+    if stat_cache is not None:
+        stat_cache.begin(runlog)
+    walked = set()
+    if walker is None:
+        walker = Walker()
 
-    for dirpath, dirnames, filenames in os.walk(base_dir):
+    walk = walker.walk(base_dir)
+    if hot_spots is not None:
+        hot_spots.clear()
+        walk = hot_spots.timed_walk(walk)
+    walk = metrics.timed("walk", walk)
+    for dirs_done, (dirpath, dirnames, filenames) in enumerate(walk, 1):
         for ignore_dir in IGNORE_DIRS:
             if ignore_dir in dirnames:
                 dirnames.remove(ignore_dir)
         if not dirpath.endswith("/"):
             dirpath = f"{dirpath}/"
-        for filename in filenames:
-            archive_data = None
-            file_count += 1
-            current_file_path = os.path.join(dirpath, filename)
-            stat = os.stat(current_file_path, follow_symlinks=False)
-            disk_modified = stat.st_mtime
-            size = stat.st_size
-            try:  # Known file happy path
-                loc = db.location_for(dirpath, filename)
-                id, checksum, seen = loc.id, loc.checksum, loc.seen
-                known_files += 1
-                if disk_modified != loc.modified:  # Changed since last scan
-                    updated_files += 1
-                    cs = db.register_hash(current_file_path)
-                    loc = db.update_details(loc, disk_modified, cs, size)
-                    for plugin in discovered_plugins:
-                        plugin.process(db, loc)
-                    debug("*UPDATED*", current_file_path)
-                    archive_data = dict(
-                        reason="UPDATED", rectype="location", record=loc, runlog=runlog
-                    )
-                else:
-                    unchanged_files += 1
-                    db.update_seen(loc)
-            except db.DoesNotExist:  # New file
-                new_files += 1
-                cs = db.register_hash(current_file_path)
-                loc = db.insert_location(
-                    dirpath=dirpath,
-                    filename=filename,
-                    modified=disk_modified,
-                    checksum=cs,
-                    filesize=size,
-                )
-                for plugin in discovered_plugins:
-                    plugin.process(db, loc)
-                debug("*CREATED*", current_file_path)
-                archive_data = dict(
-                    reason="CREATED", rectype="location", record=loc, runlog=runlog
-                )
-            db.session.flush()
-            if archive_data:
-                db.archive_record(**archive_data)
-    ct = db.all_file_count(base_dir)
-
-    deleted_files = db.unseen_location_count(base_dir)
-    for loc in db.unseen_locations(base_dir):
-        debug(f"*DELETED* {loc.dirpath}{loc.filename}")
-        archive_data = dict(
-            reason="DELETED", rectype="location", record=loc, runlog=runlog
+        if throttle is not None:
+            throttle.stat()  # For the directory listing
+        stats = None
+        if cached:
+            walked.add(dirpath)
+            with timer("stat"):
+                stats = {}
+                for filename in filenames:
+                    if throttle is not None:
+                        throttle.stat()
+                    path = os.path.join(dirpath, filename)
+                    stats[filename] = os.stat(path, follow_symlinks=False)
+            if stat_cache.unchanged(dirpath, stats):
+                counts.files += len(filenames)
+                counts.known += len(filenames)
+                counts.unchanged += len(filenames)
+                metrics.count("cached_directories")
+                stat_cache.keep(dirpath)
+                if progress is not None:
+                    progress.update(dirpath, counts, pending=0)
+                continue
+            db.clear_seen_bits(dirpath, subtree=False)
+        files = scan_files(
+            db,
+            dirpath,
+            filenames,
+            runlog,
+            counts,
+            metrics,
+            links,
+            plugins,
+            progress=progress,
+            throttle=throttle,
+            stats=stats,
+            scheduler=scheduler,
+            hot_spots=hot_spots,
         )
+        if cached:
+            with timer("delete"):
+                counts.deleted += delete_unseen(db, dirpath, runlog, subtree=False)
+        if stat_cache is not None:
+            stat_cache.save(dirpath, files)
+        if commit_every and dirs_done % commit_every == 0:
+            with timer("commit"):
+                db.commit()
+
+    kept = tuple(f"{dirpath.rstrip('/')}/" for dirpath in walker.timed_out)
+    with timer("delete"):
+        for dirpath in kept:
+            db.mark_subtree_seen(dirpath)
+        if cached:
+            for dirpath in stat_cache.vanished(walked):
+                if dirpath.startswith(kept):
+                    continue
+                db.clear_seen_bits(dirpath, subtree=False)
+                counts.deleted += delete_unseen(db, dirpath, runlog, subtree=False)
+        else:
+            counts.deleted += delete_unseen(db, base_dir, runlog)
+        db.remove_unseen_directories(base_dir)
+    with timer("digest"):
+        db.refresh_directory_digests()
+    for name, found in (
+        ("directories_pruned", walker.pruned),
+        ("directories_timed_out", walker.timed_out),
+        ("symlink_loops", walker.loops),
+    ):
+        if found:
+            metrics.count(name, len(found))
 
-    db.delete_unseen_locations(base_dir)
     db.end_run(
         runlog,
-        file_count,
-        known_files,
-        updated_files,
-        unchanged_files,
-        new_files,
-        deleted_files,
+        counts.files,
+        counts.known,
+        counts.updated,
+        counts.unchanged,
+        counts.new_files,
+        counts.deleted,
     )
+    if throttle is not None:  # Time also charged to the phases that waited
+        metrics.times["throttle"] = throttle.waited
+    db.record_metrics(runlog, metrics.as_dict())
+    if hot_spots is not None:
+        db.record_hot_spots(runlog, hot_spots.rows())
+    if progress is not None:
+        progress.finish(counts)
 
+    print_summary(counts, metrics)
+    if hot_spots is not None:
+        print(hot_spots.report())
+
+
+def print_summary(counts: ScanCounts, metrics: RunMetrics):
     print(
         f"""\
-Known:      {known_files:7,d}
-Unchanged:  {unchanged_files:7,d}
-Updated:    {updated_files:7,d}
-New:        {new_files:7,d}
-Deleted:    {deleted_files:7,d}
+Known:      {counts.known:7,d}
+Unchanged:  {counts.unchanged:7,d}
+Updated:    {counts.updated:7,d}
+New:        {counts.new_files:7,d}
+Deleted:    {counts.deleted:7,d}
 -------------------
-Total seen: {file_count:7,d}
-==================="""
+Total seen: {counts.files:7,d}
+===================
+{metrics.summary()}"""
     )
 
 
+def open_database(url=None) -> Backend:
+    """
+    Open the store named by `url` (or the FILESCAN_DB_URL environment
+    variable). memory:// URLs give an in-memory store; anything else
+    is handed to SQLAlchemy.
+    """
+    if url is None:
+        url = os.environ.get(DB_URL_ENV)
+    if url is not None and url.startswith(MEMORY_URL_SCHEME):
+        return MemoryDatabase.from_url(url)
+    from filescan.sqlalchemy_store import Database  # Costly, so only when needed
+
+    return Database(dbname=DB_NAME, url=url)
+
+
+def sqlalchemy_database(parser, url):
+    db = open_database(url)
+    if not hasattr(db, "session"):
+        parser.error("this command needs an SQLAlchemy database")
+    return db
+
+
+def export_command(args):
+    parser = argparse.ArgumentParser(
+        prog="filescan export",
+        description="Write the index to a columnar snapshot file.",
+    )
+    parser.add_argument("file", help="snapshot file to write")
+    parser.add_argument("--db-url", help="SQLAlchemy database URL")
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument("--prefix", help="only locations under this directory")
+    scope.add_argument(
+        "--run", type=int, metavar="ID", help="only locations under this run's root"
+    )
+    options = parser.parse_args(args)
+    load_environment()
+    from filescan.snapshot import export_snapshot
+
+    db = sqlalchemy_database(parser, options.db_url)
+    prefix = options.prefix
+    if prefix is not None and not prefix.endswith("/"):
+        prefix = f"{os.path.abspath(prefix)}/"
+    with db.begin(), open(options.file, "wb") as f:
+        try:
+            rows = export_snapshot(db, f, prefix=prefix, run=options.run)
+        except ValueError as e:
+            sys.exit(str(e))
+    print(", ".join(f"{n:,d} {table}" for table, n in rows.items()))
+
+
+def import_command(args):
+    parser = argparse.ArgumentParser(
+        prog="filescan import",
+        description="Bulk-load a snapshot file into an empty database.",
+    )
+    parser.add_argument("file", help="snapshot file to read")
+    parser.add_argument("--db-url", help="SQLAlchemy database URL")
+    options = parser.parse_args(args)
+    load_environment()
+    from filescan.snapshot import import_snapshot
+
+    db = sqlalchemy_database(parser, options.db_url)
+    with db.begin(), open(options.file, "rb") as f:
+        try:
+            rows = import_snapshot(db, f)
+        except ValueError as e:
+            sys.exit(str(e))
+    print(", ".join(f"{n:,d} {table}" for table, n in rows.items()))
+
+
+def du_command(args):
+    parser = argparse.ArgumentParser(
+        prog="filescan du",
+        description="Report indexed bytes and files under directories.",
+    )
+    parser.add_argument("dirs", nargs="+", metavar="dir", help="directory to report")
+    parser.add_argument("--db-url", help="SQLAlchemy database URL, or memory://")
+    parser.add_argument(
+        "-d",
+        "--max-depth",
+        type=int,
+        default=0,
+        metavar="N",
+        help="also report subdirectories down to N levels below each dir",
+    )
+    options = parser.parse_args(args)
+    load_environment()
+    db = open_database(options.db_url)
+
+    def report(dirpath, totals, depth):
+        newest = "-"
+        if totals.newest is not None:
+            newest = datetime.fromtimestamp(totals.newest).strftime("%Y-%m-%d %H:%M")
+        print(f"{totals.size:15,d} {totals.files:10,d}  {newest:16}  {dirpath}")
+        if depth < options.max_depth:
+            for child, child_totals in db.child_directories(dirpath).items():
+                report(child, child_totals, depth + 1)
+
+    missing = False
+    with db.begin():
+        for dirpath in options.dirs:
+            dirpath = os.path.abspath(dirpath).rstrip("/") + "/"
+            totals = db.directory_totals(dirpath)
+            if totals is None:
+                print(f"{dirpath}: not indexed", file=sys.stderr)
+                missing = True
+            else:
+                report(dirpath, totals, 0)
+        db.rollback()  # Nothing to store
+    if missing:
+        sys.exit(1)
+
+
+def verify_command(args):
+    from filescan.verify import (
+        DEFAULT_DAYS,
+        indexed_bytes,
+        oldest_verification,
+        parse_size,
+        verify,
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="filescan verify",
+        description="Re-hash the unchanged files verified longest ago, "
+        "reporting any whose content no longer matches the index.",
+    )
+    parser.add_argument(
+        "dirs",
+        nargs="*",
+        default=["/"],
+        metavar="dir",
+        help="directory whose files to verify (default: everything indexed)",
+    )
+    parser.add_argument("--db-url", help="SQLAlchemy database URL")
+    parser.add_argument(
+        "--bytes",
+        metavar="SIZE",
+        help="read at most this much per dir (e.g. 200G; default: enough to "
+        "cover everything in DAYS runs)",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=DEFAULT_DAYS,
+        metavar="DAYS",
+        help=f"runs, nightly, in which to cover everything (default {DEFAULT_DAYS})",
+    )
+    parser.add_argument(
+        "--read-limit",
+        type=float,
+        metavar="MB_PER_S",
+        help="hash no more than this many megabytes per second",
+    )
+    options = parser.parse_args(args)
+    budget = None
+    if options.bytes is not None:
+        try:
+            budget = parse_size(options.bytes)
+        except ValueError as e:
+            parser.error(str(e))
+    if options.days < 1:
+        parser.error("--days must be at least 1")
+    load_environment()
+    db = open_database(options.db_url)
+    if not hasattr(db, "session"):
+        sys.exit("filescan verify needs an SQLAlchemy database")
+    throttle = None
+    if options.read_limit:
+        throttle = Throttle(read_bytes_per_second=options.read_limit * 1e6)
+
+    mismatched = False
+    for dirpath in options.dirs:
+        prefix = os.path.abspath(dirpath).rstrip("/") + "/"
+        total = indexed_bytes(db, prefix)
+        limit = budget or -(-total // options.days)
+        counts = verify(db, prefix, limit, throttle)
+        oldest = oldest_verification(db, prefix)
+        db.commit()
+        for path in counts.mismatches:
+            print(f"MISMATCH {path}")
+        mismatched = mismatched or bool(counts.mismatches)
+        when = "never"
+        if oldest:
+            when = f"{datetime.fromtimestamp(oldest):%Y-%m-%d %H:%M}"
+        print(
+            f"""\
+{prefix}
+Verified:   {counts.files:7,d} files, {counts.bytes / 1e6:,.1f} MB
+Changed:    {counts.changed:7,d}
+Missing:    {counts.missing:7,d}
+Mismatched: {len(counts.mismatches):7,d}
+Least recently verified: {when}
+Runs to cover everything: {-(-total // max(limit, 1)):,d}"""
+        )
+    if mismatched:
+        sys.exit(1)
+
+
+def gc_command(args):
+    from filescan.budget import parse_duration
+    from filescan.orphans import BATCH_SIZE, collect
+
+    parser = argparse.ArgumentParser(
+        prog="filescan gc",
+        description="Delete the checksums, and their tokens, that no file "
+        "uses any more.",
+    )
+    parser.add_argument("--db-url", help="SQLAlchemy database URL")
+    parser.add_argument(
+        "--grace",
+        default="1d",
+        metavar="DURATION",
+        help="keep unused checksums this long before deleting them, e.g. 12h; "
+        "longer than any scan (default 1d)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        metavar="N",
+        help=f"checksums per transaction (default {BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="sleep between transactions, to leave room for scans",
+    )
+    options = parser.parse_args(args)
+    try:
+        grace = parse_duration(options.grace)
+    except ValueError as e:
+        parser.error(str(e))
+    if options.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    load_environment()
+    db = open_database(options.db_url)
+    if not hasattr(db, "session"):
+        sys.exit("filescan gc needs an SQLAlchemy database")
+    counts = collect(db, grace, options.batch_size, options.pause)
+    print(
+        f"""\
+Checked:   {counts.checked:9,d} checksums
+Marked:    {counts.marked:9,d}
+Unmarked:  {counts.unmarked:9,d}
+Deleted:   {counts.checksums:9,d} checksums, {counts.tokens:,d} tokens"""
+    )
+    if counts.conflicts:
+        print("A scan used a checksum being deleted; the rest waits for next time")
+
+
+def compare_command(args):
+    parser = argparse.ArgumentParser(
+        prog="filescan compare",
+        description="Report the differences between two indexed trees.",
+    )
+    parser.add_argument("left", help="first directory")
+    parser.add_argument("right", help="second directory")
+    parser.add_argument("--db-url", help="SQLAlchemy database URL, or memory://")
+    parser.add_argument(
+        "--other-db-url",
+        help="database indexing the second directory, if not the same one",
+    )
+    options = parser.parse_args(args)
+    load_environment()
+    from filescan.compare import compare_trees
+
+    left = open_database(options.db_url)
+    right = (
+        left if options.other_db_url is None else open_database(options.other_db_url)
+    )
+    roots = [
+        os.path.abspath(d).rstrip("/") + "/" for d in (options.left, options.right)
+    ]
+    differences = 0
+    with left.begin(), right.begin() if right is not left else nullcontext():
+        try:
+            for status, path in compare_trees(left, roots[0], right, roots[1]):
+                print(status, path)
+                differences += 1
+        except ValueError as e:
+            sys.exit(str(e))
+        for db in {id(left): left, id(right): right}.values():
+            db.rollback()  # Nothing to store
+    if differences:
+        sys.exit(1)
+    print("No differences")
+
+
+def collect_command(args):
+    parser = argparse.ArgumentParser(
+        prog="filescan collect",
+        description="Store the scans of remote workers (see filescan.remote).",
+    )
+    parser.add_argument(
+        "--listen",
+        default="127.0.0.1",
+        metavar="HOST:PORT",
+        help="address to accept workers on (default 127.0.0.1:8765)",
+    )
+    parser.add_argument("--db-url", help="SQLAlchemy database URL")
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        metavar="FRAMES",
+        help="commit after this many frames instead of once per run",
+    )
+    options = parser.parse_args(args)
+    load_environment()
+    logging.basicConfig(
+        level=os.environ.get("FILESCAN_LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        stream=sys.stdout,
+    )
+    from filescan.remote import Collector, parse_address
+
+    try:
+        collector = Collector(
+            parse_address(options.listen),
+            options.db_url,
+            token=os.environ.get(COLLECTOR_TOKEN_ENV, ""),
+            commit_every=options.commit_every,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    host, port = collector.server_address[:2]
+    print(f"Listening on {host}:{port}", flush=True)
+    with collector:
+        try:
+            collector.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def worker_command(args):
+    parser = argparse.ArgumentParser(
+        prog="filescan worker",
+        description="Scan directories here, storing the results via a collector.",
+    )
+    parser.add_argument("collector", metavar="HOST:PORT", help="collector address")
+    parser.add_argument("dirs", nargs="+", metavar="dir", help="directory to scan")
+    parser.add_argument(
+        "--read-limit",
+        type=float,
+        metavar="MB_PER_S",
+        help="hash no more than this many megabytes per second",
+    )
+    options = parser.parse_args(args)
+    load_environment()
+    from filescan.remote import ProtocolError, parse_address, run_worker
+
+    if plugins := discovered_plugins():
+        print("Plugins:", ", ".join(plugin.__name__ for plugin in plugins))
+    throttle = None
+    if options.read_limit:
+        throttle = Throttle(read_bytes_per_second=options.read_limit * 1e6)
+    try:
+        run_worker(
+            parse_address(options.collector),
+            options.dirs,
+            token=os.environ.get(COLLECTOR_TOKEN_ENV, ""),
+            throttle=throttle,
+        )
+    except (OSError, ProtocolError) as e:
+        sys.exit(f"Collector {options.collector}: {e}")
+
+
+COMMANDS = {
+    "export": export_command,
+    "import": import_command,
+    "du": du_command,
+    "compare": compare_command,
+    "verify": verify_command,
+    "gc": gc_command,
+    "collect": collect_command,
+    "worker": worker_command,
+}
+
+
 def main(
     args=sys.argv[1:],
     DEBUG=True,
     create=False,
 ):
-    if len(sys.argv) == 1:
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:])
+    parser = argparse.ArgumentParser(
+        prog="filescan",
+        description="Track files and Python name usage.",
+        epilog=f"Other commands: {', '.join(COMMANDS)} (filescan COMMAND --help).",
+    )
+    parser.add_argument("dirs", nargs="*", metavar="dir", help="directory to scan")
+    parser.add_argument(
+        "--db-url",
+        help="SQLAlchemy database URL, or memory:// (memory:///path to persist)",
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="print a status line this often while scanning",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=os.environ.get("FILESCAN_METRICS_FILE"),
+        help="Prometheus textfile-collector file to rewrite as the scan runs",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="report what would change without storing anything",
+    )
+    parser.add_argument(
+        "--read-limit",
+        type=float,
+        metavar="MB_PER_S",
+        help="hash no more than this many megabytes per second",
+    )
+    parser.add_argument(
+        "--stat-limit",
+        type=float,
+        metavar="OPS_PER_S",
+        help="stat no more than this many files or directories per second",
+    )
+    parser.add_argument(
+        "--target-latency",
+        type=float,
+        metavar="MS",
+        help="slow down while reads take longer than this (needs a limit)",
+    )
+    parser.add_argument(
+        "--idle-io",
+        action="store_true",
+        help="run in the idle I/O scheduling class",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="overlap filesystem and database work (see filescan.async_scan)",
+    )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        metavar="DIRS",
+        help="commit after this many directories instead of once per run",
+    )
+    parser.add_argument(
+        "--budget",
+        metavar="DURATION",
+        help="stop after this long (e.g. 20m), scanning the most overdue dirs first",
+    )
+    parser.add_argument(
+        "--stat-cache",
+        metavar="DIR",
+        default=os.environ.get(STAT_CACHE_ENV),
+        help="keep local indexes of file stats here, to skip unchanged directories",
+    )
+    parser.add_argument(
+        "-x",
+        "--one-file-system",
+        action="store_true",
+        help="don't descend into directories on other filesystems",
+    )
+    parser.add_argument(
+        "--fs-types",
+        type=parse_fs_types,
+        metavar="LIST",
+        help="descend only into mounts of these types (e.g. ext4,xfs,zfs)",
+    )
+    parser.add_argument(
+        "--skip-fs-types",
+        type=parse_fs_types,
+        default=PSEUDO_FILESYSTEMS,
+        metavar="LIST",
+        help="don't descend into mounts of these types (default: proc, sysfs "
+        "and other pseudo filesystems; patterns such as fuse.* are allowed)",
+    )
+    parser.add_argument(
+        "--follow-symlinks",
+        action="store_true",
+        help="descend into symlinked directories, entering each directory once",
+    )
+    parser.add_argument(
+        "--dir-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="skip directories that take longer than this to list",
+    )
+    parser.add_argument(
+        "--io-concurrency",
+        default=os.environ.get(IO_CONCURRENCY_ENV, ""),
+        metavar="[PATH=]N,...",
+        help="files of a directory to read at once on the device holding "
+        "PATH, or on every device (default: detected per device)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        nargs="?",
+        const=TOP_N,
+        metavar="N",
+        help=f"report the N (default {TOP_N}) slowest directories, files and "
+        "plugin calls, and store them with the run",
+    )
+    parser.add_argument(
+        "--profile-dump",
+        metavar="FILE",
+        help="write cProfile statistics for the scan to FILE (see pstats)",
+    )
+    options = parser.parse_args(args)
+    if options.budget is not None:
+        from filescan.budget import parse_duration
+
+        try:
+            budget = parse_duration(options.budget)
+        except ValueError as e:
+            parser.error(str(e))
+    if options.commit_every and options.dry_run:
+        parser.error("--commit-every can't be combined with --dry-run")
+    if options.use_async and (
+        options.dry_run or options.read_limit or options.stat_limit or options.budget
+    ):
+        parser.error("--async can't be combined with --dry-run, I/O limits or --budget")
+    if options.stat_cache and (options.use_async or options.budget):
+        parser.error("--stat-cache can't be combined with --async or --budget")
+    if options.use_async and (options.profile or options.profile_dump):
+        parser.error("--profile and --profile-dump can't be combined with --async")
+    if options.dir_timeout and options.use_async:
+        parser.error("--dir-timeout can't be combined with --async")
+    if options.follow_symlinks and options.budget:
+        parser.error("--follow-symlinks can't be combined with --budget")
+    if options.target_latency and not (options.read_limit or options.stat_limit):
+        parser.error("--target-latency needs --read-limit or --stat-limit")
+    try:
+        io_limits = parse_limits(options.io_concurrency)
+    except ValueError as e:
+        parser.error(f"--io-concurrency: {e}")
+    if not options.dirs:
         sys.exit("Nothing to do!")
-    db = Database(dbname=DB_NAME)
+    load_environment()
+    logging.basicConfig(
+        level=os.environ.get("FILESCAN_LOG_LEVEL", "WARNING").upper(),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        stream=sys.stdout,
+    )
+    if plugins := discovered_plugins():
+        print("Plugins:", ", ".join(plugin.__name__ for plugin in plugins))
+    db = open_database(options.db_url)
+
+    print(f"Using {'dry run against ' if options.dry_run else ''}database {db.dbname}")
+    progress = None
+    if options.progress or options.metrics_file:
+        progress = Progress(
+            interval=options.progress or PROGRESS_INTERVAL,
+            textfile=options.metrics_file,
+            stream=sys.stderr if options.progress else None,
+        )
+    throttle = None
+    if options.read_limit or options.stat_limit:
+        throttle = Throttle(
+            read_bytes_per_second=(options.read_limit or 0) * 1e6,
+            stats_per_second=options.stat_limit,
+            target_latency=options.target_latency and options.target_latency / 1000,
+        )
+    if options.idle_io:
+        set_idle_io_priority()
+    walker = Walker(
+        one_filesystem=options.one_file_system,
+        fs_types=options.fs_types,
+        skip_fs_types=options.skip_fs_types,
+        follow_symlinks=options.follow_symlinks,
+        timeout=options.dir_timeout,
+    )
+    if options.use_async:
+        import asyncio
 
-    print(f"Using production database {DB_NAME}")
-    with db.session.begin():
-        for base_dir in args:
-            scan_directory(base_dir, db)
+        from filescan.async_scan import scan_directories
+
+        if not hasattr(db, "db_url"):
+            sys.exit("--async needs an SQLAlchemy database")
+        scheduler = DeviceScheduler(io_limits)  # Closed below
+        try:
+            asyncio.run(
+                scan_directories(
+                    options.dirs,
+                    db.db_url,
+                    progress=progress,
+                    walker=walker,
+                    scheduler=scheduler,
+                )
+            )
+        finally:
+            scheduler.close()
+        return
+    scan = scan_directory
+    if options.budget is not None:
+        from filescan.budget import scan_with_budget
+
+        deadline = time.monotonic() + budget  # Shared by all the dirs
+
+        def scan(base_dir, db, **kwargs):
+            remaining = max(0.0, deadline - time.monotonic())
+            scan_with_budget(base_dir, db, remaining, **kwargs)
+
+    caches = []  # Stat caches to replace once their runs are committed
+    if options.stat_cache:
+        from filescan.statcache import StatCache
+
+        if not hasattr(db, "session"):
+            sys.exit("--stat-cache needs an SQLAlchemy database")
+        os.makedirs(options.stat_cache, exist_ok=True)
+
+        def scan(base_dir, db, **kwargs):
+            root = os.path.abspath(base_dir).rstrip("/") + "/"
+            caches.append(StatCache(options.stat_cache, db, root))
+            scan_directory(base_dir, db, stat_cache=caches[-1], **kwargs)
+
+    scheduler = DeviceScheduler(io_limits)  # Closed below
+    hot_spots = HotSpots(options.profile) if options.profile else None
+    profiler = None
+    if options.profile_dump:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if options.commit_every:  # The scan commits as it goes
+            for base_dir in options.dirs:
+                scan(
+                    base_dir,
+                    db,
+                    progress=progress,
+                    throttle=throttle,
+                    commit_every=options.commit_every,
+                    walker=walker,
+                    scheduler=scheduler,
+                    hot_spots=hot_spots,
+                )
+                db.commit()
+                while caches:
+                    caches.pop().commit()
+            return
+        with db.begin():
+            for base_dir in options.dirs:
+                scan(
+                    base_dir,
+                    db,
+                    progress=progress,
+                    throttle=throttle,
+                    walker=walker,
+                    scheduler=scheduler,
+                    hot_spots=hot_spots,
+                )
+            if options.dry_run:
+                db.rollback()
+        while caches and not options.dry_run:
+            caches.pop().commit()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.profile_dump)
+        for cache in caches:
+            cache.discard()
+        scheduler.close()
 
 
 if __name__ == "__main__":
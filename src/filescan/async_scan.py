@@ -0,0 +1,638 @@
+"""
+An asyncio scan engine for databases at the end of slow links.
+
+scan_directory stats, looks up, hashes and writes strictly in turn,
+so with a distant PostgreSQL server the database and the filesystem
+take turns to sit idle. Here directory listing, stat calls, hashing
+and plugins run in a thread pool, while lookups and writes for several
+directories are in flight at once on a small pool of connections
+(psycopg 3 for PostgreSQL, aiosqlite for SQLite) driven through
+SQLAlchemy's asyncio extension and Core statements.
+
+The results match scan_directory's, but each directory is written
+in a transaction of its own, so a run cannot be rolled back as a
+whole. Only the totals of the directories above each wait for the
+final transaction, so that concurrent writers never queue on (or
+deadlock over) their common ancestors' rollups. SQLite allows only one writer, so there directories are
+written one at a time (listing and hashing still overlap them).
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from filescan import (
+    IGNORE_DIRS,
+    blocks,
+    debug,
+    discovered_plugins,
+    large_file_digests,
+    print_summary,
+    run_plugin,
+    wants_content,
+)
+from filescan.backend import BATCH_SIZE, DirTotals, LRUCache, LocationRecord
+from filescan.backend import Reference, chunked, files_digest
+from filescan.backend import READ_ONCE_BUDGET, READ_ONCE_SIZE, file_checksum, read_once
+from filescan.config import engine_options
+from filescan.metrics import RunMetrics, ScanCounts
+from filescan.progress import Progress
+from filescan.sqlalchemy_store import (
+    CHECKSUM_CACHE_SIZE,
+    UPSERT_INSERTS,
+    Archive,
+    BlockDigests,
+    Checksum,
+    DirRollup,
+    Location,
+    RunLog,
+    RunMetric,
+    TokenPos,
+    _configure_sqlite,
+    refresh_digests,
+    rollup_direct_update,
+    rollup_removals,
+    rollup_rows,
+    rollup_total_updates,
+)
+from filescan.walk import Walker
+
+ASYNC_DRIVERS = {"postgresql": "psycopg", "sqlite": "aiosqlite"}
+CONCURRENCY = 4  # Directories in flight at once, where the database allows
+
+location = Location.__table__
+checksum = Checksum.__table__
+block_digests = BlockDigests.__table__
+rollup = DirRollup.__table__
+
+
+def async_url(url):
+    """`url` with the asyncio driver for its database substituted."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver known for {backend} databases")
+    if backend == "sqlite" and url.database in (None, "", ":memory:"):
+        raise ValueError("Asyncio scans need a database file or server")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def create_engine_async(url, **options):
+    engine = create_async_engine(async_url(url), **(engine_options() | options))
+    if engine.dialect.name == "sqlite":
+        _configure_sqlite(engine.sync_engine)
+    return engine
+
+
+class ReferenceBuffer:
+    """
+    Stands in for the store when plugins run in a worker thread,
+    keeping their references until they can be written.
+    """
+
+    def __init__(self):
+        self.references = []
+
+    def save_reference(self, checksum, name, line, pos, ttype=1):
+        self.add_references_bulk(checksum, [(name, line, pos, ttype)])
+
+    def add_references_bulk(self, checksum, refs):
+        self.references.extend((checksum, Reference(*ref)) for ref in refs)
+
+
+class AsyncScan:
+    def __init__(
+        self,
+        engine,
+        base_dir,
+        metrics,
+        progress,
+        concurrency,
+        executor,
+        walker=None,
+        scheduler=None,
+    ):
+        self.engine = engine
+        self.base_dir = base_dir
+        self.metrics = metrics
+        self.progress = progress
+        self.concurrency = 1 if engine.dialect.name == "sqlite" else concurrency
+        self.executor = executor
+        self.walker = Walker() if walker is None else walker
+        self.scheduler = scheduler
+        self.counts = ScanCounts()
+        self.plugins = discovered_plugins()
+        self.links = {}  # (st_dev, st_ino) -> digest, for files with several links
+        self.checksum_ids = LRUCache(CHECKSUM_CACHE_SIZE)
+        # Old and new direct totals by directory, applied to the rollups
+        # above them at the end, so directories in flight never contend
+        # for their common ancestors' rows
+        self.rollup_changes = {}
+
+    async def in_thread(self, phase, function, *args):
+        with self.metrics.timer(phase):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, function, *args
+            )
+
+    async def run(self):
+        under = location.c.dirpath.like(f"{self.base_dir}%")
+        async with self.engine.begin() as conn:
+            expected = await conn.scalar(select(func.count(location.c.id)).where(under))
+            await conn.execute(update(location).where(under).values(seen=False))
+            await conn.execute(
+                update(rollup)
+                .where(rollup.c.dirpath.like(f"{self.base_dir}%"))
+                .values(seen=False)
+            )
+            self.runlog_id = await conn.scalar(
+                insert(RunLog.__table__)
+                .values(
+                    when_run=datetime.now(),
+                    rootdir=self.base_dir,
+                    **{field: 0 for field in ScanCounts.__dataclass_fields__},
+                )
+                .returning(RunLog.__table__.c.id)
+            )
+        if self.progress is not None:
+            self.progress.start(self.base_dir, self.metrics, expected_files=expected)
+
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        async with asyncio.TaskGroup() as tasks:
+            tasks.create_task(self.list_directories(queue))
+            for _ in range(self.concurrency):
+                tasks.create_task(self.write_directories(queue))
+
+        async with self.engine.begin() as conn:
+            with self.metrics.timer("write"):
+                for q in rollup_total_updates(self.rollup_changes):
+                    await conn.execute(q)
+            with self.metrics.timer("delete"):
+                await self.delete_unseen(conn, under)
+                await self.remove_unseen_directories(conn)
+            with self.metrics.timer("digest"):
+                await conn.run_sync(refresh_digests)
+            await conn.execute(
+                update(RunLog.__table__)
+                .where(RunLog.__table__.c.id == self.runlog_id)
+                .values(when_finished=datetime.now(), **vars(self.counts))
+            )
+            await conn.execute(
+                insert(RunMetric.__table__),
+                [
+                    dict(runlog_id=self.runlog_id, name=name, value=value)
+                    for name, value in self.metrics.as_dict().items()
+                ],
+            )
+        if self.progress is not None:
+            self.progress.finish(self.counts)
+        return self.counts
+
+    async def list_directories(self, queue):
+        walker = self.walker.walk(self.base_dir)
+        while listing := await self.in_thread("walk", next, walker, None):
+            dirpath, dirnames, filenames = listing
+            for ignore_dir in IGNORE_DIRS:
+                if ignore_dir in dirnames:
+                    dirnames.remove(ignore_dir)
+            if not dirpath.endswith("/"):
+                dirpath = f"{dirpath}/"
+            stats = await self.in_thread("stat", stat_files, dirpath, filenames)
+            await queue.put((dirpath, stats))
+        for _ in range(self.concurrency):
+            await queue.put(None)
+
+    async def write_directories(self, queue):
+        while (item := await queue.get()) is not None:
+            async with self.engine.begin() as conn:
+                await self.write_directory(conn, *item)
+
+    async def write_directory(self, conn: AsyncConnection, dirpath, stats):
+        counts, metrics, timer = self.counts, self.metrics, self.metrics.timer
+        with timer("lookup"):
+            known = await self.lookup(conn, dirpath, [name for name, _ in stats])
+        unchanged, changed = [], []
+        for i, (filename, stat) in enumerate(stats):
+            if self.progress is not None:
+                self.progress.update(dirpath, counts, pending=len(stats) - i)
+            counts.files += 1
+            link = (stat.st_dev, stat.st_ino) if stat.st_nlink > 1 else None
+            loc = known.get(filename)
+            if loc is not None:
+                counts.known += 1
+                if stat.st_mtime == loc.modified:
+                    counts.unchanged += 1
+                    if link is not None:
+                        self.links.setdefault(link, loc.checksum)
+                    if link == (None if loc.inode is None else (loc.device, loc.inode)):
+                        unchanged.append(loc)
+                    else:
+                        changed.append((filename, stat, link, loc.checksum))
+                    continue
+                counts.updated += 1
+                debug("*UPDATED*", dirpath + filename)
+            else:
+                counts.new_files += 1
+                debug("*CREATED*", dirpath + filename)
+            changed.append((filename, stat, link, None))
+
+        to_hash, to_read, large = {}, {}, {}
+        buffered = 0
+        for filename, stat, link, digest in changed:
+            if digest is None and link not in self.links:
+                key = filename if link is None else link
+                if key in to_hash or key in to_read or key in large:
+                    continue
+                path = os.path.join(dirpath, filename)
+                if stat.st_size >= blocks.LARGE_FILE_SIZE:
+                    large[key] = (path, stat, known.get(filename))
+                    continue
+                job = (stat.st_dev, path)
+                if (
+                    stat.st_size < READ_ONCE_SIZE
+                    and buffered + stat.st_size <= READ_ONCE_BUDGET
+                    and wants_content(self.plugins, filename)
+                ):
+                    to_read[key] = job
+                    buffered += stat.st_size
+                else:
+                    to_hash[key] = job
+                metrics.count("bytes_hashed", stat.st_size)
+        if self.scheduler is None:
+            paths = [path for _, path in to_hash.values()]
+            digests = await self.in_thread("hash", hash_files, paths)
+            paths = [path for _, path in to_read.values()]
+            read = await self.in_thread("hash", read_files, paths)
+        else:  # Shared by the directories in flight, and limited per device
+            jobs = list(to_hash.values())
+            digests = await self.in_thread(
+                "hash", self.scheduler.map, file_checksum, jobs
+            )
+            jobs = list(to_read.values())
+            read = await self.in_thread("hash", self.scheduler.map, read_once, jobs)
+        hashed = dict(zip([*to_hash, *to_read], digests + [d for d, _ in read]))
+        contents = {
+            key: data for key, (_, data) in zip(to_read, read) if data is not None
+        }
+        metrics.count("files_read_once", len(contents))
+        found = {}  # Block digests of large files, by digest
+        if large:
+            with timer("lookup"):
+                old = await self.block_digests_for(conn, large.values())
+            jobs = [
+                (
+                    path,
+                    stat.st_size,
+                    loc,
+                    None if loc is None else old.get(loc.checksum),
+                )
+                for path, stat, loc in large.values()
+            ]
+            results = await self.in_thread("hash", hash_large_files, jobs)
+            for key, (digests, hashed_bytes, incremental) in zip(large, results):
+                metrics.count("bytes_hashed", hashed_bytes)
+                if incremental:
+                    metrics.count("incremental_hashes")
+                hashed[key] = None if digests is None else blocks.root_digest(digests)
+                if digests is not None:
+                    found[hashed[key]] = digests
+        entries = []
+        for filename, stat, link, digest in changed:
+            if digest is None:
+                if link is None:
+                    digest = hashed[filename]
+                elif link in self.links:
+                    digest = self.links[link]
+                    metrics.count("links_reused")
+                else:
+                    digest = self.links[link] = hashed[link]
+            device, inode = link or (None, None)
+            entries.append((filename, stat, digest, device, inode))
+
+        with timer("write"):
+            ids = await self.checksum_ids_for(
+                conn, {digest for *_, digest, _, _ in entries if digest is not None}
+            )
+            for batch in chunked([loc.id for loc in unchanged]):
+                await conn.execute(
+                    update(location).where(location.c.id.in_(batch)).values(seen=True)
+                )
+            await self.save_block_digests(conn, found, ids)
+            locs = await self.upsert(conn, dirpath, entries, known, ids)
+            await self.save_directory_totals(
+                conn,
+                dirpath,
+                DirTotals(
+                    len(stats),
+                    sum(stat.st_size for _, stat in stats),
+                    max((stat.st_mtime for _, stat in stats), default=None),
+                ),
+                [(loc.filename, loc.checksum) for loc in unchanged]
+                + [(loc.filename, loc.checksum) for loc in locs],
+            )
+
+        buffer = ReferenceBuffer()
+        for loc in locs:
+            link = None if loc.inode is None else (loc.device, loc.inode)
+            content = contents.get(link or loc.filename)
+            for plugin in self.plugins:
+                tokens = await self.in_thread(
+                    f"plugin:{plugin.__name__}",
+                    run_plugin,
+                    plugin,
+                    buffer,
+                    loc,
+                    content,
+                )
+                metrics.count("tokens", tokens or 0)
+        with timer("flush"):
+            if buffer.references:
+                await conn.execute(
+                    insert(TokenPos.__table__),
+                    [
+                        dict(checksum_id=ids[digest], **ref._asdict())
+                        for digest, ref in buffer.references
+                    ],
+                )
+        with timer("archive"):
+            await self.archive(
+                conn,
+                [
+                    ("UPDATED" if loc.filename in known else "CREATED", loc)
+                    for loc in locs
+                ],
+            )
+
+    async def lookup(self, conn, dirpath, filenames) -> dict[str, LocationRecord]:
+        result = {}
+        for names in chunked(filenames):
+            q = (
+                select(*location_columns())
+                .outerjoin(checksum, checksum.c.id == location.c.checksum_id)
+                .where(location.c.dirpath == dirpath, location.c.filename.in_(names))
+            )
+            for row in await conn.execute(q):
+                result[row.filename] = LocationRecord(*row)
+        return result
+
+    async def checksum_ids_for(self, conn, digests) -> dict[str, int]:
+        """Row ids for `digests`, inserting any that are new."""
+        ids = {}
+        for digest in digests:
+            if (id := self.checksum_ids.get(digest)) is not None:
+                ids[digest] = id
+        missing = sorted(digests - ids.keys())  # Sorted to avoid deadlocks
+        dialect_insert = UPSERT_INSERTS[self.engine.dialect.name]
+        for batch in chunked(missing):
+            q = (
+                dialect_insert(checksum)
+                .values([{"checksum": digest} for digest in batch])
+                .on_conflict_do_nothing(index_elements=["checksum"])
+                .returning(checksum.c.checksum, checksum.c.id)
+            )
+            ids.update((await conn.execute(q)).all())
+            unresolved = [digest for digest in batch if digest not in ids]
+            if unresolved:  # Rows that already existed
+                q = select(checksum.c.checksum, checksum.c.id).where(
+                    checksum.c.checksum.in_(unresolved)
+                )
+                ids.update((await conn.execute(q)).all())
+            for digest in batch:
+                self.checksum_ids.put(digest, ids[digest])
+        return ids
+
+    async def block_digests_for(self, conn, files) -> dict[str, bytes]:
+        """
+        The stored block digests of the content of the large files, as
+        (path, stat, location) with their previous locations, that have
+        grown since the last scan, by digest.
+        """
+        grown = sorted(
+            {
+                loc.checksum
+                for _, stat, loc in files
+                if loc is not None
+                and loc.checksum is not None
+                and 0 < loc.filesize < stat.st_size
+            }
+        )
+        result = {}
+        for batch in chunked(grown):
+            q = (
+                select(checksum.c.checksum, block_digests.c.digests)
+                .join(block_digests, block_digests.c.checksum_id == checksum.c.id)
+                .where(
+                    checksum.c.checksum.in_(batch),
+                    block_digests.c.block_size == blocks.BLOCK_SIZE,
+                )
+            )
+            result.update((await conn.execute(q)).all())
+        return result
+
+    async def save_block_digests(self, conn, found, ids):
+        """Store the block digests `found` for large files, by digest."""
+        if not found:
+            return
+        q = UPSERT_INSERTS[self.engine.dialect.name](block_digests)
+        q = q.on_conflict_do_update(
+            index_elements=["checksum_id"],
+            set_=dict(block_size=q.excluded.block_size, digests=q.excluded.digests),
+        )
+        rows = [
+            dict(checksum_id=ids[digest], block_size=blocks.BLOCK_SIZE, digests=digests)
+            for digest, digests in found.items()
+        ]
+        # Sorted, as rows are locked in this order
+        await conn.execute(q, sorted(rows, key=lambda row: row["checksum_id"]))
+
+    async def upsert(self, conn, dirpath, entries, known, ids):
+        values = [
+            dict(
+                filename=filename,
+                modified=stat.st_mtime,
+                checksum_id=ids.get(digest),
+                filesize=stat.st_size,
+                device=device,
+                inode=inode,
+            )
+            for filename, stat, digest, device, inode in entries
+        ]
+        new = [v for v in values if v["filename"] not in known]
+        if new:
+            q = insert(location).returning(
+                location.c.filename, location.c.id, sort_by_parameter_order=True
+            )
+            rows = [dict(v, dirpath=dirpath, seen=True) for v in new]
+            new_ids = dict((await conn.execute(q, rows)).all())
+        else:
+            new_ids = {}
+        # Bound parameter names must differ from the columns they set
+        updates = [
+            {f"new_{name}": value for name, value in v.items()}
+            | {"location_id": known[v["filename"]].id}
+            for v in values
+            if v["filename"] in known
+        ]
+        if updates:
+            q = (
+                update(location)
+                .where(location.c.id == bindparam("location_id"))
+                .values(
+                    {
+                        name: bindparam(f"new_{name}")
+                        for name in values[0]
+                        if name != "filename"
+                    }
+                    | {"seen": True}
+                )
+            )
+            await conn.execute(q, updates)
+        return [
+            LocationRecord(
+                id=new_ids.get(filename) or known[filename].id,
+                dirpath=dirpath,
+                filename=filename,
+                modified=stat.st_mtime,
+                checksum=digest,
+                seen=True,
+                filesize=stat.st_size,
+                device=device,
+                inode=inode,
+            )
+            for filename, stat, digest, device, inode in entries
+        ]
+
+    async def delete_unseen(self, conn, under):
+        q = (
+            select(*location_columns())
+            .outerjoin(checksum, checksum.c.id == location.c.checksum_id)
+            .where(under, location.c.seen == False)
+            .limit(BATCH_SIZE)
+        )
+        while deleted := [LocationRecord(*row) for row in await conn.execute(q)]:
+            await conn.execute(
+                delete(location).where(location.c.id.in_([loc.id for loc in deleted]))
+            )
+            self.counts.deleted += len(deleted)
+            for loc in deleted:
+                debug(f"*DELETED* {loc.dirpath}{loc.filename}")
+            await self.archive(conn, [("DELETED", loc) for loc in deleted])
+
+    async def save_directory_totals(self, conn, dirpath, totals, checksums):
+        q = select(
+            rollup.c.files, rollup.c.size, rollup.c.newest, rollup.c.files_digest
+        ).where(rollup.c.dirpath == dirpath)
+        row = (await conn.execute(q)).first()
+        if row is None:
+            q = UPSERT_INSERTS[self.engine.dialect.name](rollup)
+            q = q.on_conflict_do_nothing(index_elements=["dirpath"])
+            await conn.execute(q, rollup_rows(dirpath))
+        old = DirTotals() if row is None else DirTotals(*row[:3])
+        values = dict(files_digest=files_digest(checksums))  # Digests, here
+        if row is not None and values["files_digest"] != row.files_digest:
+            values["digest"] = None
+        await conn.execute(rollup_direct_update(dirpath, totals, **values))
+        self.rollup_changes[dirpath] = (old, totals)
+
+    async def remove_unseen_directories(self, conn):
+        q = select(rollup.c.dirpath, rollup.c.files, rollup.c.size, rollup.c.newest)
+        q = q.where(rollup.c.dirpath.like(f"{self.base_dir}%"), rollup.c.seen == False)
+        removed = {row[0]: DirTotals(*row[1:]) for row in await conn.execute(q)}
+        for q in rollup_removals(removed):
+            await conn.execute(q)
+
+    async def archive(self, conn, records):
+        if records:
+            await conn.execute(
+                insert(Archive.__table__),
+                [
+                    dict(
+                        reason=reason,
+                        rectype="location",
+                        data=loc.to_dict(),
+                        runlog_id=self.runlog_id,
+                    )
+                    for reason, loc in records
+                ],
+            )
+
+
+def location_columns():
+    """Columns for a LocationRecord, in order."""
+    return (
+        location.c.id,
+        location.c.dirpath,
+        location.c.filename,
+        location.c.modified,
+        checksum.c.checksum,
+        location.c.seen,
+        location.c.filesize,
+        location.c.device,
+        location.c.inode,
+    )
+
+
+def stat_files(dirpath, filenames):
+    return [
+        (filename, os.stat(os.path.join(dirpath, filename), follow_symlinks=False))
+        for filename in filenames
+    ]
+
+
+def hash_files(paths):
+    return [file_checksum(path) for path in paths]
+
+
+def read_files(paths):
+    return [read_once(path) for path in paths]
+
+
+def hash_large_files(jobs):
+    return [large_file_digests(*job) for job in jobs]
+
+
+async def scan_directories(
+    dirs,
+    url,
+    metrics_factory=RunMetrics,
+    progress: Progress | None = None,
+    concurrency=CONCURRENCY,
+    walker=None,
+    scheduler=None,
+):
+    """
+    Scan each of `dirs` into the database at `url`, as scan_directory
+    would, printing a summary of each; return their ScanCounts. The
+    `walker` must not have a timeout, as nothing here keeps the files
+    under directories it skips. A `scheduler` (see filescan.iosched)
+    limits concurrent reads per device.
+    """
+    engine = create_engine_async(url)
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+            for base_dir in dirs:
+                base_dir = os.path.abspath(base_dir)
+                if not base_dir.endswith("/"):
+                    base_dir += "/"
+                metrics = metrics_factory()
+                scan = AsyncScan(
+                    engine,
+                    base_dir,
+                    metrics,
+                    progress,
+                    concurrency,
+                    executor,
+                    walker,
+                    scheduler,
+                )
+                counts = await scan.run()
+                print_summary(counts, metrics)
+                results.append(counts)
+    finally:
+        await engine.dispose()
+    return results
@@ -0,0 +1,380 @@
+"""
+The storage protocol that scan_directory codes against.
+
+Any object providing these methods can serve as a filescan store.
+Lookups and writes work a directory at a time wherever possible,
+so a backend can answer a whole directory in one round trip rather
+than one query per file.
+
+Location objects returned by a backend need only offer the
+attributes of LocationRecord and a `to_dict()` method for archiving;
+the SQLAlchemy store returns its ORM Location objects. Checksums are
+opaque handles returned by `register_hash` and passed back unchanged.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import (
+    Any,
+    ContextManager,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Protocol,
+    Sequence,
+)
+
+from filescan import blocks
+from filescan.blocks import READ_SIZE
+
+# Bound parameters per IN (...) clause; comfortably below SQLite's limit
+BATCH_SIZE = 1000
+# Files smaller than this that plugins want are read once, into memory,
+# for both hashing and the plugins; see read_once
+READ_ONCE_SIZE = 1024 * 1024
+READ_ONCE_BUDGET = 64 * READ_ONCE_SIZE  # Bytes held at once, per directory
+
+
+class FileEntry(NamedTuple):
+    """
+    A new or changed file to be written by `upsert_locations`. Files
+    with several hard links also give their inode, identifying the
+    link group so that its bytes are only counted once.
+    """
+
+    filename: str
+    modified: float
+    checksum: Any
+    filesize: int
+    device: int | None = None
+    inode: int | None = None
+
+
+class Reference(NamedTuple):
+    """One occurrence of a name in a file's content."""
+
+    name: str
+    line: int
+    pos: int
+    ttype: int = 1
+
+
+class DirTotals(NamedTuple):
+    """
+    The files directly in a directory, or (as a rollup's totals) all
+    those anywhere beneath it: how many, their bytes (each hard link
+    counted, as `du --count-links` would) and the latest mtime.
+    """
+
+    files: int = 0
+    size: int = 0
+    newest: float | None = None
+
+
+@dataclass
+class LocationRecord:
+    """Plain location row for stores without an object mapper."""
+
+    id: Any
+    dirpath: str
+    filename: str
+    modified: float
+    checksum: Any
+    seen: bool
+    filesize: int
+    device: int | None = None
+    inode: int | None = None
+
+    def to_dict(self):
+        d = asdict(self)
+        d["checksum"] = {"checksum": self.checksum}
+        return d
+
+
+class Backend(Protocol):
+    DoesNotExist: type[Exception]
+
+    def begin(self) -> ContextManager:
+        """Context manager for a transaction that commits on success."""
+
+    def flush(self) -> None:
+        ...
+
+    def commit(self) -> None:
+        ...
+
+    def rollback(self) -> None:
+        ...
+
+    def start_run(self, rootdir: str) -> Any:
+        ...
+
+    def end_run(
+        self,
+        run: Any,
+        files: int,
+        known: int,
+        updated: int,
+        unchanged: int,
+        new_files: int,
+        deleted: int,
+    ) -> None:
+        ...
+
+    def record_metrics(self, run: Any, metrics: dict[str, float]) -> None:
+        """Store a run's timings and counters (see filescan.metrics)."""
+
+    def record_hot_spots(
+        self, run: Any, hot_spots: Iterable[tuple[str, str, float]]
+    ) -> None:
+        """Store a profiled run's (kind, path, seconds) (see filescan.profile)."""
+
+    def clear_seen_bits(self, prefix: str, subtree: bool = True) -> None:
+        """
+        Mark the locations and directories under `prefix` unseen, or
+        with `subtree` false only those directly in it.
+        """
+
+    def mark_subtree_seen(self, prefix: str) -> None:
+        """
+        Mark the locations and directories under `prefix` seen, so that
+        a run which couldn't look there deletes nothing beneath it.
+        """
+
+    def register_hash(self, file_path: str) -> Any:
+        ...
+
+    def register_digests(self, digests: Sequence[str | None]) -> list:
+        """Checksum handles for digests computed by the caller (None for None)."""
+
+    def block_digests(self, checksum: Any) -> bytes | None:
+        """The block digests saved for a checksum, if the store keeps them."""
+
+    def save_block_digests(self, checksum: Any, digests: bytes) -> None:
+        ...
+
+    def register_hashes(self, file_paths: Sequence[str], throttle=None) -> list:
+        """
+        Checksum handles for several files, in order, resolved together.
+        Reads are charged to `throttle`, if given (see file_checksum).
+        """
+
+    def location_for(self, dirpath: str, filename: str) -> Any:
+        ...
+
+    def lookup_many(self, dirpath: str, filenames: Iterable[str]) -> dict[str, Any]:
+        """Return the known locations among `filenames`, keyed by filename."""
+
+    def upsert_locations(self, dirpath: str, entries: Sequence[FileEntry]) -> list:
+        """
+        Insert or update a location for each entry, marking it seen,
+        and return the locations in the same order as the entries.
+        """
+
+    def mark_seen(self, locations: Iterable[Any]) -> None:
+        ...
+
+    def save_reference(
+        self, checksum: Any, name: str, line: int, pos: int, ttype: int = 1
+    ) -> Any:
+        ...
+
+    def add_references_bulk(self, checksum: Any, refs: Iterable[Reference]) -> None:
+        ...
+
+    def archive_record(self, reason: str, rectype: str, record: Any, runlog: Any):
+        ...
+
+    def all_file_count(self, prefix: str) -> int:
+        ...
+
+    def total_size(self, prefix: str) -> int:
+        """Bytes in the files under `prefix`, counting each link group once."""
+
+    def unseen_location_count(self, prefix: str) -> int:
+        ...
+
+    def mark_deleted(
+        self, prefix: str, limit: int | None = None, subtree: bool = True
+    ) -> list:
+        """
+        Delete the unseen locations under `prefix` (at most `limit` of
+        them), returning them so the caller can archive their final state.
+        With `subtree` false, only those directly in `prefix` go.
+        """
+
+    def save_directory_totals(
+        self, dirpath: str, totals: DirTotals, checksums: Iterable[tuple] = ()
+    ) -> None:
+        """
+        Record the files directly in a scanned directory, marking it seen
+        (and scanned now) and adjusting the rollups of the directory and
+        all above it.
+        `checksums` pairs each file's name with its checksum handle, for
+        the directory's content digest (see directory_digest).
+        """
+
+    def remove_unseen_directories(self, prefix: str) -> int:
+        """Drop the rollups of directories under `prefix` not seen this run."""
+
+    def scanned_directories(self, prefix: str) -> dict[str, float | None]:
+        """
+        When each indexed directory under `prefix` was last scanned, as
+        a timestamp; None where the store doesn't know.
+        """
+
+    def refresh_directory_digests(self) -> None:
+        """Bring the digests of directories whose content changed up to date."""
+
+    def directory_digest(self, dirpath: str) -> str | None:
+        """
+        Digest of all the content under `dirpath`: equal for two
+        directories exactly when they hold the same names with the same
+        content. None if the store keeps none for `dirpath`.
+        """
+
+    def directory_entries(
+        self, dirpath: str
+    ) -> tuple[dict[str, str | None], dict[str, str | None]]:
+        """
+        The files directly in `dirpath`, mapping names to content digests,
+        and its subdirectories, mapping names to directory digests.
+        """
+
+    def directory_totals(self, dirpath: str) -> DirTotals | None:
+        """Totals for everything under `dirpath`; None if it isn't indexed."""
+
+    def child_directories(self, dirpath: str) -> dict[str, DirTotals]:
+        """Totals for each directory immediately below `dirpath`, by path."""
+
+
+def file_checksum(file_path: str, throttle=None) -> str | None:
+    """
+    SHA-256 of a file's content (the root of its block digests for
+    large files; see filescan.blocks), or None if it can't be read.
+    Reads are charged to `throttle` (a filescan.throttle.Throttle).
+    """
+    try:
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size >= blocks.LARGE_FILE_SIZE:
+                return blocks.root_digest(blocks.block_digests(f, throttle))
+            return _sha256(f, throttle)
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def file_checksums(file_path: str, throttle=None) -> tuple[str, str] | None:
+    """
+    file_checksum(file_path) and the plain SHA-256 of the file's
+    content, from a single read, or None if it can't be read. The two
+    differ only for large files, and those indexed before block digests
+    were kept have the plain SHA-256 as their checksum.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < blocks.LARGE_FILE_SIZE:
+                digest = _sha256(f, throttle)
+                return digest, digest
+            whole = hashlib.sha256()
+            digests = blocks.block_digests(f, throttle, whole)
+            return blocks.root_digest(digests), whole.hexdigest()
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def _sha256(f, throttle=None) -> str:
+    if throttle is None:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+    digest = hashlib.sha256()
+    while chunk := blocks.throttle_read(f, READ_SIZE, throttle):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_once(file_path: str, throttle=None) -> tuple[str | None, bytes | None]:
+    """
+    file_checksum(file_path) and, for a file under READ_ONCE_SIZE, its
+    content, read once for both, so that plugins needn't read it again.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < READ_ONCE_SIZE:
+                if throttle is None:
+                    data = f.read()
+                else:
+                    data = blocks.throttle_read(f, -1, throttle)
+                return hashlib.sha256(data).hexdigest(), data
+    except (FileNotFoundError, PermissionError):
+        return None, None
+    return file_checksum(file_path, throttle), None  # Grown since it was stat'ed
+
+
+def _name_digest(kind: bytes, name: str, digest: str | None) -> bytes:
+    name = name.encode("utf-8", "surrogateescape")
+    return b"%s%d:%s%s\n" % (kind, len(name), name, (digest or "-").encode())
+
+
+def files_digest(files: Iterable[tuple[str, str | None]]) -> str:
+    """Digest of the (name, content digest) pairs of a directory's files."""
+    digest = hashlib.sha256()
+    for name, checksum in sorted(files):
+        digest.update(_name_digest(b"F", name, checksum))
+    return digest.hexdigest()
+
+
+def directory_digest(files: str | None, subdirs: Iterable[tuple[str, str]]) -> str:
+    """
+    A directory's Merkle digest, from the `files_digest` of its own files
+    and the (name, directory digest) pairs of its subdirectories. Only
+    names below the directory count, so equal trees under different
+    roots have equal digests.
+    """
+    digest = hashlib.sha256((files or files_digest(())).encode())
+    for name, subdir in sorted(subdirs):
+        digest.update(_name_digest(b"D", name, subdir))
+    return digest.hexdigest()
+
+
+def ancestors(dirpath: str) -> list[str]:
+    """`dirpath` and each directory above it, deepest first."""
+    result = [dirpath]
+    while parent := parent_directory(result[-1]):
+        result.append(parent)
+    return result
+
+
+def parent_directory(dirpath: str) -> str | None:
+    return dirpath[: dirpath.rstrip("/").rfind("/") + 1] or None
+
+
+def chunked(items: Sequence, size: int = BATCH_SIZE) -> Iterator[Sequence]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class LRUCache:
+    """A mapping that forgets its least recently used keys beyond `maxsize`."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            return default
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
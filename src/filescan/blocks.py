@@ -0,0 +1,118 @@
+"""
+Block digests, so that large files which only grow are not re-read in full.
+
+Content at least LARGE_FILE_SIZE long is identified not by the SHA-256
+of the whole file but by a root digest over the SHA-256 of each of its
+BLOCK_SIZE blocks (a one-level Merkle tree). Stores keep the block
+digests alongside the checksum, so when a large file has only grown,
+as logs, journals and append-only datasets do, `extend_block_digests`
+re-reads its first and last complete blocks and any partial block to
+check they still match, then hashes the new tail onto the old
+digests. Any mismatch means the file was rewritten, and the caller
+hashes it afresh.
+
+The check is a sample, and that is its risk: a file rewritten in
+place between its first and last complete blocks, and grown as well,
+keeps the stale digests of the blocks rewritten, and so a content
+identity that does not match its content. Dedup and compare trust
+that identity until the file next changes other than by growing;
+`filescan verify` re-hashes files in full and reports it as a
+mismatch. Checking every old block would rule this out, but would
+read the whole file again, which is what this module is here to avoid.
+"""
+import hashlib
+import os
+from time import perf_counter
+
+BLOCK_SIZE = 8 * 1024 * 1024
+LARGE_FILE_SIZE = 8 * BLOCK_SIZE  # Smaller files are simply hashed whole
+READ_SIZE = 1024 * 1024  # Bytes per read when hashing under a throttle
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+def root_digest(digests: bytes) -> str:
+    """The content identity of a file with these block digests."""
+    return hashlib.sha256(b"blocks:%d:" % BLOCK_SIZE + digests).hexdigest()
+
+
+def read_block(f, throttle=None) -> bytes:
+    if throttle is None:
+        return f.read(BLOCK_SIZE)
+    chunks = []
+    remaining = BLOCK_SIZE
+    while remaining:
+        chunk = throttle_read(f, min(READ_SIZE, remaining), throttle)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def throttle_read(f, size, throttle):
+    """Read up to `size` bytes, charging them to `throttle`."""
+    started = perf_counter()
+    chunk = f.read(size)
+    throttle.read(len(chunk), perf_counter() - started)
+    return chunk
+
+
+def block_digests(f, throttle=None, whole=None) -> bytes:
+    """
+    Digests of each block from the file's current position to its end,
+    feeding the blocks to the hash object `whole` too, if given.
+    """
+    digests = []
+    while block := read_block(f, throttle):
+        digests.append(hashlib.sha256(block).digest())
+        if whole is not None:
+            whole.update(block)
+    return b"".join(digests)
+
+
+def file_block_digests(file_path: str, throttle=None) -> bytes | None:
+    try:
+        with open(file_path, "rb") as f:
+            return block_digests(f, throttle)
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def extend_block_digests(
+    file_path: str, digests: bytes, old_size: int, throttle=None
+) -> tuple[bytes, int] | None:
+    """
+    Block digests for a file that had `digests` when `old_size` bytes
+    long, and the bytes read to get them: the sampled old blocks, the
+    old partial block and what was appended since. None if the file
+    can't be read, has shrunk, or fails the check of its old content.
+    """
+    if len(digests) != -(-old_size // BLOCK_SIZE) * DIGEST_SIZE:
+        return None
+
+    def old_digest(i):
+        return digests[i * DIGEST_SIZE : (i + 1) * DIGEST_SIZE]
+
+    complete, partial = divmod(old_size, BLOCK_SIZE)
+    try:
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < old_size:
+                return None
+            read = 0
+            for i in sorted({0, complete - 1} & set(range(complete))):
+                f.seek(i * BLOCK_SIZE)
+                block = read_block(f, throttle)
+                read += len(block)
+                if hashlib.sha256(block).digest() != old_digest(i):
+                    return None
+            f.seek(complete * BLOCK_SIZE)
+            extended = digests[: complete * DIGEST_SIZE]
+            if partial:  # The old last block must be a prefix of its new content
+                block = read_block(f, throttle)
+                if hashlib.sha256(block[:partial]).digest() != old_digest(complete):
+                    return None
+                extended += hashlib.sha256(block).digest()
+            extended += block_digests(f, throttle)
+            return extended, read + f.tell() - complete * BLOCK_SIZE
+    except (FileNotFoundError, PermissionError):
+        return None
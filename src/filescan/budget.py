@@ -0,0 +1,231 @@
+"""
+Scans that stop when their time is up.
+
+A full scan walks every directory, changed or not. scan_with_budget
+instead scans directories one at a time, in priority order, until
+its budget of seconds is spent. Directories whose entries changed
+since they were last scanned (their mtime is later, or they are new
+to the index) come first, most recently changed first; then the rest,
+least recently scanned first. Each directory's scan time is kept with
+its rollup, so the next run begins with those most overdue. Finding
+the changed directories takes a stat call each, so they are stat'ed
+most overdue first, for half the budget at most; any left over keep
+their place by scan time. A file
+rewritten in place doesn't touch its directory's mtime, so it is
+picked up when that directory's turn comes round.
+
+Deletion covers only what the run looked at: a scanned directory
+loses the locations of files that have left it, and a directory found
+missing (or absent from its parent's listing) loses everything
+beneath it. Directories the run didn't reach are left alone.
+"""
+import heapq
+import math
+import os
+import re
+import time
+from contextlib import nullcontext
+
+from filescan import (
+    IGNORE_DIRS,
+    delete_unseen,
+    discovered_plugins,
+    print_summary,
+    scan_files,
+)
+from filescan.backend import Backend
+from filescan.iosched import DeviceScheduler
+from filescan.metrics import RunMetrics, ScanCounts
+from filescan.profile import HotSpots
+from filescan.progress import Progress
+from filescan.throttle import Throttle
+from filescan.walk import Walker
+
+CHANGED, UNCHANGED = 0, 1  # Priority classes, the lower first
+UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(text: str) -> float:
+    """Seconds in "90", "90s", "20m", "1.5h" or "1d"."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([smhd]?)\s*", text.lower())
+    if match is None:
+        raise ValueError(f"Not a duration: {text!r}")
+    return float(match[1]) * UNITS[match[2]]
+
+
+def schedule(
+    db: Backend,
+    base_dir: str,
+    throttle: Throttle | None = None,
+    deadline: float = math.inf,
+    clock=time.monotonic,
+) -> list:
+    """
+    A heap of (class, key, dirpath) for each indexed directory under
+    `base_dir`, in the order they should be scanned. Directories are
+    stat'ed to see which have changed, the most overdue first, until
+    `deadline`; the rest are queued by their last scan time alone.
+    """
+    queue = []
+    scanned = db.scanned_directories(base_dir)
+    scanned.setdefault(base_dir, None)  # Nothing indexed yet
+    overdue = sorted(scanned.items(), key=lambda item: (item[1] is not None, item[1]))
+    for dirpath, when in overdue:
+        if clock() >= deadline:  # Out of time to look
+            if when is None:
+                queue.append((CHANGED, math.inf, dirpath))
+            else:
+                queue.append((UNCHANGED, when, dirpath))
+            continue
+        if throttle is not None:
+            throttle.stat()
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            mtime = math.inf  # Gone: cheap to deal with, so do it first
+        if when is None or mtime > when:
+            queue.append((CHANGED, -mtime, dirpath))
+        else:
+            queue.append((UNCHANGED, when, dirpath))
+    heapq.heapify(queue)
+    return queue
+
+
+def scan_with_budget(
+    base_dir: str,
+    db: Backend,
+    budget: float,
+    metrics: RunMetrics | None = None,
+    progress: Progress | None = None,
+    throttle: Throttle | None = None,
+    commit_every: int | None = None,
+    clock=time.monotonic,
+    walker: Walker | None = None,
+    scheduler: DeviceScheduler | None = None,
+    hot_spots: HotSpots | None = None,
+) -> int:
+    """
+    Scan the directories under `base_dir` most in need of it until
+    `budget` seconds have passed, returning how many were left for
+    the next run. The budget is checked between directories, and the
+    stat calls ranking them may take no more than half of it. The
+    `walker` decides which subdirectories belong to the scan; it
+    must not follow symlinks, as the queue is kept by path.
+    """
+    started = clock()
+    deadline = started + budget
+    if metrics is None:
+        metrics = RunMetrics()
+    timer = metrics.timer
+    counts = ScanCounts()
+    base_dir = os.path.abspath(base_dir)
+    if not base_dir.endswith("/"):
+        base_dir += "/"
+    if walker is None:
+        walker = Walker()
+    realbase = f"{os.path.realpath(base_dir).rstrip('/')}/"
+    try:
+        device = os.stat(base_dir).st_dev
+    except OSError:
+        device = None
+    if progress is not None:
+        progress.start(base_dir, metrics, expected_files=db.all_file_count(base_dir))
+    plugins = discovered_plugins()
+    links = {}
+    if hot_spots is not None:
+        hot_spots.clear()
+    runlog = db.start_run(base_dir)
+    db.flush()
+    with timer("schedule"):
+        queue = schedule(db, base_dir, throttle, started + budget / 2, clock)
+    queued = {dirpath for _, _, dirpath in queue}
+    dirs_done = 0
+
+    def remove_subtree(dirpath):
+        with timer("delete"):
+            db.clear_seen_bits(dirpath)
+            counts.deleted += delete_unseen(db, dirpath, runlog)
+            db.remove_unseen_directories(dirpath)
+
+    while queue and clock() < deadline:
+        _, _, dirpath = heapq.heappop(queue)
+        if throttle is not None:
+            throttle.stat()  # For the directory listing
+        hot_spot = nullcontext()
+        if hot_spots is not None:
+            hot_spot = hot_spots.timer("walk", dirpath)
+        try:
+            with timer("walk"), hot_spot:
+                dirs, filenames = walker.listdir(dirpath)
+        except (FileNotFoundError, NotADirectoryError):
+            remove_subtree(dirpath)
+            continue
+        except OSError:
+            continue  # Unreadable or too slow to list: try again next run
+        subdirs = {}
+        for name, entry in dirs.items():
+            real = f"{realbase}{dirpath[len(base_dir):]}{name}"
+            if name not in IGNORE_DIRS and walker.descend(
+                f"{dirpath}{name}", real, entry, device, set()
+            ):
+                subdirs[f"{dirpath}{name}/"] = entry
+        for child in db.child_directories(dirpath):
+            if child not in subdirs:
+                remove_subtree(child)
+        for child, entry in subdirs.items():
+            if child not in queued:  # New to the index
+                queued.add(child)
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    mtime = math.inf
+                heapq.heappush(queue, (CHANGED, -mtime, child))
+        db.clear_seen_bits(dirpath, subtree=False)
+        scan_files(
+            db,
+            dirpath,
+            filenames,
+            runlog,
+            counts,
+            metrics,
+            links,
+            plugins,
+            progress=progress,
+            throttle=throttle,
+            scheduler=scheduler,
+            hot_spots=hot_spots,
+        )
+        with timer("delete"):
+            counts.deleted += delete_unseen(db, dirpath, runlog, subtree=False)
+        dirs_done += 1
+        if commit_every and dirs_done % commit_every == 0:
+            with timer("commit"):
+                db.commit()
+
+    with timer("digest"):
+        db.refresh_directory_digests()
+    metrics.count("directories", dirs_done)
+    metrics.count("directories_deferred", len(queue))
+    db.end_run(
+        runlog,
+        counts.files,
+        counts.known,
+        counts.updated,
+        counts.unchanged,
+        counts.new_files,
+        counts.deleted,
+    )
+    if throttle is not None:
+        metrics.times["throttle"] = throttle.waited
+    db.record_metrics(runlog, metrics.as_dict())
+    if hot_spots is not None:
+        db.record_hot_spots(runlog, hot_spots.rows())
+    if progress is not None:
+        progress.finish(counts)
+
+    print_summary(counts, metrics)
+    if hot_spots is not None:
+        print(hot_spots.report())
+    if queue:
+        print(f"Budget spent; directories left for the next run: {len(queue):,d}")
+    return len(queue)
@@ -0,0 +1,59 @@
+"""
+Compare two indexed trees by their directory digests.
+
+Each directory's digest covers the names and content of everything
+beneath it (see filescan.backend.directory_digest), so two trees are
+compared top-down, reading the entries only of directories whose
+digests differ. Identical subtrees, however large, cost one
+comparison. The trees may be in the same store (two roots) or in two
+stores (the same root indexed on two hosts).
+"""
+from typing import Iterator
+
+from filescan.backend import Backend
+
+ONLY_LEFT = "-"
+ONLY_RIGHT = "+"
+CHANGED = "M"
+
+
+def compare_trees(
+    left: Backend, left_root: str, right: Backend, right_root: str
+) -> Iterator[tuple[str, str]]:
+    """
+    Yield (status, path relative to the roots) for each difference
+    between the trees, directories ending in "/". Raises ValueError
+    if either store holds no digest for its root.
+    """
+    digests = []
+    for db, root in ((left, left_root), (right, right_root)):
+        if (digest := db.directory_digest(root)) is None:
+            raise ValueError(f"No directory digest for {root}: scan it first")
+        digests.append(digest)
+    if digests[0] != digests[1]:
+        yield from _compare(left, left_root, right, right_root, "")
+
+
+def _compare(left, left_dir, right, right_dir, relpath):
+    left_files, left_dirs = left.directory_entries(left_dir)
+    right_files, right_dirs = right.directory_entries(right_dir)
+    for name in sorted(left_files.keys() | right_files.keys()):
+        if name not in right_files:
+            yield ONLY_LEFT, f"{relpath}{name}"
+        elif name not in left_files:
+            yield ONLY_RIGHT, f"{relpath}{name}"
+        elif left_files[name] is None or left_files[name] != right_files[name]:
+            yield CHANGED, f"{relpath}{name}"
+    for name in sorted(left_dirs.keys() | right_dirs.keys()):
+        if name not in right_dirs:
+            yield ONLY_LEFT, f"{relpath}{name}/"
+        elif name not in left_dirs:
+            yield ONLY_RIGHT, f"{relpath}{name}/"
+        elif left_dirs[name] is None or left_dirs[name] != right_dirs[name]:
+            yield from _compare(
+                left,
+                f"{left_dir}{name}/",
+                right,
+                f"{right_dir}{name}/",
+                f"{relpath}{name}/",
+            )
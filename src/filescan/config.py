@@ -0,0 +1,46 @@
+"""
+Settings taken from the environment.
+
+Nothing here runs at import time: the .env file is read the first
+time `load_environment` is called, by main() or by a Database that
+was not given an explicit URL.
+"""
+import functools
+import os
+
+DB_URL_ENV = "FILESCAN_DB_URL"  # Complete SQLAlchemy URL for the database
+DB_SERVER_ENV = "FILESCAN_DB_SERVER"  # PostgreSQL server, when only DBNAME is set
+DEFAULT_DB_SERVER = "postgresql+psycopg://localhost:5432"
+COLLECTOR_TOKEN_ENV = "FILESCAN_COLLECTOR_TOKEN"  # Shared by collector and workers
+STAT_CACHE_ENV = "FILESCAN_STAT_CACHE"  # Directory for --stat-cache indexes
+IO_CONCURRENCY_ENV = "FILESCAN_IO_CONCURRENCY"  # Default for --io-concurrency
+
+# Engine pool settings and the types of their values
+POOL_SETTINGS = {
+    "pool_size": int,
+    "max_overflow": int,
+    "pool_timeout": float,
+    "pool_recycle": int,
+    "pool_pre_ping": lambda value: value.lower() in ("1", "true", "yes"),
+}
+
+
+@functools.cache
+def load_environment():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+
+def db_server() -> str:
+    return os.environ.get(DB_SERVER_ENV, DEFAULT_DB_SERVER).rstrip("/")
+
+
+def engine_options() -> dict:
+    """Pool settings given as FILESCAN_DB_POOL_SIZE, FILESCAN_DB_MAX_OVERFLOW, ..."""
+    options = {}
+    for name, convert in POOL_SETTINGS.items():
+        value = os.environ.get(f"FILESCAN_DB_{name.upper()}")
+        if value is not None:
+            options[name] = convert(value)
+    return options
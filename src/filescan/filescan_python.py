@@ -1,3 +1,4 @@
+import io
 from tokenize import tokenize
 import token
 import keyword as kw
@@ -6,9 +7,10 @@ import keyword as kw
 EXTENSIONS = [".py", ".pyw"]
 
 
-def process(conn, loc):
+def process(conn, loc, content=None):
     """
-    Add the non-keyword tokens to the position index for this file.
+    Add the non-keyword tokens to the position index for this file,
+    returning the number of tokens added.
     Only called when no checksum previously existed for the file's
     current incarnation - otherwise we assume scanning took place
     when the original checksum was created.
@@ -17,17 +19,21 @@ def process(conn, loc):
         Maybe one solution is an explicit test for the existence of
         at least one TokenPos for a given checksum, but even this
         would cause repeated parsing of files containing no names.
+    `content` is the file's bytes, if the scanner has already read it.
     """
     filepath = f"{loc.dirpath}{loc.filename}"
     if any(filepath.endswith(ext) for ext in EXTENSIONS):
-        with open(filepath, "rb") as inf:
+        refs = []
+        inf = open(filepath, "rb") if content is None else io.BytesIO(content)
+        with inf:
             try:
                 for t in tokenize(inf.readline):
                     if t.type == token.NAME and not kw.iskeyword(t.string):
-                        conn.save_reference(
-                            loc.checksum, t.string, t.start[0], t.start[1]
-                        )
+                        refs.append((t.string, t.start[0], t.start[1]))
             except Exception as e:
                 print(
                     f"** {filepath}: {type(e)}\n   {e}"
                 )  # XXX: sensible handling of parse and other errors
+        conn.add_references_bulk(loc.checksum, refs)
+        return len(refs)
+    return 0
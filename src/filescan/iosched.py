@@ -0,0 +1,109 @@
+"""
+Reading files concurrently, at the pace of the device each is on.
+
+A spinning disk serves one reader best, while an SSD wants several
+requests in flight before it is busy, and a network filesystem sits
+somewhere between. A DeviceScheduler keeps a queue and a pool of
+reader threads per device (st_dev), sized from the kernel's view of
+the device: /sys/dev/block/MAJOR:MINOR/queue/rotational (or that of
+the disk a partition is on). Devices with no block queue (NFS, tmpfs,
+overlays and other anonymous devices) get a middling default. Limits
+can also be set for the devices holding given paths, as
+"/srv/archive=1,/scratch=16", or for every device, as a bare number.
+
+The scanner hands each directory's files to `map`, and scans
+directories (and roots) one after another, so there only the files of
+one directory are read at once. The async engine, which has several
+directories in flight, shares one scheduler among them, so the limits
+hold across directories, and devices, too.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+HDD_CONCURRENCY = 1
+SSD_CONCURRENCY = 8
+OTHER_CONCURRENCY = 4  # Network and virtual filesystems
+SYSFS = "/sys"
+
+
+def detect_concurrency(device: int, sysfs: str = SYSFS) -> int:
+    """Reads to keep in flight on `device`, from its rotational flag."""
+    major, minor = os.major(device), os.minor(device)
+    if major == 0:  # Anonymous: there's no block queue to look at
+        return OTHER_CONCURRENCY
+    block = f"{sysfs}/dev/block/{major}:{minor}"
+    for queue in (block, f"{block}/.."):  # A disk, or a partition of one
+        try:
+            with open(f"{queue}/queue/rotational") as f:
+                rotational = f.read().strip() == "1"
+        except OSError:
+            continue
+        return HDD_CONCURRENCY if rotational else SSD_CONCURRENCY
+    return OTHER_CONCURRENCY
+
+
+def parse_limits(text: str) -> dict[str | None, int]:
+    """
+    Limits from "PATH=N,..." (None for a bare "N", the default for
+    every device), raising ValueError for anything else, or a PATH
+    that doesn't exist.
+    """
+    limits = {}
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        path, _, n = item.rpartition("=")
+        if int(n) < 1:
+            raise ValueError(f"Concurrency must be at least 1: {item!r}")
+        if path and not os.path.exists(path):
+            raise ValueError(f"No such path: {path!r}")
+        limits[path or None] = int(n)
+    return limits
+
+
+class DeviceScheduler:
+    def __init__(self, limits: dict[str | None, int] | None = None, sysfs=SYSFS):
+        """`limits` as parse_limits gives them; other devices are detected."""
+        limits = dict(limits or {})
+        self.default = limits.pop(None, None)
+        self.limits = {os.stat(path).st_dev: n for path, n in limits.items()}
+        self.sysfs = sysfs
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def concurrency(self, device: int) -> int:
+        if device not in self.limits:
+            n = self.default or detect_concurrency(device, self.sysfs)
+            logger.info(
+                "Device %d:%d: %d concurrent reads",
+                os.major(device),
+                os.minor(device),
+                n,
+            )
+            self.limits[device] = n
+        return self.limits[device]
+
+    def _pool(self, device):
+        with self.lock:
+            if device not in self.pools:
+                self.pools[device] = ThreadPoolExecutor(
+                    max_workers=self.concurrency(device),
+                    thread_name_prefix=f"read-{os.major(device)}:{os.minor(device)}",
+                )
+            return self.pools[device]
+
+    def map(self, function, jobs) -> list:
+        """
+        function(*args) for each (device, *args) in `jobs`, in order,
+        running at most each device's limit of calls at once.
+        """
+        futures = [self._pool(device).submit(function, *args) for device, *args in jobs]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.shutdown()
+            self.pools.clear()
@@ -0,0 +1,334 @@
+"""
+A storage backend held entirely in process memory.
+
+Useful for dry runs and for timing the scanner without any database
+in the way. Given a path, the store loads its state from that file at
+startup and writes it back (atomically) when the outermost transaction
+commits, so successive runs can report what changed in between.
+Commits while a run is in progress (as --commit-every makes) are left
+to the first commit after it ends, as rewriting the whole store each
+time would cost time quadratic in its size.
+"""
+import os
+import pickle
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from filescan.backend import (
+    DirTotals,
+    FileEntry,
+    LocationRecord,
+    Reference,
+    directory_digest,
+    file_checksum,
+    files_digest,
+    parent_directory,
+)
+
+URL_SCHEME = "memory://"
+
+
+@dataclass
+class RunRecord:
+    id: int
+    when_run: datetime
+    rootdir: str
+    when_finished: datetime | None = None
+    files: int = 0
+    known: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    new_files: int = 0
+    deleted: int = 0
+    metrics: dict[str, float] = field(default_factory=dict)
+    hot_spots: list[tuple[str, str, float]] = field(default_factory=list)
+
+
+@dataclass
+class MemoryState:
+    locations: dict[tuple[str, str], LocationRecord] = field(default_factory=dict)
+    checksums: set[str] = field(default_factory=set)
+    tokens: dict[str, list[Reference]] = field(default_factory=dict)
+    runs: list[RunRecord] = field(default_factory=list)
+    archives: list[dict] = field(default_factory=list)
+    blocks: dict[str, bytes] = field(default_factory=dict)
+    # Scanned directory -> [totals of the files directly in it, seen]
+    directories: dict[str, list] = field(default_factory=dict)
+    directory_files: dict[str, str] = field(default_factory=dict)  # files_digest
+    scanned: dict[str, float] = field(default_factory=dict)  # Directory -> time
+    next_id: int = 1
+
+
+class MemoryDatabase:
+    class DoesNotExist(Exception):
+        ...
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dbname = path or ":memory:"
+        self.state = MemoryState()
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                self.state = pickle.load(f)
+            for name in (
+                "blocks",
+                "directories",
+                "directory_files",
+                "scanned",
+            ):  # Older pickles
+                vars(self.state).setdefault(name, {})
+            for run in self.state.runs:
+                vars(run).setdefault("hot_spots", [])
+        self._discard = False
+        self._running = set()  # Ids of the runs started and not yet ended
+
+    @classmethod
+    def from_url(cls, url: str):
+        """memory:// for a throwaway store, memory:///some/file to persist."""
+        return cls(path=url.removeprefix(URL_SCHEME) or None)
+
+    def _new_id(self):
+        id = self.state.next_id
+        self.state.next_id += 1
+        return id
+
+    def _under(self, prefix, subtree=True):
+        if not subtree:
+            return (
+                loc for loc in self.state.locations.values() if loc.dirpath == prefix
+            )
+        return (
+            loc
+            for loc in self.state.locations.values()
+            if loc.dirpath.startswith(prefix)
+        )
+
+    @contextmanager
+    def begin(self):
+        self._discard = False
+        yield self
+        if not self._discard:
+            self.commit()
+
+    def commit(self):
+        if self.path is None or self._running:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def rollback(self):
+        self._discard = True
+
+    def flush(self):
+        pass
+
+    def start_run(self, rootdir):
+        run = RunRecord(id=self._new_id(), when_run=datetime.now(), rootdir=rootdir)
+        self.state.runs.append(run)
+        self._running.add(run.id)
+        return run
+
+    def end_run(self, run, files, known, updated, unchanged, new_files, deleted):
+        run.files = files
+        run.known = known
+        run.updated = updated
+        run.unchanged = unchanged
+        run.new_files = new_files
+        run.deleted = deleted
+        run.when_finished = datetime.now()
+        self._running.discard(run.id)
+
+    def record_metrics(self, run, metrics):
+        run.metrics.update(metrics)
+
+    def record_hot_spots(self, run, hot_spots):
+        run.hot_spots.extend(hot_spots)
+
+    def clear_seen_bits(self, prefix, subtree=True):
+        for loc in self._under(prefix, subtree):
+            loc.seen = False
+        for dirpath, directory in self.state.directories.items():
+            if dirpath == prefix or subtree and dirpath.startswith(prefix):
+                directory[1] = False
+
+    def mark_subtree_seen(self, prefix):
+        for loc in self._under(prefix):
+            loc.seen = True
+        for dirpath, directory in self.state.directories.items():
+            if dirpath.startswith(prefix):
+                directory[1] = True
+
+    def register_hash(self, file_path):
+        hash = file_checksum(file_path)
+        if hash is not None:
+            self.state.checksums.add(hash)
+        return hash
+
+    def register_hashes(self, file_paths, throttle=None):
+        return self.register_digests(
+            [file_checksum(file_path, throttle) for file_path in file_paths]
+        )
+
+    def register_digests(self, digests):
+        self.state.checksums.update(filter(None, digests))
+        return list(digests)
+
+    def block_digests(self, checksum):
+        return self.state.blocks.get(checksum)
+
+    def save_block_digests(self, checksum, digests):
+        self.state.blocks[checksum] = digests
+
+    def location_for(self, dirpath, filename):
+        try:
+            return self.state.locations[dirpath, filename]
+        except KeyError:
+            raise self.DoesNotExist(f"{dirpath}{filename}")
+
+    def lookup_many(self, dirpath, filenames):
+        locations = self.state.locations
+        return {
+            name: locations[dirpath, name]
+            for name in filenames
+            if (dirpath, name) in locations
+        }
+
+    def upsert_locations(self, dirpath, entries):
+        result = []
+        for entry in entries:
+            entry = FileEntry(*entry)
+            loc = self.state.locations.get((dirpath, entry.filename))
+            if loc is None:
+                loc = LocationRecord(
+                    id=self._new_id(), dirpath=dirpath, seen=True, **entry._asdict()
+                )
+                self.state.locations[dirpath, entry.filename] = loc
+            else:
+                loc.modified = entry.modified
+                loc.checksum = entry.checksum
+                loc.filesize = entry.filesize
+                loc.device, loc.inode = entry.device, entry.inode
+                loc.seen = True
+            result.append(loc)
+        return result
+
+    def mark_seen(self, locations):
+        for loc in locations:
+            loc.seen = True
+
+    def save_reference(self, checksum, name, line, pos, ttype=1):
+        self.add_references_bulk(checksum, [(name, line, pos, ttype)])
+
+    def add_references_bulk(self, checksum, refs):
+        self.state.tokens.setdefault(checksum, []).extend(
+            Reference(*ref) for ref in refs
+        )
+
+    def archive_record(self, reason, rectype, record, runlog):
+        self.state.archives.append(
+            dict(
+                reason=reason, rectype=rectype, data=record.to_dict(), runlog=runlog.id
+            )
+        )
+
+    def all_file_count(self, prefix):
+        return sum(1 for loc in self._under(prefix))
+
+    def total_size(self, prefix):
+        sizes = {}
+        for loc in self._under(prefix):
+            key = loc.id if loc.inode is None else (loc.device, loc.inode)
+            sizes[key] = loc.filesize
+        return sum(sizes.values())
+
+    def unseen_location_count(self, prefix):
+        return sum(1 for loc in self._under(prefix) if not loc.seen)
+
+    def mark_deleted(self, prefix, limit=None, subtree=True):
+        deleted = [loc for loc in self._under(prefix, subtree) if not loc.seen][:limit]
+        for loc in deleted:
+            del self.state.locations[loc.dirpath, loc.filename]
+        return deleted
+
+    # Subtree totals are summed on demand: there are far fewer
+    # directories than files, and nothing here is slow to read
+
+    def save_directory_totals(self, dirpath, totals, checksums=()):
+        self.state.directories[dirpath] = [DirTotals(*totals), True]
+        self.state.directory_files[dirpath] = files_digest(checksums)
+        self.state.scanned[dirpath] = time.time()
+
+    def remove_unseen_directories(self, prefix):
+        directories = self.state.directories
+        removed = [
+            dirpath
+            for dirpath, (totals, seen) in directories.items()
+            if dirpath.startswith(prefix) and not seen
+        ]
+        for dirpath in removed:
+            del directories[dirpath]
+            self.state.directory_files.pop(dirpath, None)
+            self.state.scanned.pop(dirpath, None)
+        return len(removed)
+
+    def scanned_directories(self, prefix):
+        return {
+            dirpath: self.state.scanned.get(dirpath)
+            for dirpath in self.state.directories
+            if dirpath.startswith(prefix)
+        }
+
+    def refresh_directory_digests(self):
+        pass  # Digests are computed when asked for
+
+    def _subdirectories(self, dirpath):
+        return {
+            path[len(dirpath) : -1]: path
+            for path in self.state.directories
+            if parent_directory(path) == dirpath
+        }
+
+    def directory_digest(self, dirpath):
+        if dirpath not in self.state.directories:
+            return None
+        subdirs = self._subdirectories(dirpath).items()
+        return directory_digest(
+            self.state.directory_files.get(dirpath),
+            ((name, self.directory_digest(path)) for name, path in subdirs),
+        )
+
+    def directory_entries(self, dirpath):
+        files = {
+            loc.filename: loc.checksum
+            for loc in self._under(dirpath)
+            if loc.dirpath == dirpath
+        }
+        subdirs = self._subdirectories(dirpath).items()
+        return files, {name: self.directory_digest(path) for name, path in subdirs}
+
+    def directory_totals(self, dirpath):
+        under = [
+            totals
+            for path, (totals, seen) in self.state.directories.items()
+            if path.startswith(dirpath)
+        ]
+        if not under:
+            return None
+        newest = [totals.newest for totals in under if totals.newest is not None]
+        return DirTotals(
+            sum(totals.files for totals in under),
+            sum(totals.size for totals in under),
+            max(newest, default=None),
+        )
+
+    def child_directories(self, dirpath):
+        children = {
+            path[: path.index("/", len(dirpath)) + 1]
+            for path in self.state.directories
+            if path.startswith(dirpath) and path != dirpath
+        }
+        return {child: self.directory_totals(child) for child in sorted(children)}
@@ -0,0 +1,104 @@
+"""
+Per-run timing and volume counters for scan_directory.
+
+Time is accumulated per named phase ("walk", "stat", "lookup",
+"hash", "write", "flush", "archive", "commit", "delete", "digest" and
+"plugin:<name>" for each plugin), and counters such as bytes hashed and tokens
+emitted are kept alongside. At the end of a run they are stored
+against the RunLog and printed with the summary.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+
+PHASES = (
+    "schedule",
+    "walk",
+    "stat",
+    "lookup",
+    "hash",
+    "write",
+    "flush",
+    "archive",
+    "commit",
+    "delete",
+    "digest",
+)
+COUNTERS = (
+    "bytes_hashed",
+    "files_read_once",
+    "tokens",
+    "links_reused",
+    "incremental_hashes",
+)
+
+
+@dataclass
+class ScanCounts:
+    """The file counts that scan_directory stores on RunLog."""
+
+    files: int = 0
+    known: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    new_files: int = 0
+    deleted: int = 0
+
+
+class RunMetrics:
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.started = perf_counter()
+
+    @contextmanager
+    def timer(self, phase):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[phase] += perf_counter() - started
+
+    def timed(self, phase, iterable):
+        """Iterate over `iterable`, charging the time taken to `phase`."""
+        iterator = iter(iterable)
+        while True:
+            started = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.times[phase] += perf_counter() - started
+            yield item
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self.started
+
+    def as_dict(self):
+        """Flat name -> value mapping, as stored against the RunLog."""
+        result = {f"time_{phase}": seconds for phase, seconds in self.times.items()}
+        result.update(self.counts)
+        return result
+
+    def summary(self):
+        phases = [p for p in PHASES if p in self.times]
+        phases += sorted(p for p in self.times if p not in PHASES)
+        labels = {
+            # Plugin phases are shown under their module name, unchanged
+            name: (name if ":" in name else name.replace("_", " ").capitalize()) + ":"
+            for name in [*COUNTERS, *phases]
+        }
+        width = max(len(label) for label in labels.values()) + 1
+        lines = [
+            f"{labels[name]:{width}s}{self.counts[name]:15,d}" for name in COUNTERS
+        ]
+        lines += [
+            f"{labels[phase]:{width}s}{self.times[phase]:14.2f}s" for phase in phases
+        ]
+        return "\n".join(lines)
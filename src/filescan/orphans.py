@@ -0,0 +1,122 @@
+"""
+Garbage collection of checksums no location uses any more.
+
+When a file changes or goes, its location moves to another Checksum
+or is deleted, but the old Checksum row stays, with its TokenPos and
+BlockDigests rows. `collect` clears them out in two phases, each a
+series of small transactions so that scans can run alongside:
+
+- mark: walk the checksums in batches of ids, stamping those that no
+  location uses with the time, and clearing the stamp from any that
+  have been used again since;
+- sweep: delete the checksums stamped longer ago than a grace period,
+  and still unused, with their tokens and block digests.
+
+The grace period is for scans running meanwhile: a scanner keeps the
+ids of the checksums it has seen recently and may point a new
+location at one of them at any time. It should be longer than the
+longest scan. If a scan does so mid-sweep anyway, the foreign key
+check fails the batch, which is rolled back and left for next time.
+"""
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.exc import IntegrityError
+
+from filescan.sqlalchemy_store import BlockDigests, Checksum, Location, TokenPos
+
+BATCH_SIZE = 500
+GRACE = 24 * 60 * 60
+NO_SYNC = {"synchronize_session": False}
+
+
+@dataclass
+class GCCounts:
+    checked: int = 0
+    marked: int = 0
+    unmarked: int = 0  # Used again since they were marked
+    checksums: int = 0  # Deleted
+    tokens: int = 0
+    conflicts: int = 0  # Batches rolled back because a scan used a checksum
+
+
+def _used():
+    return exists().where(Location.checksum_id == Checksum.id)
+
+
+def mark(db, counts: GCCounts, now: float, batch_size=BATCH_SIZE, pause=0.0):
+    after = 0
+    while True:
+        q = (
+            select(Checksum.id)
+            .where(Checksum.id > after)
+            .order_by(Checksum.id)
+            .limit(batch_size)
+        )
+        ids = db.session.scalars(q).all()
+        if not ids:
+            return
+        after = ids[-1]
+        counts.checked += len(ids)
+        batch = Checksum.id.in_(ids)
+        q = update(Checksum).where(batch, Checksum.orphaned.is_(None), ~_used())
+        counts.marked += db.session.execute(
+            q.values(orphaned=now), execution_options=NO_SYNC
+        ).rowcount
+        q = update(Checksum).where(batch, Checksum.orphaned.is_not(None), _used())
+        counts.unmarked += db.session.execute(
+            q.values(orphaned=None), execution_options=NO_SYNC
+        ).rowcount
+        db.commit()
+        time.sleep(pause)
+
+
+def sweep(db, counts: GCCounts, cutoff: float, batch_size=BATCH_SIZE, pause=0.0):
+    while True:
+        q = (
+            select(Checksum.id)
+            .where(Checksum.orphaned <= cutoff, ~_used())
+            .order_by(Checksum.id)
+            .limit(batch_size)
+        )
+        ids = db.session.scalars(q).all()
+        if not ids:
+            return
+        try:
+            tokens = db.session.execute(
+                delete(TokenPos).where(TokenPos.checksum_id.in_(ids)),
+                execution_options=NO_SYNC,
+            ).rowcount
+            db.session.execute(
+                delete(BlockDigests).where(BlockDigests.checksum_id.in_(ids)),
+                execution_options=NO_SYNC,
+            )
+            checksums = db.session.execute(
+                delete(Checksum).where(Checksum.id.in_(ids)),
+                execution_options=NO_SYNC,
+            ).rowcount
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            counts.conflicts += 1
+            return
+        counts.tokens += tokens
+        counts.checksums += checksums
+        time.sleep(pause)
+
+
+def collect(
+    db, grace=GRACE, batch_size=BATCH_SIZE, pause=0.0, clock=time.time
+) -> GCCounts:
+    """
+    Mark the checksums no location uses, and delete those marked
+    more than `grace` seconds ago, sleeping `pause` seconds between
+    batches.
+    """
+    counts = GCCounts()
+    now = clock()
+    mark(db, counts, now, batch_size, pause)
+    sweep(db, counts, now - grace, batch_size, pause)
+    db.commit()
+    return counts
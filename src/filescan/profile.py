@@ -0,0 +1,97 @@
+"""
+Where a slow scan spends its time.
+
+RunMetrics says how long each phase took in total; HotSpots says
+which directories and files took it. It keeps only the N slowest of
+each kind, in a min-heap, so a profiled scan of millions of files
+costs little more memory than an ordinary one:
+
+- "walk": directories, by the time taken to list them;
+- "directory": directories, by the time taken to scan their files;
+- "hash": files, by the time taken to read and hash them;
+- "plugin:<module>": files, by the time a plugin spent on them.
+
+At the end of the run the hot spots are stored against its RunLog
+and printed, slowest first.
+"""
+import heapq
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+from filescan.backend import file_checksum, read_once
+
+TOP_N = 10
+TITLES = {
+    "walk": "Slowest directories to list",
+    "directory": "Slowest directories to scan",
+    "hash": "Slowest files to hash",
+}
+
+
+class HotSpots:
+    def __init__(self, n: int = TOP_N):
+        self.n = n
+        self.heaps = defaultdict(list)  # Kind -> [(seconds, path)], fastest first
+        self.lock = threading.Lock()  # Files are hashed in several threads
+
+    def clear(self):
+        self.heaps.clear()
+
+    def add(self, kind: str, path: str, seconds: float):
+        with self.lock:
+            heap = self.heaps[kind]
+            if len(heap) < self.n:
+                heapq.heappush(heap, (seconds, path))
+            elif seconds > heap[0][0]:
+                heapq.heapreplace(heap, (seconds, path))
+
+    @contextmanager
+    def timer(self, kind: str, path: str):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(kind, path, perf_counter() - started)
+
+    def timed_walk(self, walk):
+        """Iterate over an os.walk-style `walk`, timing each directory's listing."""
+        iterator = iter(walk)
+        while True:
+            started = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add("walk", item[0], perf_counter() - started)
+            yield item
+
+    def file_checksum(self, path: str, throttle=None) -> str | None:
+        """filescan.backend.file_checksum, timed."""
+        with self.timer("hash", path):
+            return file_checksum(path, throttle)
+
+    def read_once(self, path: str, throttle=None) -> tuple[str | None, bytes | None]:
+        """filescan.backend.read_once, timed."""
+        with self.timer("hash", path):
+            return read_once(path, throttle)
+
+    def rows(self) -> list[tuple[str, str, float]]:
+        """(kind, path, seconds) for each hot spot, slowest first within each kind."""
+        return [
+            (kind, path, seconds)
+            for kind, heap in self.heaps.items()
+            for seconds, path in sorted(heap, reverse=True)
+        ]
+
+    def report(self) -> str:
+        lines = []
+        for kind, heap in self.heaps.items():
+            title = TITLES.get(kind) or f"Slowest files in {kind.partition(':')[2]}"
+            lines.append(f"{title}:")
+            lines.extend(
+                f"{seconds:10.3f}s  {path}"
+                for seconds, path in sorted(heap, reverse=True)
+            )
+        return "\n".join(lines)
@@ -0,0 +1,176 @@
+"""
+Live progress reporting for long scans.
+
+A Progress object is handed to scan_directory, which calls `update`
+as it goes. At most once per interval it prints a one-line status
+(counts, rates, ETA and the current directory) and atomically rewrites
+a Prometheus textfile-collector file, so that node_exporter can alert
+on scans that stall or slow down. The current directory stays out of
+the textfile: as a label it would make a new series for every one.
+"""
+import os
+import sys
+import time
+from datetime import timedelta
+from time import perf_counter
+
+from filescan.metrics import RunMetrics, ScanCounts
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Progress:
+    def __init__(self, interval=10.0, textfile=None, stream=sys.stderr):
+        self.interval = interval
+        self.textfile = textfile
+        self.stream = stream
+        self.root = None
+        self.next_report = 0.0
+
+    def start(self, root: str, metrics: RunMetrics, expected_files: int):
+        """Begin a scan of `root`, which held `expected_files` at the last scan."""
+        self.root = root
+        self.metrics = metrics
+        self.expected_files = expected_files
+        self.started = self.last_time = perf_counter()
+        self.last_files = self.last_bytes = 0
+        self.files_rate = self.bytes_rate = 0.0
+        self.next_report = self.started + self.interval
+
+    def update(self, dirpath: str, counts: ScanCounts, pending: int = 0):
+        """
+        Note the scan's position; `pending` is the number of files in the
+        current directory still waiting to be processed.
+        """
+        now = perf_counter()
+        if now >= self.next_report:
+            self.report(now, dirpath, counts, pending)
+
+    def finish(self, counts: ScanCounts):
+        self.report(perf_counter(), self.root, counts, 0, running=False)
+
+    def report(self, now, dirpath, counts, pending, running=True):
+        elapsed = max(now - self.last_time, 1e-9)
+        bytes_hashed = self.metrics.counts["bytes_hashed"]
+        self.files_rate = (counts.files - self.last_files) / elapsed
+        self.bytes_rate = (bytes_hashed - self.last_bytes) / elapsed
+        self.last_time, self.last_files, self.last_bytes = (
+            now,
+            counts.files,
+            bytes_hashed,
+        )
+        self.next_report = now + self.interval
+        remaining = max(self.expected_files - counts.files, 0)
+        eta = remaining / self.files_rate if self.files_rate else None
+        if self.stream is not None:
+            self.stream.write(self.status_line(dirpath, counts, eta, running) + "\n")
+            self.stream.flush()
+        if self.textfile is not None:
+            self.write_textfile(counts, pending, eta, running)
+
+    def status_line(self, dirpath, counts, eta, running):
+        if self.expected_files:
+            done = f"{counts.files:,d}/{self.expected_files:,d} files"
+        else:
+            done = f"{counts.files:,d} files"
+        eta = "?" if eta is None else str(timedelta(seconds=round(eta)))
+        return (
+            f"[filescan] {done} ({counts.new_files:,d} new, {counts.updated:,d}"
+            f" updated) {self.files_rate:,.0f} files/s"
+            f" {self.bytes_rate / 1e6:,.1f} MB/s"
+            + (f" ETA {eta} {dirpath}" if running else " done")
+        )
+
+    def write_textfile(self, counts, pending, eta, running):
+        root = f'root="{_escape(self.root)}"'
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP filescan_{name} {help}")
+            lines.append(f"# TYPE filescan_{name} {kind}")
+            for labels, value in samples:
+                labels = ",".join([root, *labels])
+                lines.append(f"filescan_{name}{{{labels}}} {value}")
+
+        metric(
+            "running", "gauge", "1 while a scan is in progress.", [((), int(running))]
+        )
+        metric(
+            "last_progress_timestamp_seconds",
+            "gauge",
+            "When the scan last reported progress.",
+            [((), f"{time.time():.3f}")],
+        )
+        metric(
+            "files",
+            "gauge",
+            "Files seen by the current scan, by outcome.",
+            [
+                ((f'state="{state}"',), getattr(counts, field))
+                for state, field in (
+                    ("seen", "files"),
+                    ("known", "known"),
+                    ("updated", "updated"),
+                    ("unchanged", "unchanged"),
+                    ("new", "new_files"),
+                )
+            ],
+        )
+        metric(
+            "expected_files",
+            "gauge",
+            "Files under the root at the previous scan.",
+            [((), self.expected_files)],
+        )
+        metric(
+            "bytes_hashed_total",
+            "counter",
+            "Bytes hashed by the current scan.",
+            [((), self.metrics.counts["bytes_hashed"])],
+        )
+        metric(
+            "tokens_total",
+            "counter",
+            "Tokens indexed by the current scan.",
+            [((), self.metrics.counts["tokens"])],
+        )
+        metric(
+            "phase_seconds_total",
+            "counter",
+            "Time spent in each phase of the current scan.",
+            [
+                ((f'phase="{_escape(phase)}"',), f"{seconds:.3f}")
+                for phase, seconds in self.metrics.times.items()
+            ],
+        )
+        metric(
+            "files_per_second",
+            "gauge",
+            "Files processed per second over the last interval.",
+            [((), f"{self.files_rate:.1f}")],
+        )
+        metric(
+            "bytes_hashed_per_second",
+            "gauge",
+            "Bytes hashed per second over the last interval.",
+            [((), f"{self.bytes_rate:.0f}")],
+        )
+        metric(
+            "queue_depth",
+            "gauge",
+            "Files waiting to be processed.",
+            [(('queue="directory"',), pending)],
+        )
+        if eta is not None and running:
+            metric(
+                "eta_seconds",
+                "gauge",
+                "Estimated time to finish, from the previous file count.",
+                [((), f"{eta:.0f}")],
+            )
+        tmp_path = f"{self.textfile}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.textfile)
@@ -0,0 +1,400 @@
+"""
+Scan workers on many hosts feeding one collector, which alone talks
+to the database.
+
+A worker needs only the filesystem and a socket. For each directory
+it is asked to scan, it connects to the collector and is sent what
+the index already holds under that root, which it loads into a
+memory store. It then runs the ordinary scan_directory against that
+store, so only new and changed files are hashed (and passed to the
+plugins), and the store forwards each write to the collector as a
+compact change record, batched into frames. The collector creates
+the RunLog, applies the records through its Database (with the same
+bulk upserts as a local scan) and, when the worker reports the run
+finished, deletes and archives what wasn't seen and commits. When
+a large file has grown, the worker asks the collector for its stored
+block digests, so that it needn't be rehashed in full.
+
+Each frame is a 4-byte length followed by zlib-compressed JSON, so
+nothing a worker sends can run code in the collector. Frames, before
+and after decompression, are limited to MAX_FRAME bytes, so that no
+peer can make the other allocate more. A shared token keeps strangers
+out; use an SSH tunnel or similar to encrypt.
+"""
+import hmac
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import zlib
+from contextlib import nullcontext
+
+from filescan import blocks, delete_unseen, open_database, scan_directory
+from filescan.backend import BATCH_SIZE, DirTotals, FileEntry, Reference
+from filescan.memory_store import MemoryDatabase
+from filescan.metrics import RunMetrics, ScanCounts
+
+PROTOCOL_VERSION = 2
+DEFAULT_PORT = 8765
+RECORDS_PER_FRAME = 5000  # Files, references or names, roughly
+FRAME = struct.Struct("!I")
+MAX_FRAME = 256 * 1024 * 1024  # Bytes, compressed or not
+
+logger = logging.getLogger(__name__)
+
+
+class ProtocolError(Exception):
+    ...
+
+
+class Channel:
+    """Length-prefixed, compressed JSON messages over a socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def send(self, message):
+        data = json.dumps(message, separators=(",", ":")).encode()
+        if len(data) > MAX_FRAME:
+            raise ProtocolError(f"Message of {len(data):,d} bytes is over the limit")
+        data = zlib.compress(data)
+        self.sock.sendall(FRAME.pack(len(data)) + data)
+
+    def _read(self, size):
+        data = self.reader.read(size)
+        if len(data) != size:
+            raise ConnectionError("Connection closed mid-conversation")
+        return data
+
+    def receive(self):
+        (length,) = FRAME.unpack(self._read(FRAME.size))
+        if length > MAX_FRAME:
+            raise ProtocolError(f"Frame of {length:,d} bytes is over the limit")
+        inflater = zlib.decompressobj()
+        try:
+            data = inflater.decompress(self._read(length), MAX_FRAME)
+        except zlib.error as e:
+            raise ProtocolError(f"Bad frame: {e}")
+        if inflater.unconsumed_tail:
+            raise ProtocolError("Frame decompresses to over the limit")
+        if not inflater.eof:
+            raise ProtocolError("Truncated frame")
+        return json.loads(data)
+
+    def expect(self, kind):
+        message = self.receive()
+        if message[0] == "error":
+            raise ProtocolError(message[1])
+        if message[0] != kind:
+            raise ProtocolError(f"Expected {kind!r}, got {message[0]!r}")
+        return message[1:]
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    """HOST:PORT, HOST or :PORT as a (host, port) pair."""
+    host, _, port = address.rpartition(":") if ":" in address else (address, "", "")
+    return host or "127.0.0.1", int(port or DEFAULT_PORT)
+
+
+# Worker
+
+
+class WorkerStore(MemoryDatabase):
+    """
+    A memory store holding the collector's view of one tree, which
+    forwards the scan's writes to the collector. Checksum handles are
+    the digests themselves, as in any memory store.
+    """
+
+    def __init__(self, channel):
+        super().__init__()
+        self.channel = channel
+        self.records = []
+        self.pending = 0
+
+    def load_known(self):
+        """Take in the collector's locations, up to its "ready" message."""
+        while (message := self.channel.receive())[0] == "known":
+            for dirpath, filename, modified, filesize, device, inode, cs in message[1]:
+                super().upsert_locations(
+                    dirpath,
+                    [FileEntry(filename, modified, cs, filesize, device, inode)],
+                )
+        if message[0] != "ready":
+            raise ProtocolError(message[1] if message[0] == "error" else message[0])
+        return message[1]
+
+    def _forward(self, record, size=1):
+        self.records.append(record)
+        self.pending += size
+        if self.pending >= RECORDS_PER_FRAME:
+            self.send_records()
+
+    def send_records(self):
+        if self.records:
+            self.channel.send(["batch", self.records])
+            self.records, self.pending = [], 0
+
+    def commit(self):
+        self.send_records()
+
+    def upsert_locations(self, dirpath, entries):
+        entries = [FileEntry(*entry) for entry in entries]
+        known = self.state.locations
+        self._forward(
+            [
+                "upsert",
+                dirpath,
+                [
+                    [
+                        *entry,
+                        "UPDATED" if (dirpath, entry.filename) in known else "CREATED",
+                    ]
+                    for entry in entries
+                ],
+            ],
+            len(entries),
+        )
+        return super().upsert_locations(dirpath, entries)
+
+    def mark_seen(self, locations):
+        locations = list(locations)
+        if locations:
+            names = [loc.filename for loc in locations]
+            self._forward(["seen", locations[0].dirpath, names], len(names))
+        super().mark_seen(locations)
+
+    def add_references_bulk(self, checksum, refs):
+        refs = [list(Reference(*ref)) for ref in refs]
+        if refs:  # Not kept here: the collector has them
+            self._forward(["refs", checksum, refs], len(refs))
+
+    def block_digests(self, checksum):
+        self.send_records()  # They may have been saved earlier in the run
+        self.channel.send(["block_digests", checksum])
+        (digests,) = self.channel.expect("block_digests")
+        return None if digests is None else bytes.fromhex(digests)
+
+    def save_block_digests(self, checksum, digests):
+        self._forward(["blocks", checksum, digests.hex()])
+
+    def save_directory_totals(self, dirpath, totals, checksums=()):
+        checksums = [list(pair) for pair in checksums]
+        self._forward(["dir", dirpath, list(totals), checksums], len(checksums))
+
+    def archive_record(self, reason, rectype, record, runlog):
+        pass  # The collector archives what it applies
+
+
+def run_worker(
+    address: tuple[str, int],
+    dirs,
+    token: str = "",
+    metrics_factory=RunMetrics,
+    throttle=None,
+) -> list[int]:
+    """
+    Scan each of `dirs` on behalf of the collector at `address`,
+    returning the ids of the RunLog rows it created.
+    """
+    run_ids = []
+    for base_dir in dirs:
+        base_dir = os.path.abspath(base_dir).rstrip("/") + "/"
+        with socket.create_connection(address) as sock:
+            channel = Channel(sock)
+            hello = dict(
+                version=PROTOCOL_VERSION,
+                token=token,
+                host=socket.gethostname(),
+                root=base_dir,
+            )
+            channel.send(["hello", hello])
+            store = WorkerStore(channel)
+            run_ids.append(store.load_known())
+            metrics = metrics_factory()
+            scan_directory(base_dir, store, metrics, throttle=throttle)
+            store.send_records()
+            run = store.state.runs[-1]
+            counts = {name: getattr(run, name) for name in vars(ScanCounts())}
+            channel.send(["end", counts, metrics.as_dict()])
+            channel.expect("done")
+    return run_ids
+
+
+# Collector
+
+
+class Collector(socketserver.ThreadingTCPServer):
+    """
+    Applies workers' change records to the database at `url`, a run
+    per connection. SQLite allows one writer, so there runs take
+    turns; on PostgreSQL they proceed together.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, url=None, token="", commit_every=None):
+        self.url = url
+        self.token = token
+        self.commit_every = commit_every
+        probe = self.open_database()  # Fail now, not on the first worker
+        if not hasattr(probe, "session"):
+            raise ValueError("The collector needs an SQLAlchemy database")
+        self.lock = threading.Lock() if probe.is_sqlite else nullcontext()
+        probe.engine.dispose()
+        super().__init__(address, CollectorHandler)
+
+    def open_database(self):
+        return open_database(self.url)
+
+
+class CollectorHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        channel = Channel(self.request)
+        server = self.server
+        try:
+            (hello,) = channel.expect("hello")
+            if hello.get("version") != PROTOCOL_VERSION:
+                raise ProtocolError(f"Protocol version {hello.get('version')}")
+            if not hmac.compare_digest(hello.get("token", ""), server.token):
+                raise ProtocolError("Bad token")
+            root = hello["root"]
+            with server.lock:
+                db = server.open_database()
+                try:
+                    with db.begin():
+                        RunApplier(db, root, channel, server.commit_every).run()
+                finally:
+                    db.engine.dispose()
+            channel.send(["done"])  # Only once it's committed
+            logger.info("Run for %s:%s complete", hello.get("host"), root)
+        except (ProtocolError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Rejected %s: %s", self.client_address, e)
+            channel.send(["error", str(e)])
+        except ConnectionError as e:
+            logger.warning("Lost %s: %s", self.client_address, e)
+
+
+class RunApplier:
+    """Applies one worker's run to a Database."""
+
+    def __init__(self, db, root, channel, commit_every=None):
+        self.db = db
+        self.root = root
+        self.channel = channel
+        self.commit_every = commit_every
+
+    def send_known(self):
+        from sqlalchemy import select
+
+        from filescan.sqlalchemy_store import Checksum, Location
+
+        q = (
+            select(
+                Location.dirpath,
+                Location.filename,
+                Location.modified,
+                Location.filesize,
+                Location.device,
+                Location.inode,
+                Checksum.checksum,
+            )
+            .outerjoin(Location.checksum)
+            .where(Location.dirpath.like(f"{self.root}%"))
+        )
+        result = self.db.session.execute(q.execution_options(yield_per=BATCH_SIZE))
+        for rows in result.partitions():
+            self.channel.send(["known", [list(row) for row in rows]])
+
+    def run(self):
+        db = self.db
+        if not self.root.startswith("/") or not self.root.endswith("/"):
+            raise ProtocolError(f"Root {self.root!r} is not an absolute directory")
+        db.clear_seen_bits(self.root)
+        self.runlog = db.start_run(self.root)
+        db.flush()
+        self.send_known()
+        self.channel.send(["ready", self.runlog.id])
+        batches = 0
+        while (message := self.channel.receive())[0] in ("batch", "block_digests"):
+            if message[0] == "block_digests":
+                self.send_block_digests(message[1])
+                continue
+            for kind, *record in message[1]:
+                if (apply := getattr(self, f"apply_{kind}", None)) is None:
+                    raise ProtocolError(f"Unknown record {kind!r}")
+                apply(*record)
+            db.flush()
+            batches += 1
+            if self.commit_every and batches % self.commit_every == 0:
+                db.commit()
+        if message[0] != "end":
+            raise ProtocolError(f"Unexpected {message[0]!r}")
+        self.finish(*message[1:])
+
+    def send_block_digests(self, digest):
+        from sqlalchemy import select
+
+        from filescan.sqlalchemy_store import BlockDigests, Checksum
+
+        q = (
+            select(BlockDigests.digests)
+            .join(Checksum, BlockDigests.checksum_id == Checksum.id)
+            .where(
+                Checksum.checksum == digest,
+                BlockDigests.block_size == blocks.BLOCK_SIZE,
+            )
+        )
+        digests = self.db.session.scalar(q)
+        self.channel.send(["block_digests", None if digests is None else digests.hex()])
+
+    def checksums(self, digests):
+        return dict(zip(digests, self.db.register_digests(digests)))
+
+    def apply_upsert(self, dirpath, entries):
+        db = self.db
+        handles = self.checksums(list({entry[2] for entry in entries}))
+        locs = db.upsert_locations(
+            dirpath,
+            [
+                FileEntry(name, modified, handles[cs], size, device, inode)
+                for name, modified, cs, size, device, inode, reason in entries
+            ],
+        )
+        db.flush()
+        for loc, entry in zip(locs, entries):
+            db.archive_record(
+                reason=entry[-1], rectype="location", record=loc, runlog=self.runlog
+            )
+
+    def apply_seen(self, dirpath, filenames):
+        self.db.mark_seen(self.db.lookup_many(dirpath, filenames).values())
+
+    def apply_refs(self, digest, refs):
+        (cs,) = self.db.register_digests([digest])
+        self.db.add_references_bulk(cs, refs)
+
+    def apply_blocks(self, digest, digests):
+        (cs,) = self.db.register_digests([digest])
+        self.db.save_block_digests(cs, bytes.fromhex(digests))
+
+    def apply_dir(self, dirpath, totals, checksums):
+        handles = self.checksums(list({cs for name, cs in checksums}))
+        self.db.save_directory_totals(
+            dirpath,
+            DirTotals(*totals),
+            [(name, handles[cs]) for name, cs in checksums],
+        )
+
+    def finish(self, counts, metrics):
+        db = self.db
+        delete_unseen(db, self.root, self.runlog)
+        db.remove_unseen_directories(self.root)
+        db.refresh_directory_digests()
+        db.end_run(self.runlog, **ScanCounts(**counts).__dict__)
+        db.record_metrics(self.runlog, metrics)
@@ -0,0 +1,272 @@
+"""
+Columnar snapshots of the index, for analysis and for fast bulk loads.
+
+A snapshot holds the checksum, location, tokenpos and blockdigests
+tables, optionally restricted to the locations under a prefix and the
+content they refer to. It is written as a stream of blocks of up to
+ROWS_PER_BLOCK rows of one table, each column of a block stored
+separately and zlib-compressed:
+
+  - integers and floats as little-endian 64-bit arrays, with a
+    validity byte per row where the column may be NULL;
+  - paths, file names and token names dictionary-encoded, each block
+    carrying only the strings its column hasn't used before followed
+    by a 32-bit code per row;
+  - other strings and bytes as 32-bit lengths followed by the data.
+
+Checksums come first, so that an import can map their ids before it
+meets the rows that refer to them. Export and import both stream
+through Core statements rather than ORM objects, so neither holds
+more than a block of rows in memory, bar the map of checksum ids.
+"""
+import json
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime
+
+from sqlalchemy import insert, select
+
+from filescan.sqlalchemy_store import Checksum, Location, Model, RunLog
+
+MAGIC = b"FILESCAN SNAPSHOT\n"
+VERSION = 1
+ROWS_PER_BLOCK = 50_000
+COMPRESSION_LEVEL = 6
+END = 0xFF  # Table number marking the end of the snapshot
+
+# Columns of each table, in the order the tables are written
+TABLES = {
+    "checksum": (("id", "int"), ("checksum", "str")),
+    "location": (
+        ("dirpath", "dict"),
+        ("filename", "dict"),
+        ("modified", "float"),
+        ("seen", "bool"),
+        ("filesize", "int"),
+        ("device", "int?"),
+        ("inode", "int?"),
+        ("checksum_id", "int?"),
+    ),
+    "tokenpos": (
+        ("checksum_id", "int"),
+        ("ttype", "int"),
+        ("name", "dict"),
+        ("line", "int"),
+        ("pos", "int"),
+    ),
+    "blockdigests": (
+        ("checksum_id", "int"),
+        ("block_size", "int"),
+        ("digests", "bytes"),
+    ),
+}
+TABLE_NAMES = list(TABLES)
+
+BLOCK_HEADER = struct.Struct("<BI")  # Table number, rows
+LENGTH = struct.Struct("<I")
+
+
+def _pack(typecode, values) -> bytes:
+    a = array(typecode, values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack(typecode, data: bytes) -> array:
+    a = array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _pack_strings(values) -> bytes:
+    data = [
+        v if isinstance(v, bytes) else v.encode("utf-8", "surrogateescape")
+        for v in values
+    ]
+    return LENGTH.pack(len(data)) + _pack("I", map(len, data)) + b"".join(data)
+
+
+def _unpack_strings(data: bytes, decode=True) -> list:
+    (n,) = LENGTH.unpack_from(data)
+    lengths = _unpack("I", data[LENGTH.size : LENGTH.size + 4 * n])
+    values, offset = [], LENGTH.size + 4 * n
+    for length in lengths:
+        value = data[offset : offset + length]
+        values.append(value.decode("utf-8", "surrogateescape") if decode else value)
+        offset += length
+    return values
+
+
+class SnapshotWriter:
+    """Writes a snapshot to a binary file, one block of rows at a time."""
+
+    def __init__(self, f, **header):
+        self.f = f
+        self.dictionaries = {}  # (table, column) -> {string: code}
+        self.rows = dict.fromkeys(TABLES, 0)
+        header = dict(version=VERSION, created=datetime.now().isoformat(), **header)
+        f.write(MAGIC)
+        self._write(json.dumps(header).encode())
+
+    def _write(self, payload: bytes):
+        self.f.write(LENGTH.pack(len(payload)))
+        self.f.write(payload)
+
+    def _encode(self, table, name, kind, values) -> bytes:
+        if kind == "int":
+            return _pack("q", values)
+        if kind == "int?":
+            valid = bytes(v is not None for v in values)
+            return valid + _pack("q", (0 if v is None else v for v in values))
+        if kind == "float":
+            return _pack("d", values)
+        if kind == "bool":
+            return bytes(map(bool, values))
+        if kind in ("str", "bytes"):
+            return _pack_strings(values)
+        # Dictionary-encoded: new strings, then a code for each row
+        codes = self.dictionaries.setdefault((table, name), {})
+        new = []
+        for value in values:
+            if value not in codes:
+                codes[value] = len(codes)
+                new.append(value)
+        return _pack_strings(new) + _pack("I", (codes[v] for v in values))
+
+    def write(self, table: str, rows):
+        """Write a block of rows, each a tuple in the order of TABLES[table]."""
+        if not rows:
+            return
+        self.f.write(BLOCK_HEADER.pack(TABLE_NAMES.index(table), len(rows)))
+        for (name, kind), values in zip(TABLES[table], zip(*rows)):
+            payload = self._encode(table, name, kind, values)
+            self._write(zlib.compress(payload, COMPRESSION_LEVEL))
+        self.rows[table] += len(rows)
+
+    def close(self):
+        self.f.write(BLOCK_HEADER.pack(END, 0))
+
+
+class SnapshotReader:
+    """Reads a snapshot, yielding (table, rows) for each block."""
+
+    def __init__(self, f):
+        self.f = f
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a filescan snapshot")
+        self.header = json.loads(self._read())
+        if self.header["version"] != VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.header['version']}")
+        self.dictionaries = {}  # (table, column) -> [string, ...]
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated snapshot")
+        return data
+
+    def _read(self) -> bytes:
+        (length,) = LENGTH.unpack(self._read_exactly(LENGTH.size))
+        return self._read_exactly(length)
+
+    def _decode(self, table, name, kind, n, data):
+        if kind == "int":
+            return _unpack("q", data)
+        if kind == "int?":
+            valid, values = data[:n], _unpack("q", data[n:])
+            return [v if ok else None for ok, v in zip(valid, values)]
+        if kind == "float":
+            return _unpack("d", data)
+        if kind == "bool":
+            return [bool(v) for v in data]
+        if kind in ("str", "bytes"):
+            return _unpack_strings(data, decode=kind == "str")
+        strings = self.dictionaries.setdefault((table, name), [])
+        strings.extend(_unpack_strings(data))
+        codes = _unpack("I", data[len(data) - 4 * n :])
+        return [strings[code] for code in codes]
+
+    def __iter__(self):
+        while True:
+            number, n = BLOCK_HEADER.unpack(self._read_exactly(BLOCK_HEADER.size))
+            if number == END:
+                return
+            table = TABLE_NAMES[number]
+            columns = [
+                self._decode(table, name, kind, n, zlib.decompress(self._read()))
+                for name, kind in TABLES[table]
+            ]
+            yield table, list(zip(*columns))
+
+
+def export_snapshot(db, f, prefix=None, run=None) -> dict[str, int]:
+    """
+    Write the index in `db` (an SQLAlchemy Database) to the binary file
+    `f`. With `prefix`, only locations under it are written, with the
+    content they refer to; `run` takes the prefix from that RunLog's
+    root directory. Returns the number of rows written for each table.
+    """
+    if run is not None:
+        runlog = db.session.get(RunLog, run)
+        if runlog is None:
+            raise ValueError(f"No run with id {run}")
+        prefix = runlog.rootdir
+    writer = SnapshotWriter(f, prefix=prefix, run=run)
+    tables = Model.metadata.tables
+    if prefix is not None:
+        under = Location.dirpath.like(f"{prefix}%")
+        content = select(Location.checksum_id).where(under).scalar_subquery()
+    for name, columns in TABLES.items():
+        table = tables[name]
+        q = select(*(table.c[column] for column, kind in columns))
+        if prefix is not None:
+            if name == "location":
+                q = q.where(under).order_by(table.c.dirpath, table.c.filename)
+            elif name == "checksum":
+                q = q.where(table.c.id.in_(content))
+            else:
+                q = q.where(table.c.checksum_id.in_(content))
+        if name == "checksum":
+            q = q.order_by(table.c.id)
+        result = db.session.execute(q.execution_options(yield_per=ROWS_PER_BLOCK))
+        for rows in result.partitions():
+            writer.write(name, [tuple(row) for row in rows])
+    writer.close()
+    return writer.rows
+
+
+def import_snapshot(db, f) -> dict[str, int]:
+    """
+    Bulk-load a snapshot from the binary file `f` into `db`, which must
+    hold no checksums or locations. Checksums get new ids, to which the
+    other rows' references are mapped, and the directory rollups are
+    rebuilt. Returns the rows loaded for each table; the caller commits.
+    """
+    reader = SnapshotReader(f)
+    for model in (Checksum, Location):
+        if db.session.scalar(select(model.id).limit(1)) is not None:
+            raise ValueError(f"Database {db.dbname} is not empty")
+    tables = Model.metadata.tables
+    ids = {}  # Checksum id in the snapshot -> id in this database
+    loaded = dict.fromkeys(TABLES, 0)
+    for name, rows in reader:
+        table = tables[name]
+        if name == "checksum":
+            q = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+            new_ids = db.session.scalars(q, [{"checksum": cs} for id, cs in rows])
+            ids.update(zip((id for id, cs in rows), new_ids))
+        else:
+            columns = [column for column, kind in TABLES[name]]
+            params = [dict(zip(columns, row)) for row in rows]
+            for row in params:
+                if row["checksum_id"] is not None:
+                    row["checksum_id"] = ids[row["checksum_id"]]
+            db.session.execute(insert(table), params)
+        loaded[name] += len(rows)
+    db.rebuild_directory_totals()
+    return loaded
@@ -1,53 +1,86 @@
-import hashlib
-import logging
 import os
-import sys
+import time
+from collections import defaultdict
 from datetime import datetime
-
-
-from alembic import context
-from dotenv import load_dotenv
-
-load_dotenv()  #
+from itertools import groupby
 
 from sqlalchemy import (
     BigInteger,
     Boolean,
     DateTime,
+    bindparam,
+    case,
     Float,
     ForeignKey,
+    JSON,
+    LargeBinary,
     MetaData,
     String,
     create_engine,
+    delete,
+    event,
     exists,
     func,
+    insert,
+    or_,
     select,
     update,
     text,
 )
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.exc import ArgumentError, NoResultFound
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import ArgumentError, NoResultFound, OperationalError
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
+    joinedload,
+    make_transient_to_detached,
     mapped_column,
     relationship,
+    selectinload,
     sessionmaker,
 )
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.types import BIGINT
 from sqlalchemy_serializer import SerializerMixin
 
+from filescan import blocks
+from filescan.backend import (
+    BATCH_SIZE,
+    DirTotals,
+    FileEntry,
+    LRUCache,
+    Reference,
+    ancestors,
+    chunked,
+    directory_digest,
+    file_checksum,
+    files_digest,
+    parent_directory,
+)
+from filescan.config import DB_URL_ENV, db_server, engine_options, load_environment
+
+DB_URL_FORMAT = "{server}/{dbname}".format  # FILESCAN_DB_URL overrides when set
+CHECKSUM_CACHE_SIZE = 100_000  # Digest -> id entries; roughly 20 MB when full
 
-root = logging.getLogger()
-root.setLevel(logging.DEBUG)
+# Dialects whose INSERT supports ON CONFLICT DO NOTHING ... RETURNING
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
 
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-root.addHandler(handler)
+# Applied to every new SQLite connection. WAL lets readers carry on
+# while a scan writes, and the remaining settings trade a little
+# durability on power loss (never corruption) for bulk-load speed.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "temp_store": "MEMORY",
+    "cache_size": -64 * 1024,  # KiB, i.e. 64 MiB of page cache
+    "mmap_size": 256 * 1024 * 1024,
+}
 
-DB_URL_FORMAT = "postgresql+psycopg://localhost:5432/{dbname}".format
+# JSONB where PostgreSQL offers it, plain JSON (stored as text) elsewhere
+JSONType = JSON().with_variant(JSONB(), "postgresql")
 
 
 class Model(DeclarativeBase):
@@ -68,6 +101,8 @@ class Checksum(Model, SerializerMixin):
     checksum: Mapped[str] = mapped_column(String(), index=True, unique=True)
     locations: Mapped[list["Location"]] = relationship(back_populates="checksum")
     tokens: Mapped[list["TokenPos"]] = relationship(back_populates="checksum")
+    # When filescan gc first found no location using it; see filescan.orphans
+    orphaned: Mapped[float | None] = mapped_column(Float(), index=True)
     serialize_only = ("checksum",)
 
 
@@ -79,6 +114,11 @@ class Location(Model, SerializerMixin):
     modified: Mapped[float] = mapped_column(Float())
     seen: Mapped[bool] = mapped_column(Boolean())
     filesize: Mapped[int] = mapped_column(BigInteger())
+    # Set for files with several hard links: all links share an inode
+    device: Mapped[int | None] = mapped_column(BigInteger())
+    inode: Mapped[int | None] = mapped_column(BigInteger())
+    # When its content was last re-read by filescan verify (0 for never)
+    verified: Mapped[float] = mapped_column(Float(), server_default="0", index=True)
     serialize_rules = ("-checksum_id", "checksum.checksum")
     checksum_id: Mapped[int] = mapped_column(
         ForeignKey("checksum.id"), nullable=True, index=True
@@ -111,6 +151,71 @@ class RunLog(Model, SerializerMixin):
     new_files: Mapped[int]
     deleted: Mapped[int]
     archives: Mapped[list["Archive"]] = relationship("Archive", back_populates="runlog")
+    metrics: Mapped[list["RunMetric"]] = relationship(
+        "RunMetric", back_populates="runlog"
+    )
+    hot_spots: Mapped[list["HotSpot"]] = relationship(
+        "HotSpot", back_populates="runlog"
+    )
+
+
+class RunMetric(Model):
+    """A timing (in seconds) or counter recorded for a run; see filescan.metrics."""
+
+    __tablename__ = "runmetric"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    runlog_id: Mapped[int] = mapped_column(ForeignKey("runlog.id"), index=True)
+    runlog: Mapped[RunLog] = relationship("RunLog", back_populates="metrics")
+    name: Mapped[str] = mapped_column(String())
+    value: Mapped[float] = mapped_column(Float())
+
+
+class HotSpot(Model):
+    """One of a profiled run's slowest directories or files; see filescan.profile."""
+
+    __tablename__ = "hotspot"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    runlog_id: Mapped[int] = mapped_column(ForeignKey("runlog.id"), index=True)
+    runlog: Mapped[RunLog] = relationship("RunLog", back_populates="hot_spots")
+    kind: Mapped[str] = mapped_column(String())
+    path: Mapped[str] = mapped_column(String())
+    seconds: Mapped[float] = mapped_column(Float())
+
+
+class BlockDigests(Model):
+    """Per-block digests of a large file's content; see filescan.blocks."""
+
+    __tablename__ = "blockdigests"
+    checksum_id: Mapped[int] = mapped_column(
+        ForeignKey("checksum.id"), primary_key=True
+    )
+    block_size: Mapped[int]
+    digests: Mapped[bytes] = mapped_column(LargeBinary())
+
+
+class DirRollup(Model):
+    """
+    The files directly in a scanned directory and, in the total_
+    columns, all those beneath it, so subtree sizes needn't be summed
+    from location. Rows exist for each scanned directory and the
+    directories above it, and the scanner keeps them up to date.
+    `digest` is the directory's Merkle digest (see
+    filescan.backend.directory_digest), NULL while it is stale.
+    """
+
+    __tablename__ = "dirrollup"
+    dirpath: Mapped[str] = mapped_column(String(), primary_key=True)
+    parent: Mapped[str | None] = mapped_column(String(), index=True)
+    seen: Mapped[bool] = mapped_column(Boolean())
+    files: Mapped[int] = mapped_column(BigInteger())
+    size: Mapped[int] = mapped_column(BigInteger())
+    newest: Mapped[float | None] = mapped_column(Float())
+    total_files: Mapped[int] = mapped_column(BigInteger())
+    total_size: Mapped[int] = mapped_column(BigInteger())
+    total_newest: Mapped[float | None] = mapped_column(Float())
+    files_digest: Mapped[str | None] = mapped_column(String())
+    digest: Mapped[str | None] = mapped_column(String())
+    scanned: Mapped[float | None] = mapped_column(Float())
 
 
 class Archive(Model):
@@ -118,20 +223,263 @@ class Archive(Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     reason: Mapped[str] = mapped_column(String())
     rectype: Mapped[str] = mapped_column(String())
-    data: Mapped[dict] = mapped_column(JSONB())
+    data: Mapped[dict] = mapped_column(JSONType)
     runlog_id: Mapped[int] = mapped_column(
         ForeignKey("runlog.id"), nullable=True, index=True
     )
     runlog: Mapped[RunLog] = relationship("RunLog", back_populates="archives")
 
 
+def under(column, prefix, subtree=True):
+    """Condition on a dirpath `column`: below `prefix`, or (not `subtree`) in it."""
+    return column.like(f"{prefix}%") if subtree else column == prefix
+
+
+def empty_rollup(dirpath) -> dict:
+    return dict(
+        dirpath=dirpath,
+        parent=parent_directory(dirpath),
+        seen=True,
+        files=0,
+        size=0,
+        newest=None,
+        total_files=0,
+        total_size=0,
+        total_newest=None,
+        files_digest=None,
+        digest=None,
+        scanned=None,
+    )
+
+
+def rollup_rows(dirpath) -> list[dict]:
+    """Empty rollups for `dirpath` and each directory above it."""
+    return [empty_rollup(path) for path in ancestors(dirpath)]
+
+
+def rollups_from_totals(direct: dict[str, DirTotals]) -> list[dict]:
+    """Complete rollup rows from the direct totals of every directory."""
+    rows = {}
+    for dirpath, totals in direct.items():
+        for path in ancestors(dirpath):
+            row = rows.get(path) or rows.setdefault(path, empty_rollup(path))
+            row["total_files"] += totals.files
+            row["total_size"] += totals.size
+            if totals.newest is not None and (
+                row["total_newest"] is None or totals.newest > row["total_newest"]
+            ):
+                row["total_newest"] = totals.newest
+        rows[dirpath].update(files=totals.files, size=totals.size, newest=totals.newest)
+    return list(rows.values())
+
+
+def rollup_updates(dirpath, old: DirTotals, new: DirTotals, **values) -> list:
+    """
+    Statements changing the direct totals of `dirpath` from `old` to
+    `new`, applying the difference to its rollup and those above it,
+    and stamping it as scanned now. Any further `values` are set on the
+    row for `dirpath`.
+    """
+    return [rollup_direct_update(dirpath, new, **values)] + rollup_total_updates(
+        {dirpath: (old, new)}
+    )
+
+
+def rollup_direct_update(dirpath, new: DirTotals, **values):
+    """The statement setting the direct totals of `dirpath` alone."""
+    table = DirRollup.__table__
+    return (
+        update(table)
+        .where(table.c.dirpath == dirpath)
+        .values(
+            seen=True,
+            scanned=time.time(),
+            files=new.files,
+            size=new.size,
+            newest=new.newest,
+            **values,
+        )
+    )
+
+
+def rollup_total_updates(changes: dict[str, tuple[DirTotals, DirTotals]]) -> list:
+    """
+    Statements applying changes to the direct totals of directories,
+    (old, new) by dirpath, to the total_ columns of their rollups and
+    those above them. Rows getting the same change are updated by one
+    statement.
+    """
+    table = DirRollup.__table__
+    deltas = defaultdict(lambda: [0, 0])  # dirpath -> [files, size]
+    newest = {}  # dirpath -> a newer total_newest
+    recompute = set()  # Directories whose newest file has gone
+    for dirpath, (old, new) in changes.items():
+        above = ancestors(dirpath)
+        if (new.files, new.size) != (old.files, old.size):
+            for path in above:
+                deltas[path][0] += new.files - old.files
+                deltas[path][1] += new.size - old.size
+        if new.newest is not None and (old.newest is None or new.newest > old.newest):
+            for path in above:
+                if newest.get(path) is None or new.newest > newest[path]:
+                    newest[path] = new.newest
+        elif new.newest != old.newest:  # A maximum can't be decremented
+            recompute.update(above)
+    statements = []
+    by_delta = defaultdict(list)
+    for path, delta in sorted(deltas.items()):
+        if delta != [0, 0]:
+            by_delta[tuple(delta)].append(path)
+    for (files, size), paths in by_delta.items():
+        for batch in chunked(paths):
+            statements.append(
+                update(table)
+                .where(table.c.dirpath.in_(batch))
+                .values(
+                    total_files=table.c.total_files + files,
+                    total_size=table.c.total_size + size,
+                )
+            )
+    by_newest = defaultdict(list)
+    for path, value in sorted(newest.items()):
+        by_newest[value].append(path)
+    for value, paths in by_newest.items():
+        for batch in chunked(paths):
+            statements.append(
+                update(table)
+                .where(
+                    table.c.dirpath.in_(batch),
+                    or_(table.c.total_newest.is_(None), table.c.total_newest < value),
+                )
+                .values(total_newest=value)
+            )
+    return statements + newest_recomputes(recompute)
+
+
+def rollup_removals(removed: dict[str, DirTotals]) -> list:
+    """Statements dropping the rollups of the `removed` directories."""
+    table = DirRollup.__table__
+    statements = []
+    for dirpath, totals in removed.items():
+        if totals.files or totals.size:
+            statements.append(
+                update(table)
+                .where(table.c.dirpath.in_(ancestors(dirpath)[1:]))
+                .values(
+                    total_files=table.c.total_files - totals.files,
+                    total_size=table.c.total_size - totals.size,
+                )
+            )
+    for batch in chunked(list(removed)):
+        statements.append(delete(table).where(table.c.dirpath.in_(batch)))
+    survivors = {path for dirpath in removed for path in ancestors(dirpath)} - set(
+        removed
+    )
+    parents = {parent_directory(dirpath) for dirpath in removed} & survivors
+    for batch in chunked(sorted(parents)):
+        statements.append(
+            update(table).where(table.c.dirpath.in_(batch)).values(digest=None)
+        )
+    return statements + newest_recomputes(survivors)
+
+
+def refresh_digests(conn):
+    """
+    Recompute the digests of stale directories through `conn` (a
+    Session or Connection). Longer paths go first, so a directory's
+    subdirectories are always done before it; each marks its parent
+    stale in turn, so only the changed directories' ancestors are read.
+    """
+    table = DirRollup.__table__
+    stale = table.c.digest.is_(None)
+    length = func.length(table.c.dirpath)
+    while (longest := conn.scalar(select(func.max(length)).where(stale))) is not None:
+        q = select(table.c.dirpath, table.c.files_digest).where(
+            stale, length == longest
+        )
+        for batch in chunked(conn.execute(q).all()):
+            paths = [dirpath for dirpath, files in batch]
+            subdirs = {}
+            q = select(table.c.parent, table.c.dirpath, table.c.digest).where(
+                table.c.parent.in_(paths)
+            )
+            for parent, dirpath, digest in conn.execute(q):
+                subdirs.setdefault(parent, []).append(
+                    (dirpath[len(parent) : -1], digest)
+                )
+            q = (
+                update(table)
+                .where(table.c.dirpath == bindparam("path"))
+                .values(digest=bindparam("new_digest"))
+            )
+            conn.execute(
+                q,
+                [
+                    dict(
+                        path=dirpath,
+                        new_digest=directory_digest(files, subdirs.get(dirpath, ())),
+                    )
+                    for dirpath, files in batch
+                ],
+            )
+            parents = {parent_directory(dirpath) for dirpath in paths} - {None}
+            q = update(table).where(table.c.dirpath.in_(parents)).values(digest=None)
+            conn.execute(q)
+
+
+def newest_recomputes(dirpaths) -> list:
+    """Statements recomputing the total_newest of `dirpaths`, deepest first."""
+    table = DirRollup.__table__
+    child = table.alias("child")
+    children = (
+        select(func.max(child.c.total_newest))
+        .where(child.c.parent == table.c.dirpath)
+        .scalar_subquery()
+    )
+    newest = case(
+        (table.c.newest.is_(None), children),
+        (children > table.c.newest, children),
+        else_=table.c.newest,
+    )
+    return [
+        update(table).where(table.c.dirpath == dirpath).values(total_newest=newest)
+        for dirpath in sorted(dirpaths, key=lambda path: -path.count("/"))
+    ]
+
+
 class Database:
     class DoesNotExist(Exception):
         ...
 
-    def __init__(self, dbname=None, temporary=False, echo=False):
-        self.dbname = dbname if dbname is not None else os.environ.get("DBNAME", "test")
-        self.db_url = DB_URL_FORMAT(dbname=self.dbname)
+    def __init__(
+        self,
+        dbname=None,
+        temporary=False,
+        echo=False,
+        url=None,
+        checksum_cache_size=CHECKSUM_CACHE_SIZE,
+        **engine_options,
+    ):
+        """
+        Connect to the database at `url`, falling back first to the
+        FILESCAN_DB_URL environment variable and then to a PostgreSQL
+        database called `dbname` on the FILESCAN_DB_SERVER server.
+        Any further keyword arguments (pool_size and so on) are passed
+        to create_engine, overriding FILESCAN_DB_POOL_SIZE etc.
+        """
+        if url is None:
+            load_environment()
+            url = os.environ.get(DB_URL_ENV)
+        if url is None:
+            self.dbname = (
+                dbname if dbname is not None else os.environ.get("DBNAME", "test")
+            )
+            self.db_url = DB_URL_FORMAT(server=db_server(), dbname=self.dbname)
+        else:
+            self.db_url = url
+            self.dbname = make_url(url).database
+        self.is_sqlite = make_url(self.db_url).get_backend_name() == "sqlite"
+        self.engine = self._create_engine(echo=echo, **engine_options)
         exists = self._database_exists(self.dbname)
         if temporary:
             if not exists:
@@ -139,32 +487,47 @@ class Database:
         elif not exists:
             raise ValueError(f"Cannot access non-existent database {self.dbname!r}")
         # Reaching this point indicates that a suitable database exists
-        self.engine = create_engine(self.db_url, echo=echo)
+        if self.is_sqlite and self._in_memory:
+            Model.metadata.create_all(self.engine)  # Nothing to persist between runs
         self.session = sessionmaker(bind=self.engine)()
+        # Ids of checksum rows, which a rollback may have removed
+        self.checksum_ids = LRUCache(checksum_cache_size)
+        event.listen(
+            self.session, "after_soft_rollback", lambda *a: self.checksum_ids.clear()
+        )
+
+    @property
+    def _in_memory(self) -> bool:
+        return self.dbname in (None, "", ":memory:")
+
+    def _create_engine(self, echo=False, **options):
+        engine = create_engine(self.db_url, echo=echo, **(engine_options() | options))
+        if self.is_sqlite:
+            _configure_sqlite(engine)
+        return engine
 
     def _create_database(self, dbname: str):
         """
-        Creates a new PostgreSQL database with the given name.
+        Creates a new database with the given name. For SQLite the
+        file is simply created alongside its tables.
         """
-        temp_engine = create_engine(
-            "postgresql+psycopg://localhost:5432/postgres",
-            echo=True,
-            isolation_level="AUTOCOMMIT",
-        )  # Isolation level allows DDL
-
-        with temp_engine.connect() as conn:
-            conn.execute(text(f"CREATE DATABASE {dbname}"))
-        temp_engine.dispose()
-
-        engine = create_engine(
-            self.db_url, echo=False
-        )  # Create an engine to the new database
-        Model.metadata.create_all(engine)  # Create the tables
-        engine.dispose()
+        if not self.is_sqlite:
+            temp_engine = create_engine(
+                make_url(self.db_url).set(database="postgres"),
+                echo=True,
+                isolation_level="AUTOCOMMIT",
+            )  # Isolation level allows DDL
+
+            with temp_engine.connect() as conn:
+                conn.execute(text(f"CREATE DATABASE {dbname}"))
+            temp_engine.dispose()
+        Model.metadata.create_all(self.engine)  # Create the tables
 
     def _database_exists(self, dbname: str) -> bool:
         """
-        Checks if a PostgreSQL database with the given name exists.
+        Checks if a database with the given name exists by connecting
+        to it. The connection goes back to the engine's pool, ready for
+        the session's first query.
 
         Args:
             dbname: The name of the database to check.
@@ -172,21 +535,38 @@ class Database:
         Returns:
             True if the database exists, False otherwise.
         """
-        temp_engine = create_engine(
-            "postgresql+psycopg://localhost:5432/postgres", echo=False
-        )  # Connect to the server, not a specific DB
-        with temp_engine.connect() as conn:
-            result = conn.execute(
-                text("SELECT 1 FROM pg_database WHERE datname = :dbname"),
-                {"dbname": dbname},
-            )
-            return result.scalar() is not None
+        if self.is_sqlite:
+            return self._in_memory or os.path.exists(dbname)
+        try:
+            with self.engine.connect():
+                return True
+        except OperationalError as e:
+            # invalid_catalog_name, though libpq may only give the message
+            if getattr(e.orig, "sqlstate", None) == "3D000" or (
+                "does not exist" in str(e.orig)
+            ):
+                return False
+            raise
 
     def all_file_count(self, prefix):
         # Refactoring candidate ...
         q = select(func.count(Location.id)).where(Location.dirpath.like(f"{prefix}%"))
         return self.session.scalar(q)
 
+    def total_size(self, prefix):
+        under = Location.dirpath.like(f"{prefix}%")
+        unlinked = select(func.sum(Location.filesize)).where(
+            under, Location.inode.is_(None)
+        )
+        link_groups = (
+            select(func.max(Location.filesize).label("filesize"))
+            .where(under, Location.inode.is_not(None))
+            .group_by(Location.device, Location.inode)
+            .subquery()
+        )
+        linked = select(func.sum(link_groups.c.filesize))
+        return (self.session.scalar(unlinked) or 0) + (self.session.scalar(linked) or 0)
+
     def archive_record(self, reason, rectype, record, runlog):
         self.session.flush()  # Ensure the RunLog record has an id!
         archive = Archive(
@@ -194,31 +574,36 @@ class Database:
         )
         self.session.add(archive)
 
-    def clear_seen_bits(self, prefix):
+    def clear_seen_bits(self, prefix, subtree=True):
+        q = (
+            update(DirRollup)
+            .where(under(DirRollup.dirpath, prefix, subtree))
+            .values(seen=False)
+        )
+        self.session.execute(q)
         q = (
             update(Location)
-            .where(Location.dirpath.like(f"{prefix}%"))
+            .where(under(Location.dirpath, prefix, subtree))
             .values(seen=False)
         )
         return self.session.execute(q)
 
+    def mark_subtree_seen(self, prefix):
+        for table in (DirRollup, Location):
+            q = update(table).where(table.dirpath.like(f"{prefix}%")).values(seen=True)
+            self.session.execute(q)
+
+    def begin(self):
+        return self.session.begin()
+
     def commit(self):
         return self.session.commit()
 
-    def insert_location(
-        self, dirpath, filename, modified, checksum: Checksum, filesize: int
-    ):
-        loc = Location(
-            dirpath=dirpath,
-            filename=filename,
-            modified=modified,
-            checksum=checksum,
-            filesize=filesize,
-            seen=True,
-        )
-        # print(f"Added {dirpath}{filename}")
-        self.session.add(loc)
-        return loc
+    def flush(self):
+        return self.session.flush()
+
+    def rollback(self):
+        return self.session.rollback()
 
     def register_hash(self, file_path):
         """
@@ -230,25 +615,119 @@ class Database:
         the connection object as the first argument and the relevant
         Location object as the second.
         """
-        try:
-            new_file = open(file_path, "rb")
-            hash = hashlib.file_digest(new_file, "sha256").hexdigest()
-        except (FileNotFoundError, PermissionError):
-            return None
-        cs = self.session.query(Checksum).filter_by(checksum=hash).first()
+        return self.register_hashes([file_path])[0]
+
+    def register_hashes(self, file_paths, throttle=None) -> list[Checksum | None]:
+        """
+        Checksum several files' content, returning a Checksum for each
+        (None for any that can't be read). Digests already seen are
+        answered from an LRU cache of row ids; the rest are resolved
+        together, inserting any new ones, in a couple of statements.
+        """
+        return self.register_digests(
+            [file_checksum(file_path, throttle) for file_path in file_paths]
+        )
+
+    def register_digests(self, digests) -> list[Checksum | None]:
+        ids = self._checksum_ids(set(filter(None, digests)))
+        return [
+            None if digest is None else self._checksum_object(ids[digest], digest)
+            for digest in digests
+        ]
+
+    def block_digests(self, checksum: Checksum) -> bytes | None:
+        q = select(BlockDigests.digests).where(
+            BlockDigests.checksum_id == checksum.id,
+            BlockDigests.block_size == blocks.BLOCK_SIZE,
+        )
+        return self.session.scalar(q)
+
+    def save_block_digests(self, checksum: Checksum, digests: bytes):
+        table = BlockDigests.__table__
+        values = dict(
+            checksum_id=checksum.id, block_size=blocks.BLOCK_SIZE, digests=digests
+        )
+        dialect_insert = UPSERT_INSERTS.get(self.engine.dialect.name)
+        if dialect_insert is None:
+            self.session.execute(
+                delete(table).where(table.c.checksum_id == checksum.id)
+            )
+            self.session.execute(insert(table).values(values))
+        else:
+            q = dialect_insert(table).values(values)
+            q = q.on_conflict_do_update(
+                index_elements=["checksum_id"],
+                set_=dict(block_size=q.excluded.block_size, digests=q.excluded.digests),
+            )
+            self.session.execute(q)
+
+    def _checksum_ids(self, digests) -> dict[str, int]:
+        ids = {}
+        for digest in digests:
+            if (id := self.checksum_ids.get(digest)) is not None:
+                ids[digest] = id
+        missing = sorted(digests - ids.keys())  # Sorted to avoid deadlocks
+        table = Checksum.__table__
+        dialect_insert = UPSERT_INSERTS.get(self.engine.dialect.name)
+        for batch in chunked(missing):
+            if dialect_insert is not None:
+                q = (
+                    dialect_insert(table)
+                    .values([{"checksum": digest} for digest in batch])
+                    .on_conflict_do_nothing(index_elements=["checksum"])
+                    .returning(table.c.checksum, table.c.id)
+                )
+                ids.update(self.session.execute(q).all())
+            unresolved = [digest for digest in batch if digest not in ids]
+            if unresolved:  # Rows that already existed
+                q = select(table.c.checksum, table.c.id).where(
+                    table.c.checksum.in_(unresolved)
+                )
+                ids.update(self.session.execute(q).all())
+            unresolved = [digest for digest in batch if digest not in ids]
+            if unresolved:  # No upsert available for this dialect
+                q = insert(table).returning(table.c.checksum, table.c.id)
+                rows = [{"checksum": digest} for digest in unresolved]
+                ids.update(self.session.execute(q, rows).all())
+            for digest in batch:
+                self.checksum_ids.put(digest, ids[digest])
+        return ids
+
+    def _checksum_object(self, id: int, digest: str) -> Checksum:
+        """The session's Checksum for a row known to exist, without a query."""
+        cs = self.session.identity_map.get(identity_key(Checksum, id))
         if cs is None:
-            cs = Checksum(checksum=hash)
+            cs = Checksum(id=id, checksum=digest)
+            make_transient_to_detached(cs)
             self.session.add(cs)
         return cs
 
     def save_reference(
         self, checksum: Checksum, name: str, line: int, pos: int, ttype: int = 1
     ) -> TokenPos:
-
         t = TokenPos(checksum=checksum, ttype=ttype, name=name, line=line, pos=pos)
         self.session.add(t)
         return t
 
+    def add_references_bulk(self, checksum: Checksum, refs):
+        refs = [Reference(*ref) for ref in refs]
+        if not refs:
+            return
+        self.session.flush()  # The checksum needs its id
+        self.session.execute(
+            insert(TokenPos),
+            [
+                dict(
+                    checksum_id=checksum.id,
+                    ttype=ref.ttype,
+                    name=ref.name,
+                    line=ref.line,
+                    pos=ref.pos,
+                )
+                for ref in refs
+            ],
+        )
+
     def location_for(self, dirpath: str, filename: str):
         try:
             q = select(Location).where(
@@ -259,6 +738,184 @@ class Database:
         except NoResultFound:
             raise self.DoesNotExist(f"{dirpath}{filename}")
 
+    def lookup_many(self, dirpath: str, filenames) -> dict[str, Location]:
+        result = {}
+        for names in chunked(list(filenames)):
+            q = (
+                select(Location)
+                .where(Location.dirpath == dirpath, Location.filename.in_(names))
+                .options(joinedload(Location.checksum))
+            )
+            result.update((loc.filename, loc) for loc in self.session.scalars(q))
+        return result
+
+    def upsert_locations(self, dirpath: str, entries) -> list[Location]:
+        entries = [FileEntry(*entry) for entry in entries]
+        existing = self.lookup_many(dirpath, (e.filename for e in entries))
+        result = []
+        for entry in entries:
+            loc = existing.get(entry.filename)
+            if loc is None:
+                loc = Location(dirpath=dirpath, **entry._asdict(), seen=True)
+                self.session.add(loc)
+            else:
+                loc.modified = entry.modified
+                loc.checksum = entry.checksum
+                loc.filesize = entry.filesize
+                loc.device = entry.device
+                loc.inode = entry.inode
+                loc.seen = True
+            result.append(loc)
+        return result
+
+    def mark_seen(self, locations):
+        ids = [loc.id for loc in locations]
+        for batch in chunked(ids):
+            self.session.execute(
+                update(Location).where(Location.id.in_(batch)).values(seen=True)
+            )
+
+    def mark_deleted(self, prefix, limit=None, subtree=True) -> list[Location]:
+        q = (
+            select(Location)
+            .where(under(Location.dirpath, prefix, subtree), Location.seen == False)
+            .options(selectinload(Location.checksum))
+            .limit(limit)
+        )
+        deleted = list(self.session.scalars(q))
+        # Core deletes, since the session would hold deleted objects to the end
+        for batch in chunked([loc.id for loc in deleted]):
+            self.session.execute(delete(Location).where(Location.id.in_(batch)))
+        for loc in deleted:
+            self.session.expunge(loc)
+        return deleted
+
+    def save_directory_totals(self, dirpath: str, totals: DirTotals, checksums=()):
+        table = DirRollup.__table__
+        q = select(
+            table.c.files, table.c.size, table.c.newest, table.c.files_digest
+        ).where(table.c.dirpath == dirpath)
+        row = self.session.execute(q).first()
+        if row is None:  # A directory new to the index
+            rows = rollup_rows(dirpath)
+            dialect_insert = UPSERT_INSERTS.get(self.engine.dialect.name)
+            if dialect_insert is not None:
+                q = dialect_insert(table).on_conflict_do_nothing(
+                    index_elements=["dirpath"]
+                )
+            else:
+                q = select(table.c.dirpath).where(
+                    table.c.dirpath.in_([row["dirpath"] for row in rows])
+                )
+                present = set(self.session.scalars(q))
+                rows = [row for row in rows if row["dirpath"] not in present]
+                q = insert(table)
+            self.session.execute(q, rows)
+        old = DirTotals() if row is None else DirTotals(*row[:3])
+        files = files_digest(
+            (name, None if cs is None else cs.checksum) for name, cs in checksums
+        )
+        values = dict(files_digest=files)
+        if row is not None and files != row.files_digest:
+            values["digest"] = None  # Stale until refresh_directory_digests
+        for q in rollup_updates(dirpath, old, DirTotals(*totals), **values):
+            self.session.execute(q)
+
+    def remove_unseen_directories(self, prefix: str) -> int:
+        table = DirRollup.__table__
+        q = select(table.c.dirpath, table.c.files, table.c.size, table.c.newest).where(
+            table.c.dirpath.like(f"{prefix}%"), table.c.seen == False
+        )
+        removed = {row[0]: DirTotals(*row[1:]) for row in self.session.execute(q)}
+        for q in rollup_removals(removed):
+            self.session.execute(q)
+        return len(removed)
+
+    def scanned_directories(self, prefix: str) -> dict[str, float | None]:
+        q = select(DirRollup.dirpath, DirRollup.scanned).where(
+            DirRollup.dirpath.like(f"{prefix}%")
+        )
+        return dict(self.session.execute(q).all())
+
+    def refresh_directory_digests(self):
+        refresh_digests(self.session)
+
+    def directory_digest(self, dirpath: str) -> str | None:
+        q = select(DirRollup.digest).where(DirRollup.dirpath == dirpath)
+        return self.session.scalar(q)
+
+    def directory_entries(self, dirpath: str):
+        q = (
+            select(Location.filename, Checksum.checksum)
+            .outerjoin(Location.checksum)
+            .where(Location.dirpath == dirpath)
+        )
+        files = dict(self.session.execute(q).all())
+        q = select(DirRollup.dirpath, DirRollup.digest).where(
+            DirRollup.parent == dirpath
+        )
+        subdirs = {
+            path[len(dirpath) : -1]: digest for path, digest in self.session.execute(q)
+        }
+        return files, subdirs
+
+    def rebuild_directory_totals(self):
+        """Recompute every rollup from location, as after a bulk load."""
+        self.session.execute(delete(DirRollup))
+        q = select(
+            Location.dirpath,
+            func.count(Location.id),
+            func.coalesce(func.sum(Location.filesize), 0),
+            func.max(Location.modified),
+        ).group_by(Location.dirpath)
+        direct = {row[0]: DirTotals(*row[1:]) for row in self.session.execute(q)}
+        for batch in chunked(rollups_from_totals(direct)):
+            self.session.execute(insert(DirRollup.__table__), batch)
+        q = (
+            select(Location.dirpath, Location.filename, Checksum.checksum)
+            .outerjoin(Location.checksum)
+            .order_by(Location.dirpath)
+        )
+        rows = self.session.execute(q.execution_options(yield_per=BATCH_SIZE))
+        digests = (
+            dict(
+                path=dirpath,
+                new_files=files_digest((name, cs) for _, name, cs in group),
+            )
+            for dirpath, group in groupby(rows, key=lambda row: row[0])
+        )
+        table = DirRollup.__table__
+        q = (
+            update(table)
+            .where(table.c.dirpath == bindparam("path"))
+            .values(files_digest=bindparam("new_files"))
+        )
+        for batch in chunked(list(digests)):
+            self.session.execute(q, batch)
+        refresh_digests(self.session)
+
+    def directory_totals(self, dirpath: str) -> DirTotals | None:
+        table = DirRollup.__table__
+        q = select(table.c.total_files, table.c.total_size, table.c.total_newest).where(
+            table.c.dirpath == dirpath
+        )
+        row = self.session.execute(q).first()
+        return None if row is None else DirTotals(*row)
+
+    def child_directories(self, dirpath: str) -> dict[str, DirTotals]:
+        table = DirRollup.__table__
+        q = (
+            select(
+                table.c.dirpath,
+                table.c.total_files,
+                table.c.total_size,
+                table.c.total_newest,
+            )
+            .where(table.c.parent == dirpath)
+            .order_by(table.c.dirpath)
+        )
+        return {row[0]: DirTotals(*row[1:]) for row in self.session.execute(q)}
+
     def start_run(self, rootdir) -> int:
         runlog = RunLog(
             when_run=datetime.now(),
@@ -293,24 +950,17 @@ class Database:
         run.when_finished = datetime.now()
         self.session.add(run)
 
-    def update_details(
-        self,
-        loc: Location,
-        modified: float,
-        checksum: Checksum,
-        size,
-        seen: bool = True,
-    ):
-        loc.modified = modified
-        loc.checksum = checksum
-        loc.filesize = size
-        loc.seen = seen
-        self.session.add(loc)
-        return loc
+    def record_metrics(self, run: RunLog, metrics: dict[str, float]):
+        self.session.add_all(
+            RunMetric(runlog=run, name=name, value=value)
+            for name, value in metrics.items()
+        )
 
-    def update_seen(self, loc, value=True):
-        loc.seen = value
-        self.session.add(loc)
+    def record_hot_spots(self, run: RunLog, hot_spots):
+        self.session.add_all(
+            HotSpot(runlog=run, kind=kind, path=path, seconds=seconds)
+            for kind, path, seconds in hot_spots
+        )
 
     def unseen_location_count(self, prefix):
         q = select(func.count(Location.id)).where(
@@ -318,19 +968,25 @@ class Database:
         )
         return self.session.scalars(q).one()
 
-    def unseen_locations(self, prefix):
-        q = select(Location).where(
-            Location.dirpath.like(f"{prefix}%"), Location.seen == False
-        )
-        result = self.session.scalars(q)
-        return result
 
-    def delete_unseen_locations(self, prefix):
-        q = select(Location).where(
-            Location.dirpath.like(f"{prefix}%"), Location.seen == False
-        )
-        for r in self.session.scalars(q):
-            self.session.delete(r)
+def _configure_sqlite(engine):
+    """
+    Apply SQLITE_PRAGMAS to each new connection, and take over
+    transaction control from the sqlite3 module so that SAVEPOINTs
+    (session.begin_nested()) behave as they do on PostgreSQL.
+    """
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def on_begin(conn):
+        conn.exec_driver_sql("BEGIN")
 
 
 #
@@ -345,6 +1001,3 @@ def counted_symbols_from_filename_q(filename, *, dirpath):
         .group_by(TokenPos.name)
     )
     return q
-
-
-i = 0
@@ -0,0 +1,214 @@
+"""
+A local stat cache, so that unchanged directories need no database work.
+
+Much as git keeps an index of the stat data of the files it tracks,
+a scan run with a cache directory keeps a file per (database, root)
+recording what the run found: for each directory, a fixed-width
+record per file of its name's hash, mtime in nanoseconds, size,
+inode and checksum id, sorted by name hash. The next scan of that
+root maps the file into memory and compares each directory's listing
+and stat results with its records. A directory that matches exactly
+is counted as unchanged without a single query; only the others are
+looked up, written and checked for deletions as usual.
+
+The cache is only trusted while it describes the database: its header
+names the RunLog of the run that wrote it, and it is ignored unless
+that is still the latest run of the root or of any directory above or
+below it. It is written to a temporary file as the scan goes and moved
+into place (atomically) only once the run is committed.
+
+Layout (little-endian): a header; the records, directory by
+directory; then a table giving each directory's path and the offset
+and number of its records. Records for files changed within the clock
+granularity of a scan (mtime no earlier than the scan's start) are
+never trusted, as git does with "racily clean" entries.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+from sqlalchemy import literal, or_, select
+
+from filescan.sqlalchemy_store import RunLog
+
+MAGIC = b"FSSTATC\0"
+VERSION = 1
+# Magic, version, RunLog id and start (microseconds), scan start (ns),
+# directory table offset, directory count
+HEADER = struct.Struct("<8sIqqqqq")
+RECORD = struct.Struct("<8sqqQq")  # Name hash, mtime_ns, size, inode, checksum id
+DIRECTORY = struct.Struct("<qqI")  # Record offset, record count, path length
+
+
+def name_hash(name: str) -> bytes:
+    return hashlib.blake2b(
+        name.encode("utf-8", "surrogateescape"), digest_size=8
+    ).digest()
+
+
+def cache_path(cache_dir: str, db_url: str, root: str) -> str:
+    key = hashlib.sha256(f"{db_url}\0{root}".encode("utf-8", "surrogateescape"))
+    return os.path.join(cache_dir, f"{key.hexdigest()[:32]}.idx")
+
+
+def latest_run(db, root: str):
+    """(id, start in microseconds) of the latest run overlapping `root`, if any."""
+    q = (
+        select(RunLog.id, RunLog.when_run)
+        .where(
+            or_(
+                RunLog.rootdir.like(f"{root}%"),
+                literal(root).startswith(RunLog.rootdir),
+            )
+        )
+        .order_by(RunLog.id.desc())
+        .limit(1)
+    )
+    row = db.session.execute(q).first()
+    return None if row is None else (row.id, _micros(row.when_run))
+
+
+def _micros(when):
+    return round(when.timestamp() * 1e6)
+
+
+class StatCache:
+    """
+    The stat cache for one root of one database: the records of the
+    last run, if they can be trusted, and those of the run under way.
+    """
+
+    def __init__(self, cache_dir: str, db, root: str):
+        self.path = cache_path(cache_dir, db.db_url, root)
+        self.directories = {}  # Path -> (offset, count) of its records
+        self.started_ns = 0
+        self._map = None
+        self._out = None
+        try:
+            self._load(latest_run(db, root))
+        except (OSError, ValueError, struct.error):
+            self.directories = {}
+
+    def _load(self, latest):
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            run_id,
+            run_start,
+            started_ns,
+            table,
+            count,
+        ) = HEADER.unpack_from(self._map)
+        if (magic, version) != (MAGIC, VERSION) or (run_id, run_start) != latest:
+            self.close()
+            return
+        pos = table
+        for _ in range(count):
+            offset, records, length = DIRECTORY.unpack_from(self._map, pos)
+            pos += DIRECTORY.size
+            dirpath = self._map[pos : pos + length].decode("utf-8", "surrogateescape")
+            pos += length
+            self.directories[dirpath] = (offset, records)
+        self.started_ns = started_ns
+
+    @property
+    def valid(self) -> bool:
+        return bool(self.directories)
+
+    def file_count(self) -> int:
+        return sum(count for offset, count in self.directories.values())
+
+    def _records(self, dirpath):
+        offset, count = self.directories[dirpath]
+        return self._map[offset : offset + count * RECORD.size]
+
+    def unchanged(self, dirpath: str, stats: dict[str, os.stat_result]) -> bool:
+        """Whether `dirpath` holds just the files `stats`, as they were cached."""
+        if dirpath not in self.directories:
+            return False
+        records = self._records(dirpath)
+        if len(records) != len(stats) * RECORD.size:
+            return False
+        cached = {record[0]: record[1:4] for record in RECORD.iter_unpack(records)}
+        for name, stat in stats.items():
+            mtime_ns, size, inode = cached.get(name_hash(name), (None, None, None))
+            if (
+                mtime_ns != stat.st_mtime_ns
+                or size != stat.st_size
+                or inode != stat.st_ino
+                or mtime_ns >= self.started_ns  # Racily clean
+            ):
+                return False
+        return True
+
+    def vanished(self, walked) -> list[str]:
+        """The cached directories not among `walked`."""
+        return [dirpath for dirpath in self.directories if dirpath not in walked]
+
+    # Writing the next generation
+
+    def begin(self, runlog):
+        """Start recording the run `runlog`, which has yet to walk the tree."""
+        self._run = (runlog.id, _micros(runlog.when_run))
+        self._started_ns = time.time_ns()
+        self._written = []  # (path, offset, count)
+        self._out = open(f"{self.path}.tmp", "wb")
+        self._out.write(bytes(HEADER.size))
+
+    def keep(self, dirpath: str):
+        """Carry an unchanged directory's records over to the next cache."""
+        self._write(dirpath, self._records(dirpath))
+
+    def save(self, dirpath: str, files: dict):
+        """Record a scanned directory: `files` maps names to (stat, checksum)."""
+        records = sorted(
+            RECORD.pack(
+                name_hash(name),
+                stat.st_mtime_ns,
+                stat.st_size,
+                stat.st_ino,
+                0 if checksum is None else checksum.id,
+            )
+            for name, (stat, checksum) in files.items()
+        )
+        self._write(dirpath, b"".join(records))
+
+    def _write(self, dirpath, records):
+        self._written.append((dirpath, self._out.tell(), len(records) // RECORD.size))
+        self._out.write(records)
+
+    def commit(self):
+        """Replace the cache with the run's, once the run is committed."""
+        out = self._out
+        table = out.tell()
+        for dirpath, offset, count in self._written:
+            path = dirpath.encode("utf-8", "surrogateescape")
+            out.write(DIRECTORY.pack(offset, count, len(path)) + path)
+        out.seek(0)
+        out.write(
+            HEADER.pack(
+                MAGIC, VERSION, *self._run, self._started_ns, table, len(self._written)
+            )
+        )
+        out.close()
+        self._out = None
+        self.close()
+        os.replace(out.name, self.path)
+
+    def discard(self):
+        if self._out is not None:
+            self._out.close()
+            os.unlink(self._out.name)
+            self._out = None
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,143 @@
+"""
+I/O budgets for scans that share a file server with live traffic.
+
+A Throttle holds a token bucket for bytes read while hashing and
+another for stat calls (including directory listings). Each charge
+beyond the bucket's small burst allowance sleeps long enough to keep
+the average at the configured rate. Given a target latency, the
+throttle also watches how long each read takes and halves both rates
+while reads are slower than the target, then creeps back up towards
+the configured rates once they recover.
+
+`set_idle_io_priority` puts the process in the kernel's idle I/O
+class, so its reads are only served when the disk is otherwise idle.
+"""
+import logging
+import os
+import platform
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BURST_SECONDS = 0.1  # Work a bucket allows without waiting, in seconds' worth
+ADJUST_INTERVAL = 1.0  # Seconds between adaptive rate changes
+LATENCY_SMOOTHING = 0.2  # Weight of each new sample in the latency average
+MIN_SCALE = 1 / 64  # Adaptation never slows below this fraction of the rates
+RECOVERY_STEP = 0.1  # Fraction of the configured rates regained per interval
+
+# ioprio_set(2), which the standard library does not wrap
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+class RateLimiter:
+    """Token bucket: `acquire(n)` waits as needed to hold `rate` units/s."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.last = clock()
+
+    @property
+    def capacity(self):
+        return self.rate * BURST_SECONDS
+
+    def acquire(self, n=1) -> float:
+        """Charge `n` units, returning the time spent waiting for them."""
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        # The debt is repaid by the refill while we sleep
+        delay = -self.tokens / self.rate
+        self.sleep(delay)
+        return delay
+
+
+class Throttle:
+    def __init__(
+        self,
+        read_bytes_per_second=None,
+        stats_per_second=None,
+        target_latency=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.limits = {}
+        if read_bytes_per_second:
+            self.limits["read"] = RateLimiter(read_bytes_per_second, clock, sleep)
+        if stats_per_second:
+            self.limits["stat"] = RateLimiter(stats_per_second, clock, sleep)
+        self.rates = {name: limit.rate for name, limit in self.limits.items()}
+        self.target_latency = target_latency
+        self.clock = clock
+        self.latency = None
+        self.scale = 1.0
+        self.next_adjustment = clock() + ADJUST_INTERVAL
+        self.waited = 0.0
+        # Concurrent readers queue here, each waiting its turn in the buckets
+        self.lock = threading.Lock()
+
+    def read(self, nbytes, latency=None):
+        """Charge `nbytes` just read, which took `latency` seconds."""
+        with self.lock:
+            if latency is not None:
+                self.observe(latency)
+            if "read" in self.limits:
+                self.waited += self.limits["read"].acquire(nbytes)
+
+    def stat(self, n=1):
+        """Charge `n` stat calls or directory listings."""
+        with self.lock:
+            if "stat" in self.limits:
+                self.waited += self.limits["stat"].acquire(n)
+
+    def observe(self, latency):
+        if self.target_latency is None:
+            return
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        now = self.clock()
+        if now < self.next_adjustment:
+            return
+        self.next_adjustment = now + ADJUST_INTERVAL
+        if self.latency > self.target_latency:
+            scale = max(self.scale / 2, MIN_SCALE)
+        else:
+            scale = min(self.scale + RECOVERY_STEP, 1.0)
+        if scale != self.scale:
+            logger.debug(
+                "Read latency %.1f ms: I/O rates scaled to %.0f%%",
+                self.latency * 1000,
+                scale * 100,
+            )
+            self.scale = scale
+            for name, limit in self.limits.items():
+                limit.rate = self.rates[name] * scale
+
+
+def set_idle_io_priority() -> bool:
+    """Move this process into the idle I/O class; False where unsupported."""
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if platform.system() != "Linux" or number is None:
+        logger.warning("Idle I/O priority is not supported on this platform")
+        return False
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    priority = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, priority) != 0:
+        logger.warning(
+            "Could not set idle I/O priority: %s", os.strerror(ctypes.get_errno())
+        )
+        return False
+    return True
@@ -0,0 +1,157 @@
+"""
+Rolling checks that unchanged files still hold the content indexed.
+
+A scan re-reads only files whose mtime has changed, so a disk that
+silently corrupts an old file goes unnoticed. `verify` re-hashes a
+slice of the index at a time: the locations verified longest ago (or
+never), up to a budget of bytes, skipping those that have changed on
+disk since they were scanned (the next scan will deal with them).
+Each location records when it was last verified, so successive runs
+work their way round the whole index. With the default budget, the
+indexed bytes divided by a cycle of days, running nightly covers
+everything once per cycle.
+
+Large files indexed before block digests were kept have a plain
+SHA-256 as their checksum and no block digests, so those are checked
+against a plain SHA-256 of their content.
+
+A file whose content no longer matches its Checksum is reported and
+recorded as a "MISMATCH" archive event, holding the location and the
+digest found. The index itself is left alone: the stored checksum is
+the evidence of what the file should hold.
+"""
+import os
+import re
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import joinedload
+
+from filescan import blocks
+from filescan.backend import chunked, file_checksum, file_checksums
+from filescan.sqlalchemy_store import Archive, Location
+
+DEFAULT_DAYS = 30
+SIZE_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+def parse_size(text: str) -> int:
+    """Bytes in "1048576", "500M", "20G" or "1.5T" (powers of 1024)."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?\s*", text.lower())
+    if match is None:
+        raise ValueError(f"Not a size: {text!r}")
+    return int(float(match[1]) * SIZE_UNITS[match[2]])
+
+
+def content_checksum(db, loc, path: str, size: int, throttle=None) -> str | None:
+    """
+    The digest of the file at `path` to compare with `loc`'s checksum:
+    its file_checksum, unless it is a large file whose checksum has no
+    block digests, being older than them. For those both the plain
+    SHA-256 and the root digest are taken, in one read, and the plain
+    one is used if it matches.
+    """
+    if size < blocks.LARGE_FILE_SIZE or db.block_digests(loc.checksum) is not None:
+        return file_checksum(path, throttle)
+    found = file_checksums(path, throttle)
+    if found is None:
+        return None
+    root, plain = found
+    return plain if plain == loc.checksum.checksum else root
+
+
+@dataclass
+class VerifyCounts:
+    files: int = 0
+    bytes: int = 0
+    changed: int = 0  # Since the last scan, so not checked
+    missing: int = 0  # Gone or unreadable
+    mismatches: list[str] = field(default_factory=list)
+
+
+def _indexed(prefix):
+    return Location.dirpath.like(f"{prefix}%"), Location.checksum_id.is_not(None)
+
+
+def indexed_bytes(db, prefix: str) -> int:
+    q = select(func.sum(Location.filesize)).where(*_indexed(prefix))
+    return db.session.scalar(q) or 0
+
+
+def oldest_verification(db, prefix: str) -> float | None:
+    """When the least recently verified location under `prefix` was (0 for never)."""
+    return db.session.scalar(
+        select(func.min(Location.verified)).where(*_indexed(prefix))
+    )
+
+
+def choose(db, prefix: str, budget: int) -> list[int]:
+    """Ids of the locations under `prefix` verified longest ago, up to `budget` bytes."""
+    q = (
+        select(Location.id, Location.filesize)
+        .where(*_indexed(prefix))
+        .order_by(Location.verified, Location.id)
+        .execution_options(yield_per=1000)
+    )
+    chosen, total = [], 0
+    result = db.session.execute(q)
+    for id, size in result:
+        if chosen and total + size > budget:
+            break
+        chosen.append(id)
+        total += size
+    result.close()
+    return chosen
+
+
+def verify(db, prefix: str, budget: int, throttle=None) -> VerifyCounts:
+    """
+    Re-hash up to `budget` bytes of the unchanged files under `prefix`
+    that were verified longest ago, committing as it goes.
+    """
+    counts = VerifyCounts()
+    links = {}  # (device, inode) -> digest found, for files with several links
+    for ids in chunked(choose(db, prefix, budget)):
+        q = (
+            select(Location)
+            .options(joinedload(Location.checksum))
+            .where(Location.id.in_(ids))
+        )
+        done = []
+        for loc in db.session.scalars(q):
+            path = f"{loc.dirpath}{loc.filename}"
+            try:
+                stat = os.stat(path, follow_symlinks=False)
+            except OSError:
+                counts.missing += 1
+                continue
+            if stat.st_mtime != loc.modified or stat.st_size != loc.filesize:
+                counts.changed += 1
+                continue
+            link = None if loc.inode is None else (loc.device, loc.inode)
+            if link in links:
+                digest = links[link]
+            else:
+                digest = content_checksum(db, loc, path, stat.st_size, throttle)
+                if digest is None:
+                    counts.missing += 1
+                    continue
+                counts.files += 1
+                counts.bytes += stat.st_size
+                if link is not None:
+                    links[link] = digest
+            if digest != loc.checksum.checksum:
+                counts.mismatches.append(path)
+                db.session.add(
+                    Archive(
+                        reason="MISMATCH",
+                        rectype="location",
+                        data=dict(loc.to_dict(), found=digest),
+                    )
+                )
+            done.append(loc.id)
+        q = update(Location).where(Location.id.in_(done)).values(verified=time.time())
+        db.session.execute(q)
+        db.commit()
+    return counts
@@ -0,0 +1,248 @@
+"""
+Walking directory trees without wandering off them.
+
+A Walker does the work of os.walk for a scan, but it can be told where
+to stop. Mount points are found in /proc/self/mountinfo, so mounts of
+unwanted filesystem types (by default the kernel's pseudo filesystems
+such as proc and sysfs) are passed over without touching them, which
+matters for network mounts whose server has gone away. With
+`one_filesystem` the walk stays on the device it started on, as
+`find -xdev` does.
+
+Given a `timeout`, each directory is listed in a helper thread, and
+one that takes longer is skipped and reported in `timed_out`; the
+helper is abandoned to finish (or not) in its own time. When symlinked
+directories are followed, each directory is entered at most once,
+by its (st_dev, st_ino), so links back up the tree can't make the
+walk go round in circles.
+"""
+import fnmatch
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+MOUNTINFO = "/proc/self/mountinfo"
+PSEUDO_FILESYSTEMS = (
+    "autofs",
+    "binfmt_misc",
+    "bpf",
+    "cgroup",
+    "cgroup2",
+    "configfs",
+    "debugfs",
+    "devpts",
+    "devtmpfs",
+    "efivarfs",
+    "fusectl",
+    "hugetlbfs",
+    "mqueue",
+    "nsfs",
+    "proc",
+    "pstore",
+    "rpc_pipefs",
+    "securityfs",
+    "selinuxfs",
+    "sysfs",
+    "tracefs",
+)
+
+
+def _unescape(field: bytes) -> str:
+    """Undo mountinfo's octal escapes (\\040 for a space, and so on)."""
+    parts = field.split(b"\\")
+    result = [parts[0]]
+    for part in parts[1:]:
+        result.append(bytes([int(part[:3], 8)]) + part[3:])
+    return os.fsdecode(b"".join(result))
+
+
+def read_mounts(path: str = MOUNTINFO) -> dict[str, str]:
+    """Filesystem type by mount point, or nothing where there's no mountinfo."""
+    try:
+        with open(path, "rb") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    mounts = {}
+    for line in lines:
+        fields = line.split()
+        separator = fields.index(b"-")  # After the optional fields
+        mounts[_unescape(fields[4])] = os.fsdecode(fields[separator + 1])
+    return mounts
+
+
+def parse_fs_types(text: str) -> tuple[str, ...]:
+    """Filesystem type patterns from a comma-separated list ("nfs*,cifs")."""
+    return tuple(name.strip() for name in text.split(",") if name.strip())
+
+
+class TimedLister:
+    """Lists directories in a helper thread, giving up after `timeout` seconds."""
+
+    def __init__(self, timeout: float, scandir=os.scandir):
+        self.timeout = timeout
+        self.scandir = scandir
+        self._requests = None
+
+    def _serve(self, requests):
+        while (request := requests.get()) is not None:
+            dirpath, results = request
+            try:
+                results.put(_list(self.scandir, dirpath))
+            except OSError as e:
+                results.put(e)
+
+    def __call__(self, dirpath: str):
+        if self._requests is None:
+            self._requests = queue.SimpleQueue()
+            threading.Thread(
+                target=self._serve, args=(self._requests,), daemon=True
+            ).start()
+        results = queue.SimpleQueue()
+        self._requests.put((dirpath, results))
+        try:
+            result = results.get(timeout=self.timeout)
+        except queue.Empty:
+            self._requests.put(None)  # The helper quits if it ever returns
+            self._requests = None
+            raise TimeoutError(f"Listing {dirpath} took over {self.timeout}s")
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+
+def _list(scandir, dirpath):
+    """Directory entries by name, and the other names, in `dirpath`."""
+    dirs, files = {}, []
+    with scandir(dirpath) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs[entry.name] = entry
+            else:
+                files.append(entry.name)
+    return dirs, files
+
+
+class Walker:
+    """Walks a tree for a scan, entering only the directories it should."""
+
+    def __init__(
+        self,
+        one_filesystem: bool = False,
+        fs_types=None,
+        skip_fs_types=PSEUDO_FILESYSTEMS,
+        follow_symlinks: bool = False,
+        timeout: float | None = None,
+        mountinfo: str = MOUNTINFO,
+        scandir=os.scandir,
+    ):
+        self.one_filesystem = one_filesystem
+        self.fs_types = fs_types  # Allowed types, if not all
+        self.skip_fs_types = skip_fs_types
+        self.follow_symlinks = follow_symlinks
+        self.mounts = read_mounts(mountinfo)
+        if timeout:
+            self.listdir = TimedLister(timeout, scandir)
+        else:
+            self.listdir = lambda dirpath: _list(scandir, dirpath)
+        self.pruned = []  # Of the last walk, with the reasons
+        self.timed_out = []
+        self.loops = []
+
+    def fs_type(self, path: str) -> str | None:
+        """The type of the filesystem holding `path`, a real path."""
+        while True:
+            if path in self.mounts:
+                return self.mounts[path]
+            if path == "/" or not path:
+                return None
+            path = os.path.dirname(path)
+
+    def excluded(self, fs_type: str) -> bool:
+        def matches(patterns):
+            return any(fnmatch.fnmatchcase(fs_type, p) for p in patterns)
+
+        if self.fs_types is not None and not matches(self.fs_types):
+            return True
+        return matches(self.skip_fs_types or ())
+
+    def _prune(self, path, reason):
+        logger.info("Not descending into %s: %s", path, reason)
+        self.pruned.append((path, reason))
+
+    def descend(self, path: str, realpath: str, entry, device: int, visited: set):
+        """
+        Whether to walk the subdirectory `entry`, at `path`, whose real
+        path is `realpath`, of a directory on `device`.
+        """
+        symlink = entry.is_symlink()
+        if symlink and not self.follow_symlinks:
+            return False
+        fs_type = self.fs_type(realpath) if symlink else self.mounts.get(realpath)
+        if fs_type is not None:  # Decided before it is stat'ed
+            if self.one_filesystem and not symlink:
+                self._prune(path, f"a {fs_type} mount")
+                return False
+            if self.excluded(fs_type):
+                self._prune(path, f"on {fs_type}")
+                return False
+        if not (self.one_filesystem or self.follow_symlinks):
+            return True
+        try:
+            stat = entry.stat()
+        except OSError:
+            return False
+        if self.one_filesystem and stat.st_dev != device:
+            self._prune(path, "on another device")
+            return False
+        if self.follow_symlinks:
+            if (stat.st_dev, stat.st_ino) in visited:
+                logger.warning("Not descending into %s: already walked", path)
+                self.loops.append(path)
+                return False
+            visited.add((stat.st_dev, stat.st_ino))
+        return True
+
+    def walk(self, top: str):
+        """
+        As os.walk(top): yield (dirpath, dirnames, filenames) top-down,
+        descending only into the dirnames left in place by the caller
+        that the Walker allows.
+        """
+        self.pruned, self.timed_out, self.loops = [], [], []
+        try:
+            stat = os.stat(top)
+        except OSError:
+            return
+        visited = {(stat.st_dev, stat.st_ino)}
+        stack = [(top, os.path.realpath(top), stat.st_dev)]
+        while stack:
+            dirpath, realpath, device = stack.pop()
+            try:
+                dirs, filenames = self.listdir(dirpath)
+            except TimeoutError as e:
+                logger.warning("%s", e)
+                self.timed_out.append(dirpath)
+                continue
+            except OSError:
+                continue  # Unreadable, as os.walk would skip it
+            dirnames = list(dirs)
+            yield dirpath, dirnames, filenames
+            below = []
+            for name in dirnames:
+                entry = dirs[name]
+                path = os.path.join(dirpath, name)
+                if entry.is_symlink():
+                    real = os.path.realpath(path)
+                else:
+                    real = os.path.join(realpath, name)
+                if self.descend(path, real, entry, device, visited):
+                    below.append((path, real, device))
+            stack.extend(reversed(below))
@@ -0,0 +1,156 @@
+"""test_async_scan.py: the asyncio engine must agree with scan_directory."""
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("greenlet")
+pytest.importorskip("aiosqlite")
+
+from filescan import blocks, main, scan_directory
+from filescan.async_scan import async_url, scan_directories
+from filescan.backend import file_checksum
+from filescan.metrics import RunMetrics
+from filescan.sqlalchemy_store import (
+    Archive,
+    BlockDigests,
+    Database,
+    DirRollup,
+    Location,
+    RunLog,
+    TokenPos,
+)
+from sqlalchemy import func, select
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for d in ("a", "a/b", "c"):
+        (root / d).mkdir(parents=True)
+        for i in range(3):
+            (root / d / f"f{i}.txt").write_text(f"{d} {i}")
+    (root / "c" / "m.py").write_text("spam = eggs\n")
+    os.link(root / "a" / "f0.txt", root / "c" / "link.txt")
+    return root
+
+
+def snapshot(url):
+    db = Database(url=url)
+    with db.session.begin():
+        locations = {
+            (loc.dirpath, loc.filename): (
+                loc.modified,
+                loc.checksum.checksum,
+                loc.filesize,
+                loc.inode is not None,
+            )
+            for loc in db.session.scalars(select(Location))
+        }
+        runs = [
+            (run.files, run.known, run.updated, run.unchanged, run.new_files)
+            + (run.deleted,)
+            for run in db.session.scalars(select(RunLog).order_by(RunLog.id))
+        ]
+        reasons = dict(
+            db.session.execute(
+                select(Archive.reason, func.count()).group_by(Archive.reason)
+            ).all()
+        )
+        tokens = db.session.scalar(select(func.count(TokenPos.id)))
+        rollups = {
+            row.dirpath: (row.total_files, row.total_size, row.digest)
+            for row in db.session.scalars(select(DirRollup))
+        }
+    db.engine.dispose()
+    return locations, runs, reasons, tokens, rollups
+
+
+def scan_sync(url, root):
+    db = Database(url=url, temporary=True)
+    with db.begin():
+        scan_directory(str(root), db)
+    db.engine.dispose()
+
+
+def scan_async(url, root):
+    Database(url=url, temporary=True).engine.dispose()
+    asyncio.run(scan_directories([str(root)], url))
+
+
+def test_async_scan_matches_sync_scan(tmp_path, tree):
+    urls = {
+        engine: f"sqlite:///{tmp_path / engine}.sqlite" for engine in ("sync", "async")
+    }
+    for scan in (scan_sync, scan_async):
+        url = urls["async" if scan is scan_async else "sync"]
+        scan(url, tree)
+        scan(url, tree)
+    (tree / "a" / "f1.txt").write_text("changed")
+    os.utime(tree / "a" / "f1.txt", (1, 1))
+    (tree / "c" / "f2.txt").unlink()
+    (tree / "c" / "new.txt").write_text("new")
+    scan_sync(urls["sync"], tree)
+    scan_async(urls["async"], tree)
+
+    sync, asynchronous = snapshot(urls["sync"]), snapshot(urls["async"])
+    assert asynchronous == sync
+    locations, runs, reasons, tokens, rollups = asynchronous
+    assert runs[-1] == (11, 10, 1, 9, 1, 1)
+    assert reasons == {"CREATED": 12, "UPDATED": 1, "DELETED": 1}
+    assert tokens == 2
+    assert None not in {digest for *_, digest in rollups.values()}
+
+
+def test_large_files_grow_incrementally(tmp_path, monkeypatch):
+    monkeypatch.setattr(blocks, "BLOCK_SIZE", 1024)
+    monkeypatch.setattr(blocks, "LARGE_FILE_SIZE", 4096)
+    root = tmp_path / "tree"
+    root.mkdir()
+    log = root / "app.log"
+    log.write_bytes(os.urandom(10_000))
+    url = f"sqlite:///{tmp_path / 'large.sqlite'}"
+    scan_async(url, root)
+    with open(log, "ab") as f:
+        f.write(os.urandom(3_000))
+    os.utime(log, (1, 1))
+    runs = []
+
+    def metrics_factory():
+        runs.append(RunMetrics())
+        return runs[-1]
+
+    asyncio.run(scan_directories([str(root)], url, metrics_factory))
+    assert runs[0].counts["incremental_hashes"] == 1
+    db = Database(url=url)
+    with db.session.begin():
+        (loc,) = db.session.scalars(select(Location))
+        assert loc.checksum.checksum == file_checksum(str(log))
+        digests = db.session.scalar(
+            select(BlockDigests.digests).where(
+                BlockDigests.checksum_id == loc.checksum_id
+            )
+        )
+        assert digests == blocks.file_block_digests(str(log))
+    db.engine.dispose()
+
+
+def test_async_url():
+    assert (
+        str(async_url("sqlite:////tmp/x.sqlite")) == "sqlite+aiosqlite:////tmp/x.sqlite"
+    )
+    assert async_url("postgresql://host/db").drivername == "postgresql+psycopg"
+    with pytest.raises(ValueError):
+        async_url("sqlite://")
+    with pytest.raises(ValueError):
+        async_url("mysql://host/db")
+
+
+def test_async_cli(tmp_path, tree, capsys):
+    url = f"sqlite:///{tmp_path / 'cli.sqlite'}"
+    Database(url=url, temporary=True).engine.dispose()
+    main([str(tree), "--db-url", url, "--async"])
+    assert "Total seen:      11" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tree), "--db-url", url, "--async", "--dry-run"])
@@ -0,0 +1,238 @@
+"""test_backend.py: every store must honour the storage protocol."""
+
+import os
+import time
+
+import pytest
+
+from filescan.backend import DirTotals, FileEntry
+from filescan.memory_store import MemoryDatabase
+from filescan.sqlalchemy_store import Database
+
+PREFIX = "/conformance/"
+
+
+def sqlalchemy_backend(tmp_path):
+    db = Database(url="sqlite://", temporary=True)
+    db.session.begin()
+    return db
+
+
+def memory_backend(tmp_path):
+    return MemoryDatabase()
+
+
+def sqlite_backend(tmp_path):
+    sqlite_store = pytest.importorskip("sqlite_store")
+    return sqlite_store.Connection(path=str(tmp_path / "test.sqlite"), create=True)
+
+
+def postgresql_backend(tmp_path):
+    if "FILESCAN_TEST_PG_DBNAME" not in os.environ:
+        pytest.skip("FILESCAN_TEST_PG_DBNAME not set")
+    postgresql_store = pytest.importorskip("postgresql_store")
+    return postgresql_store.Connection(
+        dbname=os.environ["FILESCAN_TEST_PG_DBNAME"], create=True
+    )
+
+
+def mongo_backend(tmp_path):
+    if "FILESCAN_TEST_MONGO_DBNAME" not in os.environ:
+        pytest.skip("FILESCAN_TEST_MONGO_DBNAME not set")
+    mongo_store = pytest.importorskip("mongo_store")
+    return mongo_store.Connection(
+        dbname=os.environ["FILESCAN_TEST_MONGO_DBNAME"], create=True
+    )
+
+
+BACKENDS = [
+    sqlalchemy_backend,
+    memory_backend,
+    sqlite_backend,
+    postgresql_backend,
+    mongo_backend,
+]
+
+
+@pytest.fixture(params=BACKENDS, ids=lambda f: f.__name__)
+def backend(request, tmp_path):
+    return request.param(tmp_path)
+
+
+def test_lookup_many_only_returns_known(backend):
+    cs = backend.register_hash("/dev/null")
+    backend.upsert_locations(PREFIX, [FileEntry("a.txt", 1.0, cs, 0)])
+    found = backend.lookup_many(PREFIX, ["a.txt", "b.txt"])
+    assert list(found) == ["a.txt"]
+    assert found["a.txt"].dirpath == PREFIX
+    assert backend.lookup_many(PREFIX, []) == {}
+
+
+def test_location_for(backend):
+    cs = backend.register_hash("/dev/null")
+    backend.upsert_locations(PREFIX, [FileEntry("a.txt", 1.0, cs, 0)])
+    assert backend.location_for(PREFIX, "a.txt").modified == 1.0
+    with pytest.raises(backend.DoesNotExist):
+        backend.location_for(PREFIX, "nosuch.txt")
+
+
+def test_upsert_inserts_then_updates(backend):
+    cs = backend.register_hash("/dev/null")
+    entries = [FileEntry(f"f{i}", float(i), cs, i) for i in range(5)]
+    locs = backend.upsert_locations(PREFIX, entries)
+    assert [loc.filename for loc in locs] == [e.filename for e in entries]
+    locs = backend.upsert_locations(PREFIX, [FileEntry("f3", 99.0, cs, 1234)])
+    assert locs[0].modified == 99.0 and locs[0].filesize == 1234
+    backend.flush()
+    assert backend.all_file_count(PREFIX) == 5
+
+
+def test_update_without_links(backend):
+    # Only NULL devices and inodes in the rows updated at once
+    cs = backend.register_hash("/dev/null")
+    entries = [FileEntry(f"f{i}", 1.0, cs, i) for i in range(3)]
+    backend.upsert_locations(PREFIX, entries)
+    entries = [entry._replace(modified=2.0) for entry in entries]
+    locs = backend.upsert_locations(PREFIX, entries)
+    assert [(loc.modified, loc.device, loc.inode) for loc in locs] == [
+        (2.0, None, None)
+    ] * 3
+    (loc,) = backend.upsert_locations(PREFIX, [FileEntry("f0", 3.0, cs, 0, 1, 42)])
+    assert (loc.device, loc.inode) == (1, 42)
+
+
+def test_seen_bits_and_mark_deleted(backend):
+    cs = backend.register_hash("/dev/null")
+    locs = backend.upsert_locations(
+        PREFIX, [FileEntry(f"f{i}", 1.0, cs, 0) for i in range(4)]
+    )
+    backend.upsert_locations("/elsewhere/", [FileEntry("x", 1.0, cs, 0)])
+    backend.flush()
+    backend.clear_seen_bits(PREFIX)
+    backend.mark_seen(locs[:2])
+    backend.flush()
+    assert backend.unseen_location_count(PREFIX) == 2
+    deleted = backend.mark_deleted(PREFIX)
+    assert sorted(loc.filename for loc in deleted) == ["f2", "f3"]
+    assert deleted[0].to_dict()["filename"] in ("f2", "f3")
+    backend.flush()
+    assert backend.all_file_count(PREFIX) == 2
+    assert backend.all_file_count("/elsewhere/") == 1
+
+
+def test_mark_deleted_in_batches(backend):
+    cs = backend.register_hash("/dev/null")
+    backend.upsert_locations(PREFIX, [FileEntry(f"f{i}", 1.0, cs, 0) for i in range(5)])
+    backend.flush()
+    backend.clear_seen_bits(PREFIX)
+    batches = []
+    while deleted := backend.mark_deleted(PREFIX, limit=2):
+        batches.append(sorted(loc.filename for loc in deleted))
+        backend.flush()
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sorted(sum(batches, [])) == [f"f{i}" for i in range(5)]
+    assert backend.all_file_count(PREFIX) == 0
+
+
+def test_total_size_counts_link_groups_once(backend):
+    cs = backend.register_hash("/dev/null")
+    backend.upsert_locations(
+        PREFIX,
+        [
+            FileEntry("plain", 1.0, cs, 100),
+            FileEntry("link1", 1.0, cs, 1000, 1, 42),
+            FileEntry("link2", 1.0, cs, 1000, 1, 42),
+            FileEntry("other", 1.0, cs, 10, 2, 42),
+        ],
+    )
+    (loc,) = backend.upsert_locations("/elsewhere/", [FileEntry("x", 1.0, cs, 5)])
+    backend.flush()
+    assert backend.lookup_many(PREFIX, ["link1"])["link1"].inode == 42
+    assert loc.inode is None
+    assert backend.total_size(PREFIX) == 1110
+    assert backend.total_size("/nowhere/") == 0
+
+
+def test_register_hash_is_stable(backend):
+    assert backend.register_hash("/dev/null") == backend.register_hash("/dev/null")
+    assert backend.register_hash("/no/such/file") is None
+
+
+def test_references_and_runs(backend):
+    cs = backend.register_hash("/dev/null")
+    (loc,) = backend.upsert_locations(PREFIX, [FileEntry("m.py", 1.0, cs, 0)])
+    backend.add_references_bulk(cs, [("spam", 1, 0), ("eggs", 2, 4, 1)])
+    backend.add_references_bulk(cs, [])
+    backend.save_reference(cs, "ham", 3, 0)
+    run = backend.start_run(PREFIX)
+    backend.archive_record("CREATED", "location", loc, run)
+    backend.end_run(run, 1, 0, 0, 0, 1, 0)
+    backend.flush()
+
+
+def test_block_digests_round_trip(backend):
+    digests = bytes(range(64))
+    (cs,) = backend.register_digests(["0" * 64])
+    assert backend.block_digests(cs) is None
+    backend.save_block_digests(cs, digests)
+    backend.save_block_digests(cs, digests[::-1])
+    backend.flush()
+    # Stores that can't keep block digests just always hash afresh
+    assert backend.block_digests(cs) in (None, digests[::-1])
+
+
+def test_directory_totals(backend):
+    cs = backend.register_hash("/dev/null")
+    sub = f"{PREFIX}sub/"
+    backend.clear_seen_bits(PREFIX)
+    backend.upsert_locations(PREFIX, [FileEntry("a", 1.0, cs, 10)])
+    backend.upsert_locations(
+        sub, [FileEntry("b", 5.0, cs, 20), FileEntry("c", 2.0, cs, 30)]
+    )
+    backend.save_directory_totals(PREFIX, DirTotals(1, 10, 1.0))
+    backend.save_directory_totals(sub, DirTotals(2, 50, 5.0))
+    backend.flush()
+    assert backend.directory_totals(PREFIX) == (3, 60, 5.0)
+    assert backend.directory_totals("/nowhere/") is None
+    # Stores without rollups sum locations, and can't list directories
+    assert backend.child_directories(PREFIX) in ({}, {sub: (2, 50, 5.0)})
+
+
+def test_seen_bits_for_one_directory(backend):
+    cs = backend.register_hash("/dev/null")
+    sub = f"{PREFIX}sub/"
+    backend.upsert_locations(PREFIX, [FileEntry("a", 1.0, cs, 0)])
+    backend.upsert_locations(sub, [FileEntry("b", 1.0, cs, 0)])
+    backend.flush()
+    backend.clear_seen_bits(PREFIX, subtree=False)
+    backend.flush()
+    assert backend.unseen_location_count(PREFIX) == 1
+    backend.clear_seen_bits(PREFIX)
+    (loc,) = backend.mark_deleted(PREFIX, subtree=False)
+    assert loc.filename == "a"
+    backend.flush()
+    assert backend.all_file_count(PREFIX) == 1
+
+
+def test_mark_subtree_seen(backend):
+    cs = backend.register_hash("/dev/null")
+    sub = f"{PREFIX}sub/"
+    backend.upsert_locations(PREFIX, [FileEntry("a", 1.0, cs, 0)])
+    backend.upsert_locations(sub, [FileEntry("b", 1.0, cs, 0)])
+    backend.flush()
+    backend.clear_seen_bits(PREFIX)
+    backend.mark_subtree_seen(sub)
+    backend.flush()
+    assert [loc.filename for loc in backend.mark_deleted(PREFIX)] == ["a"]
+
+
+def test_scanned_directories(backend):
+    cs = backend.register_hash("/dev/null")
+    backend.upsert_locations(PREFIX, [FileEntry("a", 1.0, cs, 0)])
+    backend.save_directory_totals(PREFIX, DirTotals(1, 0, 1.0))
+    backend.flush()
+    scanned = backend.scanned_directories(PREFIX)
+    assert list(scanned) == [PREFIX]
+    # Stores without rollups know the directories but not when
+    assert scanned[PREFIX] is None or scanned[PREFIX] <= time.time()
+    assert backend.scanned_directories("/nowhere/") == {}
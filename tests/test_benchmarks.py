@@ -0,0 +1,75 @@
+"""test_benchmarks.py: the benchmark harness itself must be trustworthy."""
+
+import json
+import os
+
+from benchmarks.synthetic import (
+    TreeSpec,
+    churn_tree,
+    compare,
+    main,
+    make_tree,
+    run_benchmark,
+)
+
+SPEC = TreeSpec(depth=2, fanout=2, files=40, median_size=512, churn=0.1)
+
+
+def snapshot(root):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            with open(os.path.join(dirpath, name), "rb") as f:
+                result[os.path.relpath(os.path.join(dirpath, name), root)] = f.read()
+    return result
+
+
+def test_trees_are_reproducible(tmp_path):
+    paths = make_tree(tmp_path / "one", SPEC)
+    make_tree(tmp_path / "two", SPEC)
+    assert len(paths) == 40
+    assert snapshot(tmp_path / "one") == snapshot(tmp_path / "two")
+    assert len(churn_tree(tmp_path / "one", SPEC, paths)) == 40
+    assert snapshot(tmp_path / "one") != snapshot(tmp_path / "two")
+
+
+def test_benchmark_phases():
+    result = run_benchmark(SPEC, url="memory://")
+    cold, warm, churn = (result["phases"][p] for p in ("cold", "warm", "churn"))
+    assert cold["bytes_hashed"] > 0 and cold["tokens"] > 0
+    assert warm["bytes_hashed"] == 0
+    assert 0 < churn["bytes_hashed"] < cold["bytes_hashed"]
+
+
+def test_compare_flags_regressions():
+    baseline = dict(
+        phases=dict(cold=dict(files_per_s=100.0, statements_per_file=2.0)),
+        thresholds=dict(cold=0.1),
+    )
+    result = dict(
+        phases={
+            phase: dict(
+                files_per_s=95.0,
+                mb_hashed_per_s=1.0,
+                tokens_per_s=1.0,
+                statements_per_file=3.0,
+            )
+            for phase in ("cold", "warm", "churn")
+        }
+    )
+    (regression,) = compare(result, baseline, tolerance=0.25)
+    assert regression.startswith("cold statements_per_file")
+    assert len(compare(result, baseline | dict(thresholds={}), tolerance=0.01)) == 2
+
+
+def test_first_baseline_is_recorded(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    args = ["--depth", "1", "--files", "5", "--db-url", "memory://"]
+    main([*args, "--baseline", str(baseline)])
+    assert "No baseline yet" in capsys.readouterr().out
+    saved = json.loads(baseline.read_text())
+    assert saved["thresholds"]["cold"] == 0.25
+    saved["thresholds"] = dict.fromkeys(saved["thresholds"], 1e6)  # Timing noise
+    baseline.write_text(json.dumps(saved))
+    main([*args, "--baseline", str(baseline)])
+    assert "No baseline yet" not in capsys.readouterr().out
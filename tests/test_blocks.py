@@ -0,0 +1,98 @@
+"""test_blocks.py: block digests and hashing only what a file gained."""
+
+import os
+
+import pytest
+
+from filescan import blocks, scan_directory
+from filescan.backend import file_checksum
+from filescan.metrics import RunMetrics
+from filescan.sqlalchemy_store import Database
+
+BLOCK = 1024
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(blocks, "BLOCK_SIZE", BLOCK)
+    monkeypatch.setattr(blocks, "LARGE_FILE_SIZE", 4 * BLOCK)
+
+
+def append(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+@pytest.mark.parametrize("old_size", [BLOCK * 5, BLOCK * 5 + 100, 100])
+def test_extend_matches_full_hash(tmp_path, old_size):
+    path = tmp_path / "log"
+    path.write_bytes(os.urandom(old_size))
+    old = blocks.file_block_digests(str(path))
+    append(path, os.urandom(4 * BLOCK + 17))
+    extended, read = blocks.extend_block_digests(str(path), old, old_size)
+    assert extended == blocks.file_block_digests(str(path))
+    assert file_checksum(str(path)) == blocks.root_digest(extended)
+    complete = old_size // BLOCK  # The first and last of these are sampled
+    assert (
+        read == min(complete, 2) * BLOCK + old_size + 4 * BLOCK + 17 - complete * BLOCK
+    )
+
+
+def test_extend_refuses_rewritten_files(tmp_path):
+    path = tmp_path / "log"
+    content = os.urandom(BLOCK * 5 + 100)
+    path.write_bytes(content)
+    old = blocks.file_block_digests(str(path))
+
+    def flipped(i):  # Random content with the byte at i certainly changed
+        return content[:i] + bytes([content[i] ^ 1]) + content[i + 1 :]
+
+    for changed in (
+        flipped(0),  # First block
+        flipped(BLOCK * 5 - 1),  # Last complete
+        flipped(len(content) - 1),  # Partial block
+    ):
+        path.write_bytes(changed + b"appended")
+        assert blocks.extend_block_digests(str(path), old, len(content)) is None
+    # Middle blocks aren't sampled: the risk the module docstring records
+    path.write_bytes(flipped(BLOCK * 2 + 5) + b"appended")
+    assert blocks.extend_block_digests(str(path), old, len(content)) is not None
+    path.write_bytes(content[:-1])
+    assert blocks.extend_block_digests(str(path), old, len(content)) is None
+    assert blocks.extend_block_digests(str(path), old[:-1], len(content)) is None
+
+
+def test_small_files_keep_plain_sha256(tmp_path):
+    import hashlib
+
+    path = tmp_path / "small"
+    path.write_bytes(b"x" * (4 * BLOCK - 1))
+    assert file_checksum(str(path)) == hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_scan_extends_grown_files(tmp_path):
+    root = tmp_path / "tree"
+    root.mkdir()
+    log = root / "app.log"
+    log.write_bytes(os.urandom(BLOCK * 10 + 10))
+    db = Database(url="sqlite://", temporary=True)
+    with db.begin():
+        scan_directory(str(root), db)
+        append(log, os.urandom(BLOCK * 2))
+        metrics = RunMetrics()
+        scan_directory(str(root), db, metrics)
+        assert metrics.counts["incremental_hashes"] == 1
+        # The first and last complete blocks, the partial block and the tail
+        assert metrics.counts["bytes_hashed"] == BLOCK * 2 + 10 + BLOCK * 2
+        loc = db.location_for(f"{root}/", "app.log")
+        assert loc.checksum.checksum == file_checksum(str(log))
+
+        log.write_bytes(b"rotated" + log.read_bytes()[7:] + b"more")
+        metrics = RunMetrics()
+        scan_directory(str(root), db, metrics)
+        assert metrics.counts["incremental_hashes"] == 0
+        assert metrics.counts["bytes_hashed"] == log.stat().st_size
+        loc = db.location_for(f"{root}/", "app.log")
+        assert loc.checksum.checksum == file_checksum(str(log))
@@ -0,0 +1,169 @@
+"""test_budget.py: budgeted scans go by priority and delete only what they cover."""
+
+import os
+import shutil
+
+import pytest
+
+from filescan import main, scan_directory
+from filescan.budget import (
+    CHANGED,
+    UNCHANGED,
+    parse_duration,
+    scan_with_budget,
+    schedule,
+)
+from filescan.sqlalchemy_store import Database, DirRollup, Location
+from filescan.walk import Walker
+from sqlalchemy import select, update
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for d in ("a", "a/b", "c"):
+        (root / d).mkdir(parents=True)
+        for i in range(3):
+            (root / d / f"f{i}.txt").write_text(f"{d} {i}")
+    return root
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+    yield db
+    db.engine.dispose()
+
+
+def index(db):
+    locations = sorted(
+        (loc.dirpath, loc.filename, loc.checksum.checksum)
+        for loc in db.session.scalars(select(Location))
+    )
+    rollups = {
+        row.dirpath: (row.total_files, row.total_size, row.digest)
+        for row in db.session.scalars(select(DirRollup))
+    }
+    return locations, rollups
+
+
+def test_unlimited_budget_matches_full_scan(tmp_path, tree, db):
+    full = Database(url=f"sqlite:///{tmp_path / 'full'}.sqlite", temporary=True)
+    for changes in (False, True):
+        if changes:
+            make_changes(tree)
+        with db.begin():
+            assert scan_with_budget(str(tree), db, budget=3600) == 0
+        with full.begin():
+            scan_directory(str(tree), full)
+        with db.begin(), full.begin():
+            assert index(db) == index(full)
+    full.engine.dispose()
+
+
+def make_changes(tree):
+    (tree / "a" / "f1.txt").write_text("changed")
+    (tree / "c" / "f2.txt").unlink()
+    (tree / "c" / "d").mkdir()
+    (tree / "c" / "d" / "new.txt").write_text("new")
+    shutil.rmtree(tree / "a" / "b")
+
+
+def test_schedule_puts_changed_directories_first(tree, db):
+    with db.begin():
+        scan_directory(str(tree), db)
+    (tree / "c" / "new.txt").write_text("new")
+    os.utime(tree / "c", (2e9, 2e9))
+    with db.begin():
+        queue = sorted(schedule(db, f"{tree}/"))
+    assert [(cls, path) for cls, _, path in queue] == [
+        (CHANGED, f"{tree}/c/"),
+        (UNCHANGED, f"{tree}/"),
+        (UNCHANGED, f"{tree}/a/"),
+        (UNCHANGED, f"{tree}/a/b/"),
+    ]
+
+
+def test_schedule_stops_looking_at_the_deadline(tree, db):
+    with db.begin():
+        scan_directory(str(tree), db)
+        db.session.execute(
+            update(DirRollup)
+            .where(DirRollup.dirpath == f"{tree}/a/")
+            .values(scanned=1000.0)
+        )
+    os.utime(tree / "c", (2e9, 2e9))
+    readings = iter(range(100))
+    with db.begin():  # Time to stat one directory, the most overdue
+        queue = sorted(schedule(db, f"{tree}/", deadline=1, clock=readings.__next__))
+    # a/ was stat'ed and found changed since 1000; c/'s change went unseen
+    classes = {path: cls for cls, _, path in queue}
+    assert classes[f"{tree}/a/"] == CHANGED
+    assert classes[f"{tree}/c/"] == UNCHANGED
+
+
+def test_deletion_is_scoped_to_scanned_directories(tree, db):
+    with db.begin():
+        scan_directory(str(tree), db)
+    (tree / "a" / "f0.txt").unlink()
+    (tree / "c" / "f0.txt").unlink()
+    shutil.rmtree(tree / "a" / "b")
+    with db.begin():  # As if scanned long ago, and changed since
+        db.session.execute(update(DirRollup).values(scanned=1000.0))
+    for path, mtime in ((tree, 1.0e9), (tree / "a", 1.5e9), (tree / "c", 1.6e9)):
+        os.utime(path, (mtime, mtime))
+    # A clock that ticks once per directory listed allows one per run
+    ticks = [0]
+
+    def scandir(path):
+        ticks[0] += 1
+        return os.scandir(path)
+
+    def run():
+        with db.begin():
+            left = scan_with_budget(
+                str(tree),
+                db,
+                budget=0.5,
+                clock=lambda: ticks[0],
+                walker=Walker(scandir=scandir),
+            )
+            locations = db.session.scalars(select(Location))
+            return left, {
+                f"{loc.dirpath[len(str(tree)) + 1 :]}{loc.filename}"
+                for loc in locations
+            }
+
+    # Vanished directories first, then the most recently changed
+    left, names = run()
+    assert left == 3
+    assert not any(name.startswith("a/b/") for name in names)
+    assert {"a/f0.txt", "c/f0.txt"} <= names
+    left, names = run()
+    assert left == 2
+    assert "c/f0.txt" not in names and "a/f0.txt" in names
+    left, names = run()
+    assert left == 2  # The root, changed, and c, scanned but still in line
+    assert "a/f0.txt" not in names
+    with db.begin():
+        assert db.directory_totals(f"{tree}/a/b/") is None
+        assert db.directory_totals(f"{tree}/").files == 4
+
+
+def test_parse_duration():
+    assert parse_duration("90") == 90
+    assert parse_duration("20m") == 1200
+    assert parse_duration("1.5h") == 5400
+    with pytest.raises(ValueError):
+        parse_duration("soon")
+
+
+def test_cli(tmp_path, tree, capsys):
+    url = f"sqlite:///{tmp_path / 'cli'}.sqlite"
+    Database(url=url, temporary=True).engine.dispose()
+    main([str(tree), "--db-url", url, "--budget", "0"])
+    assert "left for the next run: 1" in capsys.readouterr().out
+    main([str(tree), "--db-url", url, "--budget", "10m"])
+    assert "Total seen:       9" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tree), "--db-url", url, "--budget", "soon"])
@@ -0,0 +1,107 @@
+"""test_iosched.py: reads are spread over devices within each one's limit."""
+
+import os
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from filescan import main, scan_directory
+from filescan.iosched import (
+    HDD_CONCURRENCY,
+    OTHER_CONCURRENCY,
+    SSD_CONCURRENCY,
+    DeviceScheduler,
+    detect_concurrency,
+    parse_limits,
+)
+from filescan.memory_store import MemoryDatabase
+from filescan.throttle import Throttle
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    root = tmp_path / "sys"
+    for disk, rotational in (("sda", "1"), ("nvme0n1", "0")):
+        (root / "devices" / disk / "queue").mkdir(parents=True)
+        (root / "devices" / disk / "queue" / "rotational").write_text(rotational)
+        (root / "devices" / disk / f"{disk}p1").mkdir()
+    (root / "dev" / "block").mkdir(parents=True)
+    for number, target in (
+        ("8:0", "sda"),
+        ("8:1", "sda/sdap1"),
+        ("259:0", "nvme0n1"),
+        ("259:1", "nvme0n1/nvme0n1p1"),
+    ):
+        (root / "dev" / "block" / number).symlink_to(f"../../devices/{target}")
+    return str(root)
+
+
+def test_detect_concurrency(sysfs):
+    assert detect_concurrency(os.makedev(8, 0), sysfs) == HDD_CONCURRENCY
+    assert detect_concurrency(os.makedev(8, 1), sysfs) == HDD_CONCURRENCY
+    assert detect_concurrency(os.makedev(259, 1), sysfs) == SSD_CONCURRENCY
+    assert detect_concurrency(os.makedev(0, 42), sysfs) == OTHER_CONCURRENCY
+    assert detect_concurrency(os.makedev(9, 9), sysfs) == OTHER_CONCURRENCY
+
+
+def test_parse_limits(tmp_path):
+    assert parse_limits(f"{tmp_path}=2, 3,") == {str(tmp_path): 2, None: 3}
+    assert parse_limits("") == {}
+    for bad in ("/x=0", "/x=many", "fast", "/nonexistent=1"):
+        with pytest.raises(ValueError):
+            parse_limits(bad)
+    scheduler = DeviceScheduler({str(tmp_path): 2, None: 5})
+    assert scheduler.concurrency(os.stat(tmp_path).st_dev) == 2
+    assert scheduler.concurrency(os.makedev(0, 4242)) == 5
+
+
+def test_limits_per_device():
+    running, most = Counter(), Counter()
+    lock = threading.Lock()
+
+    def read(device, n):
+        with lock:
+            running[device] += 1
+            most[device] = max(most[device], running[device])
+        time.sleep(0.02)
+        with lock:
+            running[device] -= 1
+        return n
+
+    scheduler = DeviceScheduler()
+    scheduler.limits = {1: 1, 2: 3}
+    jobs = [(device, device, n) for n in range(9) for device in (1, 2)]
+    try:
+        assert scheduler.map(read, jobs) == [n for n in range(9) for _ in (1, 2)]
+    finally:
+        scheduler.close()
+    assert most == {1: 1, 2: 3}
+
+
+def test_scans_match(tmp_path):
+    for i in range(20):
+        (tmp_path / f"f{i}.txt").write_text(f"file {i}" * i)
+    dbs = [MemoryDatabase(), MemoryDatabase()]
+    scheduler = DeviceScheduler({None: 4})
+    throttle = Throttle(read_bytes_per_second=1e9)
+    try:
+        for db, kwargs in zip(dbs, ({}, dict(scheduler=scheduler, throttle=throttle))):
+            with db.begin():
+                scan_directory(str(tmp_path), db, **kwargs)
+    finally:
+        scheduler.close()
+    plain, scheduled = (
+        {loc.filename: loc.checksum for loc in db.state.locations.values()}
+        for db in dbs
+    )
+    assert scheduled == plain and len(plain) == 20
+
+
+def test_cli(tmp_path, capsys):
+    (tmp_path / "f.txt").write_text("spam")
+    main([str(tmp_path), "--db-url", "memory://", "--io-concurrency", "2"])
+    assert "Total seen:       1" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), "--io-concurrency", "/nonexistent=1"])
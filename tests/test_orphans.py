@@ -0,0 +1,69 @@
+"""test_orphans.py: unused checksums must go, once their grace period is up."""
+
+import os
+
+from filescan import main, scan_directory
+from filescan.orphans import collect
+from filescan.sqlalchemy_store import Checksum, Database, TokenPos
+from sqlalchemy import func, select
+
+
+def rewrite(path, text, mtime):
+    path.write_text(text)
+    os.utime(path, (mtime, mtime))
+
+
+def test_collect(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    rewrite(tree / "m.py", "spam = eggs\n", 1000)
+    (tree / "f.txt").write_text("ham")
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+
+    def scan():
+        with db.begin():
+            scan_directory(str(tree), db)
+
+    def rows():
+        with db.begin():
+            return [
+                db.session.scalar(select(func.count()).select_from(model))
+                for model in (Checksum, TokenPos)
+            ]
+
+    scan()
+    assert rows() == [2, 2]
+    rewrite(tree / "m.py", "spam = eggs + bacon\n", 2000)
+    scan()
+    assert rows() == [3, 5]
+    counts = collect(db, batch_size=2, clock=lambda: 10_000)
+    assert (counts.checked, counts.marked, counts.checksums) == (3, 1, 0)
+    rewrite(tree / "m.py", "spam = eggs\n", 3000)  # Used again
+    scan()
+    counts = collect(db, clock=lambda: 20_000)
+    assert (counts.marked, counts.unmarked, counts.checksums) == (1, 1, 0)
+    counts = collect(db, grace=5_000, clock=lambda: 26_000)
+    assert (counts.checksums, counts.tokens) == (1, 3)
+    with db.begin():
+        assert db.session.scalar(select(func.count(Checksum.id))) == 2
+        assert db.session.scalar(select(func.count(Checksum.orphaned))) == 0
+        dangling = select(TokenPos.id).where(
+            TokenPos.checksum_id.not_in(select(Checksum.id))
+        )
+        assert db.session.scalars(dangling).all() == []
+    db.engine.dispose()
+
+
+def test_cli(tmp_path, capsys):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    (tree / "f.txt").write_text("spam")
+    url = f"sqlite:///{tmp_path / 'cli'}.sqlite"
+    Database(url=url, temporary=True).engine.dispose()
+    main([str(tree), "--db-url", url])
+    os.unlink(tree / "f.txt")
+    main([str(tree), "--db-url", url])
+    capsys.readouterr()
+    main(["gc", "--db-url", url, "--grace", "0"])
+    out = capsys.readouterr().out
+    assert "Deleted:           1 checksums, 0 tokens" in out
@@ -0,0 +1,71 @@
+"""test_profile.py: profiled scans must find their hot spots."""
+
+import os
+import pstats
+import time
+
+from filescan import main, scan_directory
+from filescan.profile import HotSpots
+from filescan.sqlalchemy_store import Database, HotSpot, RunLog
+from filescan.walk import Walker
+from sqlalchemy import func, select
+
+
+def test_keeps_the_slowest():
+    hot_spots = HotSpots(3)
+    for i in range(10):
+        hot_spots.add("hash", f"f{i}", i % 7)
+    hot_spots.add("walk", "d", 1.0)
+    assert hot_spots.rows() == [
+        ("hash", "f6", 6),
+        ("hash", "f5", 5),
+        ("hash", "f4", 4),
+        ("walk", "d", 1.0),
+    ]
+    assert hot_spots.report().splitlines()[:2] == [
+        "Slowest files to hash:",
+        "     6.000s  f6",
+    ]
+
+
+def test_profiled_scan(tmp_path, capsys):
+    tree = tmp_path / "tree"
+    for d in ("fast", "slow"):
+        (tree / d).mkdir(parents=True)
+        (tree / d / "m.py").write_text("spam = eggs\n")
+        (tree / d / "f.txt").write_text(d)
+
+    def scandir(path):
+        if path.endswith("slow"):
+            time.sleep(0.05)
+        return os.scandir(path)
+
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+    hot_spots = HotSpots(2)
+    with db.begin():
+        walker = Walker(mountinfo="/nonexistent", scandir=scandir)
+        scan_directory(str(tree), db, walker=walker, hot_spots=hot_spots)
+    assert "Slowest directories to list:\n" in capsys.readouterr().out
+    with db.begin():
+        (run,) = db.session.scalars(select(RunLog))
+        stored = [(row.kind, row.path, row.seconds) for row in run.hot_spots]
+    assert stored == hot_spots.rows()
+    kinds = {kind for kind, _, _ in stored}
+    assert kinds == {"walk", "directory", "hash", "plugin:filescan.filescan_python"}
+    assert stored[0][:2] == ("walk", f"{tree}/slow")
+    assert len([1 for kind, _, _ in stored if kind == "hash"]) == 2
+    db.engine.dispose()
+
+
+def test_cli(tmp_path, capsys):
+    (tmp_path / "f.txt").write_text("spam")
+    dump = tmp_path / "scan.prof"
+    url = f"sqlite:///{tmp_path / 'cli'}.sqlite"
+    Database(url=url, temporary=True).engine.dispose()
+    main([str(tmp_path), "--db-url", url, "--profile", "--profile-dump", str(dump)])
+    assert f"{tmp_path}/f.txt" in capsys.readouterr().out
+    assert pstats.Stats(str(dump)).total_calls > 0
+    db = Database(url=url)
+    with db.session.begin():
+        assert db.session.scalar(select(func.count(HotSpot.id))) > 0
+    db.engine.dispose()
@@ -0,0 +1,34 @@
+"""test_progress.py: status lines and Prometheus textfile output."""
+
+import io
+import re
+
+from filescan import scan_directory
+from filescan.memory_store import MemoryDatabase
+from filescan.progress import Progress
+
+SAMPLE = re.compile(r'^filescan_\w+\{root="[^"]*"(,\w+="[^"]*")*\} [0-9.e+-]+$')
+
+
+def test_progress_reports(tmp_path, capsys):
+    tree = tmp_path / "tree"
+    (tree / "sub").mkdir(parents=True)
+    for i in range(5):
+        (tree / "sub" / f"f{i}").write_text(str(i))
+    textfile = tmp_path / "filescan.prom"
+    stream = io.StringIO()
+    progress = Progress(interval=0, textfile=str(textfile), stream=stream)
+    scan_directory(str(tree), MemoryDatabase(), progress=progress)
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 6  # One per file, and one at the end
+    assert lines[-1].startswith("[filescan] 5 files (5 new, 0 updated)")
+    assert lines[-1].endswith(" done")
+
+    text = textfile.read_text()
+    for line in text.splitlines():
+        assert line.startswith("# ") or SAMPLE.match(line), line
+    assert f'filescan_running{{root="{tree}/"}} 0' in text
+    assert 'state="new"} 5' in text
+    assert list(tmp_path.glob("*.tmp")) == []
+    assert "directory=" not in text  # One series per directory otherwise
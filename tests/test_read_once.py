@@ -0,0 +1,51 @@
+"""test_read_once.py: small files plugins want must be read only once."""
+
+import types
+
+from filescan import run_plugin, scan_directory, wants_content
+from filescan.backend import READ_ONCE_SIZE, file_checksum, read_once
+from filescan.memory_store import MemoryDatabase
+from filescan.metrics import RunMetrics
+
+
+def plugin(process, extensions=None):
+    module = types.ModuleType("filescan_test")
+    module.process = process
+    if extensions is not None:
+        module.EXTENSIONS = extensions
+    return module
+
+
+def test_read_once(tmp_path):
+    small, large = tmp_path / "small", tmp_path / "large"
+    small.write_bytes(b"spam" * 100)
+    large.write_bytes(b"x" * READ_ONCE_SIZE)
+    assert read_once(str(small)) == (file_checksum(str(small)), b"spam" * 100)
+    assert read_once(str(large)) == (file_checksum(str(large)), None)
+    assert read_once(str(tmp_path / "missing")) == (None, None)
+
+
+def test_plugins():
+    by_path = plugin(lambda db, loc: "path")
+    python = plugin(lambda db, loc, content=None: content, [".py"])
+    anything = plugin(lambda db, loc, content=None: content)
+    assert not wants_content([by_path], "m.py")
+    assert wants_content([by_path, python], "m.py")
+    assert not wants_content([by_path, python], "m.txt")
+    assert wants_content([anything], "m.txt")
+    assert run_plugin(by_path, None, None, b"spam") == "path"
+    assert run_plugin(python, None, None, b"spam") == b"spam"
+
+
+def test_scan(tmp_path):
+    (tmp_path / "m.py").write_text("spam = eggs\n")
+    (tmp_path / "f.txt").write_text("ham")
+    (tmp_path / "big.py").write_bytes(b"# " + b"x" * READ_ONCE_SIZE)
+    db, metrics = MemoryDatabase(), RunMetrics()
+    with db.begin():
+        scan_directory(str(tmp_path), db, metrics=metrics)
+    assert metrics.counts["files_read_once"] == 1
+    assert metrics.counts["tokens"] == 2
+    checksums = {loc.filename: loc.checksum for loc in db.state.locations.values()}
+    assert checksums["m.py"] == file_checksum(str(tmp_path / "m.py"))
+    assert "\nplugin:filescan.filescan_python:" in metrics.summary()
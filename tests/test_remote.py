@@ -0,0 +1,196 @@
+"""test_remote.py: a worker scanning through a collector must match a local scan."""
+
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+
+import pytest
+
+from filescan import blocks, main, remote, scan_directory
+from filescan.metrics import RunMetrics
+from filescan.remote import (
+    Channel,
+    Collector,
+    ProtocolError,
+    parse_address,
+    run_worker,
+)
+from filescan.sqlalchemy_store import (
+    Archive,
+    BlockDigests,
+    Database,
+    DirRollup,
+    Location,
+    RunLog,
+    TokenPos,
+)
+from sqlalchemy import func, select
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for d in ("a", "a/b", "c"):
+        (root / d).mkdir(parents=True)
+        for i in range(3):
+            (root / d / f"f{i}.txt").write_text(f"{d} {i}")
+    (root / "c" / "m.py").write_text("spam = eggs\n")
+    (root / "c" / "ünï.txt").write_text("unicode")
+    os.link(root / "a" / "f0.txt", root / "c" / "link.txt")
+    return root
+
+
+def snapshot(url):
+    db = Database(url=url)
+    with db.session.begin():
+        locations = {
+            (loc.dirpath, loc.filename): (
+                loc.modified,
+                loc.checksum.checksum,
+                loc.filesize,
+                loc.inode is not None,
+            )
+            for loc in db.session.scalars(select(Location))
+        }
+        runs = [
+            (run.files, run.known, run.updated, run.unchanged, run.new_files)
+            + (run.deleted, run.when_finished is not None)
+            for run in db.session.scalars(select(RunLog).order_by(RunLog.id))
+        ]
+        reasons = dict(
+            db.session.execute(
+                select(Archive.reason, func.count()).group_by(Archive.reason)
+            ).all()
+        )
+        tokens = db.session.scalar(select(func.count(TokenPos.id)))
+        blocks = db.session.scalar(select(func.count()).select_from(BlockDigests))
+        rollups = {
+            row.dirpath: (row.total_files, row.total_size, row.digest)
+            for row in db.session.scalars(select(DirRollup))
+        }
+    db.engine.dispose()
+    return locations, runs, reasons, tokens, blocks, rollups
+
+
+@pytest.fixture
+def collector(tmp_path):
+    url = f"sqlite:///{tmp_path / 'collected'}.sqlite"
+    Database(url=url, temporary=True).engine.dispose()
+    server = Collector(("127.0.0.1", 0), url, token="sesame")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def scan_local(url, root):
+    db = Database(url=url, temporary=True)
+    with db.begin():
+        scan_directory(str(root), db)
+    db.engine.dispose()
+
+
+def test_worker_matches_local_scan(tmp_path, tree, collector):
+    local = f"sqlite:///{tmp_path / 'local'}.sqlite"
+    address = collector.server_address
+    for _ in range(2):
+        scan_local(local, tree)
+        run_worker(address, [str(tree)], token="sesame")
+    (tree / "a" / "f1.txt").write_text("changed")
+    os.utime(tree / "a" / "f1.txt", (1, 1))
+    (tree / "c" / "f2.txt").unlink()
+    (tree / "c" / "new.py").write_text("new = 1\n")
+    scan_local(local, tree)
+    assert run_worker(address, [str(tree)], token="sesame") == [3]
+
+    remote = snapshot(collector.url)
+    assert remote == snapshot(local)
+    locations, runs, reasons, tokens, blocks, rollups = remote
+    assert runs[-1] == (12, 11, 1, 10, 1, 1, True)
+    assert reasons == {"CREATED": 13, "UPDATED": 1, "DELETED": 1}
+    assert tokens == 3
+    assert None not in {digest for *_, digest in rollups.values()}
+
+
+def test_collector_rejects_strangers(tree, collector):
+    with pytest.raises(ProtocolError, match="Bad token"):
+        run_worker(collector.server_address, [str(tree)], token="guess")
+    assert snapshot(collector.url)[1] == []
+
+
+def test_grown_files_hash_their_tail(tmp_path, collector, monkeypatch):
+    monkeypatch.setattr(blocks, "BLOCK_SIZE", 1024)
+    monkeypatch.setattr(blocks, "LARGE_FILE_SIZE", 4096)
+    log = tmp_path / "logs" / "app.log"
+    log.parent.mkdir()
+    log.write_bytes(os.urandom(5000))
+    runs = []
+
+    def metrics_factory():
+        runs.append(RunMetrics())
+        return runs[-1]
+
+    run_worker(collector.server_address, [str(log.parent)], "sesame", metrics_factory)
+    with open(log, "ab") as f:
+        f.write(os.urandom(3000))
+    os.utime(log, (1, 1))
+    run_worker(collector.server_address, [str(log.parent)], "sesame", metrics_factory)
+    assert runs[-1].counts["incremental_hashes"] == 1
+    locations = snapshot(collector.url)[0]
+    (digest,) = [cs for _, cs, _, _ in locations.values()]
+    assert digest == blocks.root_digest(blocks.file_block_digests(str(log)))
+
+
+def test_frames_are_limited(monkeypatch):
+    monkeypatch.setattr(remote, "MAX_FRAME", 1000)
+    left, right = socket.socketpair()
+    with left, right:
+        sender, receiver = Channel(left), Channel(right)
+        sender.send(["ok", "x" * 900])
+        assert receiver.receive() == ["ok", "x" * 900]
+        with pytest.raises(ProtocolError):
+            sender.send(["big", "x" * 1000])
+        left.sendall(struct.pack("!I", 2**31))
+        with pytest.raises(ProtocolError, match="over the limit"):
+            receiver.receive()
+    left, right = socket.socketpair()
+    with left, right:
+        bomb = zlib.compress(b"0" * 100_000)  # A few hundred bytes
+        left.sendall(struct.pack("!I", len(bomb)) + bomb)
+        with pytest.raises(ProtocolError, match="decompresses"):
+            Channel(right).receive()
+
+
+def test_parse_address():
+    assert parse_address("host:99") == ("host", 99)
+    assert parse_address("host") == ("host", 8765)
+    assert parse_address(":99") == ("127.0.0.1", 99)
+
+
+def test_cli(tmp_path, tree, capsys):
+    url = f"sqlite:///{tmp_path / 'cli'}.sqlite"
+    Database(url=url, temporary=True).engine.dispose()
+    collector = subprocess.Popen(
+        [sys.executable, "-m", "filescan", "collect", "--listen", ":0"]
+        + ["--db-url", url],
+        stdout=subprocess.PIPE,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=SRC),
+    )
+    try:
+        address = collector.stdout.readline().split()[-1]
+        main(["worker", address, str(tree / "a"), str(tree / "c")])
+        assert capsys.readouterr().out.count("Total seen:") == 2
+    finally:
+        collector.terminate()
+        collector.wait()
+    assert len(snapshot(url)[1]) == 2
+    with pytest.raises(SystemExit):
+        main(["worker", address, str(tree)])
@@ -0,0 +1,271 @@
+"""test_scan.py: scan a real directory tree into a throwaway database."""
+
+import os
+
+import pytest
+
+from filescan import main, scan_directory
+from filescan.memory_store import MemoryDatabase
+from filescan.metrics import RunMetrics
+from filescan.sqlalchemy_store import Archive, Database, DirRollup, RunLog
+from sqlalchemy import func, select
+
+
+@pytest.fixture
+def db():
+    db = Database(url="sqlite://", temporary=True)
+    with db.session.begin():
+        yield db
+        db.session.rollback()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for d in ("a", "a/b", "c"):
+        (tmp_path / d).mkdir(exist_ok=True)
+        for i in range(3):
+            (tmp_path / d / f"f{i}.txt").write_text(f"{d} {i}")
+    return tmp_path
+
+
+def last_run(db):
+    return db.session.scalars(select(RunLog).order_by(RunLog.id.desc())).first()
+
+
+def test_rescan_detects_changes(db, tree):
+    scan_directory(str(tree), db)
+    run = last_run(db)
+    assert (run.files, run.new_files, run.known) == (9, 9, 0)
+
+    scan_directory(str(tree), db)
+    run = last_run(db)
+    assert (run.files, run.unchanged, run.new_files) == (9, 9, 0)
+
+    changed = tree / "a" / "f0.txt"
+    changed.write_text("changed")
+    os.utime(changed, (1, 1))
+    (tree / "c" / "f1.txt").unlink()
+    scan_directory(str(tree), db)
+    run = last_run(db)
+    assert (run.files, run.updated, run.unchanged, run.deleted) == (8, 1, 7, 1)
+    assert db.all_file_count(f"{tree}/") == 8
+    reasons = db.session.execute(
+        select(Archive.reason, func.count()).group_by(Archive.reason)
+    )
+    assert dict(reasons.all()) == {"CREATED": 9, "UPDATED": 1, "DELETED": 1}
+
+
+def test_memory_store_writes_once_per_run(tmp_path):
+    store = tmp_path / "index.pickle"
+    db = MemoryDatabase(path=str(store))
+    run = db.start_run("/x/")
+    db.commit()  # As --commit-every does
+    assert not store.exists()
+    db.end_run(run, 0, 0, 0, 0, 0, 0)
+    db.commit()
+    assert MemoryDatabase(path=str(store)).state.runs[0].id == run.id
+
+
+def test_memory_store_persists_unless_dry_run(tree, tmp_path, capsys):
+    store = tmp_path / "index.pickle"
+    url = f"memory://{store}"
+    main([str(tree / "a"), "--db-url", url])
+    assert MemoryDatabase(path=str(store)).all_file_count(f"{tree}/a/") == 6
+
+    (tree / "a" / "new.txt").write_text("new")
+    main([str(tree / "a"), "--db-url", url, "--dry-run"])
+    assert "New:              1" in capsys.readouterr().out
+    state = MemoryDatabase(path=str(store)).state
+    assert len(state.locations) == 6 and len(state.runs) == 1
+
+
+def test_metrics_recorded_with_run(db, tree, capsys):
+    scan_directory(str(tree), db)
+    metrics = {m.name: m.value for m in last_run(db).metrics}
+    assert metrics["bytes_hashed"] == sum(
+        os.path.getsize(p) for p in tree.rglob("*") if p.is_file()
+    )
+    assert {"time_walk", "time_stat", "time_hash", "time_flush"} <= set(metrics)
+    assert "Bytes hashed:" in capsys.readouterr().out
+
+
+def test_hard_links_hashed_once(db, tree):
+    size = sum(path.stat().st_size for path in tree.rglob("*.txt"))
+    os.link(tree / "a" / "f0.txt", tree / "c" / "link.txt")
+    metrics = RunMetrics()
+    scan_directory(str(tree), db, metrics)
+    assert metrics.counts["links_reused"] == 1
+    assert metrics.counts["bytes_hashed"] == size
+    original = db.location_for(f"{tree}/a/", "f0.txt")
+    link = db.location_for(f"{tree}/c/", "link.txt")
+    assert link.checksum is original.checksum
+    assert (link.device, link.inode) == (original.device, original.inode)
+    assert original.inode is not None
+    assert db.total_size(f"{tree}/") == size
+
+    (tree / "c" / "link.txt").unlink()  # Leaves a.f0.txt with a single link
+    scan_directory(str(tree), db)
+    assert db.location_for(f"{tree}/a/", "f0.txt").inode is None
+    assert db.total_size(f"{tree}/") == size
+
+
+def test_commit_every_and_batched_deletes(tree, tmp_path_factory, monkeypatch):
+    import shutil
+
+    import filescan
+
+    monkeypatch.setattr(filescan, "BATCH_SIZE", 2)
+    url = f"sqlite:///{tmp_path_factory.mktemp('db') / 'scan.sqlite'}"
+    db = Database(url=url, temporary=True)
+    commits = []
+    db.commit = lambda commit=db.commit: commits.append(commit())
+    scan_directory(str(tree), db, commit_every=2)
+    db.commit()
+    assert len(commits) == 3  # Every second one of four directories, then ours
+    shutil.rmtree(tree / "a")
+    scan_directory(str(tree), db, commit_every=2)
+    db.commit()
+    assert len(db.session.identity_map) < 10  # Deleted rows weren't kept
+    other = Database(url=url)
+    assert other.all_file_count(f"{tree}/") == 3
+    run = other.session.scalars(select(RunLog).order_by(RunLog.id.desc())).first()
+    assert run.deleted == 6
+    reasons = other.session.execute(
+        select(Archive.reason, func.count()).group_by(Archive.reason)
+    )
+    assert dict(reasons.all()) == {"CREATED": 9, "DELETED": 6}
+
+
+def rollups(db):
+    return {
+        row.dirpath: (row.total_files, row.total_size, row.total_newest)
+        for row in db.session.scalars(select(DirRollup))
+        if row.total_files
+    }
+
+
+def test_rollups_follow_changes(db, tree):
+    import shutil
+
+    def check():
+        kept = rollups(db)
+        db.rebuild_directory_totals()
+        assert kept == rollups(db)
+
+    scan_directory(str(tree), db)
+    check()
+    size = sum(path.stat().st_size for path in tree.rglob("*.txt"))
+    assert db.directory_totals(f"{tree}/") == (
+        9,
+        size,
+        (tree / "c" / "f2.txt").stat().st_mtime,
+    )
+    assert db.directory_totals("/") == db.directory_totals(f"{tree}/")
+    assert list(db.child_directories(f"{tree}/")) == [f"{tree}/a/", f"{tree}/c/"]
+
+    os.utime(tree / "c" / "f2.txt", (1, 1))  # The newest file becomes the oldest
+    (tree / "a" / "b" / "new.txt").write_text("a new file")
+    scan_directory(str(tree), db)
+    check()
+    assert (
+        db.directory_totals(f"{tree}/c/").newest
+        == (tree / "c" / "f1.txt").stat().st_mtime
+    )
+
+    shutil.rmtree(tree / "a" / "b")
+    (tree / "c" / "f0.txt").unlink()
+    scan_directory(str(tree), db)
+    check()
+    assert db.directory_totals(f"{tree}/a/b/") is None
+    assert db.directory_totals(f"{tree}/").files == 5
+
+
+def test_du(tree, tmp_path, capsys):
+    for url in (
+        f"sqlite:///{tmp_path / 'du.sqlite'}",
+        "memory://" + str(tmp_path / "du.pickle"),
+    ):
+        if url.startswith("sqlite"):
+            Database(url=url, temporary=True).engine.dispose()
+        main([str(tree / "a"), "--db-url", url])
+        capsys.readouterr()
+        main(["du", str(tree / "a"), "--db-url", url, "-d", "1"])
+        lines = capsys.readouterr().out.splitlines()
+        assert [line.split()[:2] + line.split()[-1:] for line in lines] == [
+            ["24", "6", f"{tree}/a/"],
+            ["15", "3", f"{tree}/a/b/"],
+        ]
+        with pytest.raises(SystemExit):
+            main(["du", str(tree / "c"), "--db-url", url])
+
+
+def test_compare(db, tree, tmp_path_factory):
+    import shutil
+
+    from filescan.compare import compare_trees
+
+    copy = tmp_path_factory.mktemp("copy")
+    shutil.copytree(tree, copy, dirs_exist_ok=True)
+    scan_directory(str(tree), db)
+    scan_directory(str(copy), db)
+    left, right = f"{tree}/", f"{copy}/"
+    assert db.directory_digest(left) == db.directory_digest(right)
+    assert list(compare_trees(db, left, db, right)) == []
+
+    unchanged = db.directory_digest(f"{copy}/c/")
+    (copy / "a" / "b" / "f0.txt").write_text("changed")
+    (copy / "a" / "new.txt").write_text("new")
+    (copy / "a" / "f1.txt").unlink()
+    shutil.rmtree(copy / "c")
+    (copy / "d").mkdir()
+    scan_directory(str(copy), db)
+    assert db.directory_digest(f"{copy}/c/") is None
+    assert list(compare_trees(db, left, db, right)) == [
+        ("-", "a/f1.txt"),
+        ("+", "a/new.txt"),
+        ("M", "a/b/f0.txt"),
+        ("-", "c/"),
+        ("+", "d/"),
+    ]
+    memory = MemoryDatabase()
+    scan_directory(str(tree), memory)
+    assert memory.directory_digest(left) == db.directory_digest(left)
+    assert list(compare_trees(memory, left, db, right))[-1] == ("+", "d/")
+    with pytest.raises(ValueError):
+        list(compare_trees(db, left, db, "/nowhere/"))
+
+
+def test_compare_cli(tree, tmp_path_factory, capsys):
+    urls = [f"sqlite:///{tmp_path_factory.mktemp('db') / name}" for name in "lr"]
+    for url in urls:
+        Database(url=url, temporary=True).engine.dispose()
+        main([str(tree), "--db-url", url])
+    capsys.readouterr()
+    main(
+        [
+            "compare",
+            str(tree),
+            str(tree),
+            "--db-url",
+            urls[0],
+            "--other-db-url",
+            urls[1],
+        ]
+    )
+    assert capsys.readouterr().out == "No differences\n"
+    (tree / "c" / "f0.txt").write_text("changed")
+    main([str(tree), "--db-url", urls[1]])
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        main(
+            [
+                "compare",
+                str(tree),
+                str(tree),
+                "--db-url",
+                urls[0],
+                "--other-db-url",
+                urls[1],
+            ]
+        )
+    assert capsys.readouterr().out == "M c/f0.txt\n"
@@ -0,0 +1,128 @@
+"""test_snapshot.py: export the index and load it back elsewhere."""
+
+import io
+import os
+
+import pytest
+
+from filescan import blocks, main, scan_directory
+from filescan.snapshot import (
+    SnapshotReader,
+    SnapshotWriter,
+    export_snapshot,
+    import_snapshot,
+)
+from filescan.sqlalchemy_store import BlockDigests, Database, Location, TokenPos
+from sqlalchemy import select
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    monkeypatch.setattr(blocks, "BLOCK_SIZE", 1024)
+    monkeypatch.setattr(blocks, "LARGE_FILE_SIZE", 4096)
+    root = tmp_path / "tree"
+    for d in ("a", "a/b", "c", "ünï"):
+        (root / d).mkdir(parents=True)
+        for i in range(3):
+            (root / d / f"f{i}.txt").write_text(f"{d} {i}")
+    (root / "a" / "m.py").write_text("spam = eggs\nspam()\n")
+    (root / "c" / "big.bin").write_bytes(os.urandom(5000))
+    os.link(root / "a" / "f0.txt", root / "c" / "link.txt")
+    return root
+
+
+def index(url):
+    db = Database(url=url)
+    with db.begin():
+        locations = {
+            (loc.dirpath, loc.filename): (
+                loc.modified,
+                loc.seen,
+                loc.filesize,
+                loc.inode,
+                loc.checksum.checksum,
+            )
+            for loc in db.session.scalars(select(Location))
+        }
+        tokens = sorted(
+            (t.checksum.checksum, t.ttype, t.name, t.line, t.pos)
+            for t in db.session.scalars(select(TokenPos))
+        )
+        digests = sorted(
+            (d.block_size, d.digests) for d in db.session.scalars(select(BlockDigests))
+        )
+    db.engine.dispose()
+    return locations, tokens, digests
+
+
+def scanned(url, root):
+    db = Database(url=url, temporary=True)
+    with db.begin():
+        scan_directory(str(root), db)
+    db.engine.dispose()
+
+
+def test_round_trip(tmp_path, tree):
+    source, target = (f"sqlite:///{tmp_path / name}.sqlite" for name in "st")
+    scanned(source, tree)
+    db = Database(url=source)
+    snapshot = io.BytesIO()
+    with db.begin():
+        rows = export_snapshot(db, snapshot)
+    assert rows == {"checksum": 14, "location": 15, "tokenpos": 3, "blockdigests": 1}
+
+    db = Database(url=target, temporary=True)
+    with db.begin():
+        assert import_snapshot(db, io.BytesIO(snapshot.getvalue())) == rows
+    assert index(target) == index(source)
+    locations, tokens, digests = index(target)
+    assert locations[(f"{tree}/c/", "link.txt")][3] is not None
+    with db.begin(), pytest.raises(ValueError, match="not empty"):
+        import_snapshot(db, io.BytesIO(snapshot.getvalue()))
+
+
+def test_prefix_and_run_restrict_the_export(tmp_path, tree):
+    url = f"sqlite:///{tmp_path / 'db'}.sqlite"
+    scanned(url, tree / "a")
+    scanned(url, tree / "c")
+    db = Database(url=url)
+    with db.begin():
+        by_prefix = export_snapshot(db, io.BytesIO(), prefix=f"{tree}/a/")
+        by_run = export_snapshot(db, io.BytesIO(), run=1)
+        with pytest.raises(ValueError):
+            export_snapshot(db, io.BytesIO(), run=99)
+    assert by_prefix == by_run
+    assert by_prefix == {"checksum": 7, "location": 7, "tokenpos": 3, "blockdigests": 0}
+
+
+def test_blocks_share_dictionaries():
+    f = io.BytesIO()
+    writer = SnapshotWriter(f, prefix=None)
+    rows = [
+        ("/d/", "x", 1.5, True, 10, None, 7, 1),
+        ("/d/", "y", 2.0, False, 0, 3, 9, None),
+    ]
+    writer.write("location", rows[:1])
+    writer.write("location", rows)
+    writer.close()
+    f.seek(0)
+    reader = SnapshotReader(f)
+    assert reader.header["prefix"] is None
+    assert list(reader) == [("location", rows[:1]), ("location", rows)]
+    with pytest.raises(ValueError):
+        SnapshotReader(io.BytesIO(b"not a snapshot"))
+    with pytest.raises(ValueError, match="Truncated"):
+        list(SnapshotReader(io.BytesIO(f.getvalue()[:-3])))
+
+
+def test_cli(tmp_path, tree, capsys):
+    source, target = (f"sqlite:///{tmp_path / name}.sqlite" for name in "st")
+    scanned(source, tree)
+    Database(url=target, temporary=True).engine.dispose()
+    path = str(tmp_path / "index.snap")
+    main(["export", path, "--db-url", source, "--prefix", str(tree / "c")])
+    assert "5 location" in capsys.readouterr().out
+    main(["import", path, "--db-url", target])
+    assert "5 location" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main(["import", path, "--db-url", target])
@@ -0,0 +1,45 @@
+"""test_startup.py: short invocations must not pay for a full scan's setup."""
+
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+ENV = dict(os.environ, PYTHONPATH=SRC)
+HEAVY = {"sqlalchemy", "dotenv", "alembic", "psycopg", "filescan.filescan_python"}
+
+
+def python(*args):
+    return subprocess.run(
+        [sys.executable, *args], env=ENV, capture_output=True, text=True
+    )
+
+
+def loaded_by(*args):
+    """The heavy modules left in sys.modules after `filescan ARGS`."""
+    result = python(
+        "-c",
+        "import sys, filescan\n"
+        "try:\n"
+        f"    filescan.main({list(args)!r})\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print(sorted({HEAVY!r} & set(sys.modules)), file=sys.stderr)",
+    )
+    return result.stderr.splitlines()[-1]
+
+
+def test_import_has_no_side_effects():
+    result = python(
+        "-c",
+        "import logging, sys, filescan;"
+        f"print(sorted({HEAVY!r} & set(sys.modules)), logging.getLogger().handlers)",
+    )
+    assert result.stdout == "[] []\n"
+    assert result.stderr == ""
+
+
+def test_short_invocations_stay_light():
+    assert python("-m", "filescan").stderr == "Nothing to do!\n"
+    assert loaded_by() == "[]"
+    assert loaded_by("--help") == "[]"
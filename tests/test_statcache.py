@@ -0,0 +1,131 @@
+"""test_statcache.py: scans through a stat cache must match scans without one."""
+
+import os
+import shutil
+
+import pytest
+
+from filescan import main, scan_directory
+from filescan.metrics import RunMetrics
+from filescan.sqlalchemy_store import Archive, Database, DirRollup, Location, RunLog
+from filescan.statcache import StatCache, cache_path
+from sqlalchemy import event, func, select
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for d in ("a", "a/b", "c", "empty"):
+        (root / d).mkdir(parents=True)
+    for d in ("a", "a/b", "c"):
+        for i in range(3):
+            (root / d / f"f{i}.txt").write_text(f"{d} {i}")
+    os.link(root / "a" / "f0.txt", root / "c" / "link.txt")
+    return root
+
+
+def snapshot(db):
+    with db.begin():
+        locations = {
+            (loc.dirpath, loc.filename): (
+                loc.modified,
+                loc.checksum.checksum,
+                loc.filesize,
+                loc.inode is not None,
+            )
+            for loc in db.session.scalars(select(Location))
+        }
+        runs = [
+            (run.files, run.known, run.updated, run.unchanged, run.new_files)
+            + (run.deleted,)
+            for run in db.session.scalars(select(RunLog).order_by(RunLog.id))
+        ]
+        reasons = dict(
+            db.session.execute(
+                select(Archive.reason, func.count()).group_by(Archive.reason)
+            ).all()
+        )
+        rollups = {
+            row.dirpath: (row.total_files, row.total_size, row.digest)
+            for row in db.session.scalars(select(DirRollup))
+        }
+    return locations, runs, reasons, rollups
+
+
+def cached_scan(db, root, cache_dir):
+    metrics = RunMetrics()
+    with db.begin():
+        cache = StatCache(str(cache_dir), db, f"{root}/")
+        scan_directory(str(root), db, metrics, stat_cache=cache)
+    cache.commit()
+    return metrics.counts["cached_directories"]
+
+
+def test_cached_scans_match_plain_scans(tmp_path, tree):
+    plain, cached = (
+        Database(url=f"sqlite:///{tmp_path / name}.sqlite", temporary=True)
+        for name in ("plain", "cached")
+    )
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+
+    def scan_both():
+        with plain.begin():
+            scan_directory(str(tree), plain)
+        return cached_scan(cached, tree, cache_dir)
+
+    assert scan_both() == 0
+    assert scan_both() == 5
+    (tree / "a" / "f1.txt").write_text("changed")
+    (tree / "c" / "f2.txt").unlink()
+    (tree / "c" / "new.txt").write_text("new")
+    shutil.rmtree(tree / "a" / "b")
+    (tree / "d").mkdir()
+    assert scan_both() == 2  # The root and empty/
+    assert snapshot(cached) == snapshot(plain)
+    assert snapshot(cached)[1][-1] == (7, 6, 1, 5, 1, 4)
+    for db in (plain, cached):
+        db.engine.dispose()
+
+
+def test_unchanged_tree_needs_no_location_queries(tmp_path, tree):
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+    cached_scan(db, tree, tmp_path)
+    statements = []
+    event.listen(
+        db.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    assert cached_scan(db, tree, tmp_path) == 5
+    assert statements and not [s for s in statements if "location" in s]
+    db.engine.dispose()
+
+
+def test_other_runs_invalidate_the_cache(tmp_path, tree):
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+    cached_scan(db, tree, tmp_path)
+    with db.begin():
+        assert StatCache(str(tmp_path), db, f"{tree}/").valid
+        scan_directory(str(tree / "c"), db)  # A run below the root
+        assert not StatCache(str(tmp_path), db, f"{tree}/").valid
+    cached_scan(db, tree, tmp_path)
+    with open(cache_path(str(tmp_path), db.db_url, f"{tree}/"), "r+b") as f:
+        f.write(b"garbage")
+    with db.begin():
+        assert not StatCache(str(tmp_path), db, f"{tree}/").valid
+    db.engine.dispose()
+
+
+def test_cli(tmp_path, tree, capsys):
+    url = f"sqlite:///{tmp_path / 'cli'}.sqlite"
+    Database(url=url, temporary=True).engine.dispose()
+    cache_dir = tmp_path / "cache"
+    main([str(tree), "--db-url", url, "--stat-cache", str(cache_dir), "--dry-run"])
+    assert os.listdir(cache_dir) == []
+    for _ in range(2):
+        main([str(tree), "--db-url", url, "--stat-cache", str(cache_dir)])
+    assert "Unchanged:       10" in capsys.readouterr().out
+    assert len(os.listdir(cache_dir)) == 1
+    with pytest.raises(SystemExit):
+        main([str(tree), "--db-url", url, "--stat-cache", str(cache_dir), "--async"])
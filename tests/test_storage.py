@@ -1,12 +1,14 @@
 """test_storage.py: make sure you can rely on the integrity of storage."""
 
+import os
 import tempfile
 
 from datetime import datetime
 
 import pytest
 
-from sqlalchemy_store import (
+from filescan.backend import FileEntry
+from filescan.sqlalchemy_store import (
     Location,
     TokenPos,
     RunLog,
@@ -14,10 +16,12 @@ from sqlalchemy_store import (
     Database,
     Checksum,
 )
-from sqlalchemy import select, func
+from sqlalchemy import event, select, func
 from sqlalchemy.orm import sessionmaker
 
 PREFIX = "/Users/sholden/"
+# Any SQLAlchemy URL will do; point this at PostgreSQL to test the server backend
+TEST_DB_URL = os.environ.get("FILESCAN_TEST_DB_URL", "sqlite://")
 
 
 @pytest.fixture(scope="function")  # 'function' scope means for each test function
@@ -26,7 +30,7 @@ def db():
     A pytest fixture that provides a database with a SQLAlchemy session,
     and rolls back the session after the test completes.
     """
-    db = Database(dbname="test", temporary=True, echo=False)
+    db = Database(url=TEST_DB_URL, temporary=True, echo=False)
     with db.session.begin():  # Start a transaction *on the connection*
         if not verify_empty(db.session):
             raise ValueError("Session was not empty before test")
@@ -95,12 +99,10 @@ def test_seen_bits(db):
     q3 = q1.where(Location.seen == False)
     for q, r in (q1, 20), (q2, 10), (q3, 10):
         assert db.session.scalar(q) == r
-    db.delete_unseen_locations(PREFIX)
+    assert len(db.mark_deleted(PREFIX)) == 10
     assert db.session.scalar(q1) == 10
     assert db.unseen_location_count(PREFIX) == 0
-    q = select(Location)
-    for loc in db.session.scalars(q):  # Should be passing the whole object here.
-        db.update_seen(loc, False)
+    db.clear_seen_bits(PREFIX)
     assert db.unseen_location_count(PREFIX) == 10
 
 
@@ -157,16 +159,45 @@ def test_register_hash(db):
     assert isinstance(cs, Checksum)
 
 
+def test_register_hashes_batch_and_cache(db, tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"f{i}"
+        path.write_bytes(b"content %d" % (i % 2))
+        paths.append(str(path))
+    existing = db.register_hash(paths[1])
+    checksums = db.register_hashes([*paths, str(tmp_path / "missing")])
+    assert checksums[1] is existing
+    assert checksums[0] is checksums[2]
+    assert checksums[3] is None
+    assert db.session.scalar(func.count(Checksum.id)) == 2
+
+    statements = []
+    listen = lambda *args: statements.append(args)
+    event.listen(db.engine, "before_cursor_execute", listen)
+    try:
+        assert db.register_hashes(paths) == checksums[:3]
+    finally:
+        event.remove(db.engine, "before_cursor_execute", listen)
+    assert statements == []  # All answered from the cache
+
+
+def test_checksum_cache_cleared_by_rollback(db):
+    with db.session.begin_nested() as nested:
+        db.register_hash("/dev/null")
+        nested.rollback()
+    assert len(db.checksum_ids) == 0
+    cs = db.register_hash("/dev/null")
+    db.flush()
+    assert db.session.get(Checksum, cs.id) is cs
+
+
 def test_location_serialization(db):
     cs = db.register_hash("/dev/null")
     for name in ("one", "two", "three"):
         db.save_reference(checksum=cs, name=name, line=1, pos=1)
-    loc = db.insert_location(
-        dirpath="/somwhere/over/the/rainbow",
-        filename="far_away.txt",
-        modified=1023.25,
-        checksum=cs,
-        filesize=999,
+    (loc,) = db.upsert_locations(
+        "/somwhere/over/the/rainbow", [FileEntry("far_away.txt", 1023.25, cs, 999)]
     )
     loc_dict = loc.to_dict()
     assert list(loc_dict["checksum"].keys()) == ["checksum"]
@@ -175,12 +206,24 @@ def test_location_serialization(db):
 def test_large_filesize(db):
     with db.session.begin_nested():
         cs = db.register_hash("/dev/null")
-        loc = db.insert_location(
-            dirpath="/somwhere/over/the/rainbow",
-            filename="far_away.txt",
-            modified=1023.25,
-            checksum=cs,
-            filesize=3515506688,
+        db.upsert_locations(
+            "/somwhere/over/the/rainbow",
+            [FileEntry("far_away.txt", 1023.25, cs, 3515506688)],
         )
-        db.session.add(loc)
     assert True
+
+
+def test_sqlite_file_database(tmp_path):
+    url = f"sqlite:///{tmp_path / 'scan.sqlite'}"
+    with pytest.raises(ValueError):
+        Database(url=url)
+    db = Database(url=url, temporary=True)
+    with db.session.begin():
+        cs = db.register_hash("/dev/null")
+        db.upsert_locations("/tmp/", [FileEntry("x", 1.0, cs, 0)])
+    with db.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+    db.session.close()
+    db.engine.dispose()
+    db = Database(url=url)  # Now exists, so no temporary flag needed
+    assert db.all_file_count("/tmp/") == 1
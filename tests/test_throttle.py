@@ -0,0 +1,102 @@
+"""test_throttle.py: I/O budgets, checked against a fake clock."""
+
+import hashlib
+
+import pytest
+
+from filescan import main, scan_directory
+from filescan.backend import READ_SIZE, file_checksum
+from filescan.memory_store import MemoryDatabase
+from filescan.throttle import ADJUST_INTERVAL, MIN_SCALE, RateLimiter, Throttle
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_rate_limiter_holds_the_average_rate(clock):
+    limiter = RateLimiter(100, clock, clock.sleep)
+    for _ in range(1000):
+        limiter.acquire()
+    # Only the burst allowance goes unpaid
+    assert clock.now == pytest.approx(10.0 - 0.1)
+
+
+def test_rate_limiter_allows_idle_time_to_refill(clock):
+    limiter = RateLimiter(100, clock, clock.sleep)
+    clock.now += 60
+    assert limiter.acquire(10) == 0.0
+    assert limiter.acquire(10) == pytest.approx(0.1)
+
+
+def test_throttle_charges_reads_and_stats(clock):
+    throttle = Throttle(
+        read_bytes_per_second=1e6, stats_per_second=10, clock=clock, sleep=clock.sleep
+    )
+    throttle.read(2_100_000)
+    assert throttle.waited == pytest.approx(2.0)
+    throttle.stat(21)
+    assert throttle.waited == pytest.approx(4.0)
+    assert Throttle().limits == {}
+
+
+def test_throttle_adapts_to_latency(clock):
+    throttle = Throttle(
+        read_bytes_per_second=1e6, target_latency=0.01, clock=clock, sleep=clock.sleep
+    )
+    limit = throttle.limits["read"]
+    for _ in range(3):
+        clock.now += ADJUST_INTERVAL
+        throttle.read(0, latency=0.5)
+    assert limit.rate == pytest.approx(1e6 / 8)
+    for _ in range(40):  # Time for the average to settle, then recover
+        clock.now += ADJUST_INTERVAL
+        throttle.read(0, latency=0.001)
+    assert limit.rate == pytest.approx(1e6)
+    for _ in range(20):
+        clock.now += ADJUST_INTERVAL
+        throttle.read(0, latency=1.0)
+    assert limit.rate == pytest.approx(1e6 * MIN_SCALE)
+
+
+def test_throttled_checksum_matches(tmp_path, clock):
+    content = bytes(range(256)) * (READ_SIZE // 100)
+    path = tmp_path / "data"
+    path.write_bytes(content)
+    throttle = Throttle(read_bytes_per_second=1e6, clock=clock, sleep=clock.sleep)
+    assert file_checksum(str(path), throttle) == hashlib.sha256(content).hexdigest()
+    assert clock.slept == pytest.approx(len(content) / 1e6 - 0.1)
+    assert file_checksum(str(tmp_path / "missing"), throttle) is None
+
+
+def test_throttled_scan(tmp_path, clock):
+    for i in range(5):
+        (tmp_path / f"f{i}").write_bytes(b"x" * 1000)
+    throttle = Throttle(
+        read_bytes_per_second=1000, stats_per_second=10, clock=clock, sleep=clock.sleep
+    )
+    db = MemoryDatabase()
+    with db.begin():
+        scan_directory(str(tmp_path), db, throttle=throttle)
+    assert db.all_file_count(f"{tmp_path}/") == 5
+    assert throttle.waited == pytest.approx(clock.slept)
+    assert clock.slept >= 4.9  # 5 KB at 1 KB/s
+
+
+def test_target_latency_needs_a_limit(tmp_path):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), "--db-url", "memory://", "--target-latency", "20"])
@@ -0,0 +1,116 @@
+"""test_verify.py: rolling verification must find silently changed content."""
+
+import hashlib
+import os
+
+import pytest
+
+from filescan import blocks, main, scan_directory
+from filescan.sqlalchemy_store import (
+    Archive,
+    BlockDigests,
+    Checksum,
+    Database,
+    Location,
+)
+from filescan.verify import choose, parse_size, verify
+from sqlalchemy import delete, select, update
+
+
+@pytest.fixture
+def db(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    for i in range(10):
+        (tree / f"f{i}.txt").write_text(f"{i}" * 100)
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+    with db.begin():
+        scan_directory(str(tree), db)
+    yield db
+    db.engine.dispose()
+
+
+def corrupt(path):
+    """Change a file's content behind its mtime's back, as bitrot would."""
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.write(b"X")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_parse_size():
+    assert parse_size("1024") == 1024
+    assert parse_size("1.5k") == 1536
+    assert parse_size("20GiB") == 20 * 2**30
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_rolling_verification(db, tmp_path):
+    tree = f"{tmp_path}/tree/"
+    first = choose(db, tree, 350)
+    assert len(first) == 3
+    counts = verify(db, tree, 350)
+    assert (counts.files, counts.bytes, counts.mismatches) == (3, 300, [])
+    assert not set(first) & set(choose(db, tree, 350))  # Moved to the back
+    corrupt(f"{tree}f9.txt")
+    (tmp_path / "tree" / "f8.txt").write_text("rewritten")
+    os.unlink(f"{tree}f7.txt")
+    counts = verify(db, tree, 10_000)
+    assert (counts.files, counts.changed, counts.missing) == (8, 1, 1)
+    assert counts.mismatches == [f"{tree}f9.txt"]
+    (archive,) = db.session.scalars(select(Archive).where(Archive.reason == "MISMATCH"))
+    assert archive.data["filename"] == "f9.txt"
+    assert archive.data["found"] != archive.data["checksum"]["checksum"]
+    unverified = select(Location.filename).where(Location.verified == 0)
+    assert sorted(db.session.scalars(unverified)) == ["f7.txt", "f8.txt"]
+    db.session.rollback()
+
+
+def test_cli(db, tmp_path, capsys):
+    url = db.db_url
+    tree = str(tmp_path / "tree")
+    main(["verify", tree, "--db-url", url, "--days", "5"])
+    out = capsys.readouterr().out
+    assert "Verified:         2 files" in out
+    assert "Runs to cover everything: 5" in out
+    corrupt(f"{tree}/f0.txt")
+    with pytest.raises(SystemExit) as e:
+        main(["verify", tree, "--db-url", url, "--bytes", "1M"])
+    assert e.value.code == 1
+    assert f"MISMATCH {tree}/f0.txt" in capsys.readouterr().out
+
+
+class ReadCounter:
+    """A throttle that only counts the bytes read."""
+
+    bytes = 0
+
+    def read(self, n, seconds):
+        self.bytes += n
+
+
+def test_large_files_indexed_before_block_digests(tmp_path, monkeypatch):
+    monkeypatch.setattr(blocks, "BLOCK_SIZE", 1024)
+    monkeypatch.setattr(blocks, "LARGE_FILE_SIZE", 4096)
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    big = tree / "big.bin"
+    big.write_bytes(os.urandom(10_000))
+    db = Database(url=f"sqlite:///{tmp_path / 'db'}.sqlite", temporary=True)
+    with db.begin():
+        scan_directory(str(tree), db)
+    with db.begin():  # As an old scan left it: a plain SHA-256, no block digests
+        db.session.execute(delete(BlockDigests))
+        checksum = db.session.scalars(select(Checksum)).one()
+        checksum.checksum = hashlib.sha256(big.read_bytes()).hexdigest()
+    prefix = f"{tree}/"
+    throttle = ReadCounter()
+    counts = verify(db, prefix, 10**6, throttle)
+    assert counts.mismatches == []
+    assert counts.bytes == throttle.bytes == 10_000  # Both digests from one read
+    corrupt(big)
+    db.session.execute(update(Location).values(verified=0))
+    assert verify(db, prefix, 10**6).mismatches == [str(big)]
+    db.session.rollback()
+    db.engine.dispose()
@@ -0,0 +1,129 @@
+"""test_walk.py: the walker must stay where it is told to."""
+
+import os
+import threading
+
+import pytest
+
+from filescan import main, scan_directory
+from filescan.memory_store import MemoryDatabase
+from filescan.walk import Walker, parse_fs_types, read_mounts
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for d in ("a/b", "c", "proc/1", "nfs/share"):
+        (root / d).mkdir(parents=True)
+        (root / d / "f.txt").write_text(d)
+    return root
+
+
+@pytest.fixture
+def mountinfo(tmp_path, tree):
+    path = tmp_path / "mountinfo"
+    path.write_text(
+        "22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n"
+        f"23 22 0:5 / {tree}/proc rw shared:2 - proc proc rw\n"
+        f"24 22 0:40 / {tree}/nfs rw - nfs4 server:/export rw,vers=4.2\n"
+        "25 22 0:41 / /mnt/with\\040space rw - tmpfs tmpfs rw\n"
+    )
+    return str(path)
+
+
+def walked(walker, top):
+    return sorted(
+        os.path.relpath(dirpath, top) for dirpath, _, _ in walker.walk(str(top))
+    )
+
+
+def test_read_mounts(mountinfo, tree):
+    mounts = read_mounts(mountinfo)
+    assert mounts["/"] == "ext4"
+    assert mounts[f"{tree}/nfs"] == "nfs4"
+    assert mounts["/mnt/with space"] == "tmpfs"
+    assert read_mounts("/nonexistent") == {}
+    assert parse_fs_types(" nfs*, cifs,,") == ("nfs*", "cifs")
+
+
+def test_matches_os_walk(tree):
+    (tree / "c" / "link").symlink_to(tree / "a")
+    (tree / "c" / "dangling").symlink_to(tree / "nowhere")
+
+    def listing(walk):
+        return [(path, sorted(dirs), sorted(files)) for path, dirs, files in walk]
+
+    walker = Walker(mountinfo="/nonexistent")
+    assert listing(walker.walk(str(tree))) == listing(os.walk(str(tree)))
+
+
+def test_pruning_by_filesystem(tree, mountinfo):
+    everything = [".", "a", "a/b", "c", "nfs", "nfs/share", "proc", "proc/1"]
+    assert walked(Walker(mountinfo="/nonexistent"), tree) == everything
+    walker = Walker(mountinfo=mountinfo)
+    assert walked(walker, tree) == [".", "a", "a/b", "c", "nfs", "nfs/share"]
+    assert walker.pruned == [(f"{tree}/proc", "on proc")]
+    walker = Walker(skip_fs_types=("proc", "nfs*"), mountinfo=mountinfo)
+    assert walked(walker, tree) == [".", "a", "a/b", "c"]
+    walker = Walker(fs_types=("ext4",), skip_fs_types=(), mountinfo=mountinfo)
+    assert walked(walker, tree) == [".", "a", "a/b", "c"]
+    walker = Walker(one_filesystem=True, skip_fs_types=(), mountinfo=mountinfo)
+    assert walked(walker, tree) == [".", "a", "a/b", "c"]
+    assert len(walker.pruned) == 2
+
+
+def test_symlink_loops(tree):
+    (tree / "a" / "b" / "up").symlink_to(tree)
+    (tree / "c" / "alias").symlink_to(tree / "a")
+    walker = Walker(mountinfo="/nonexistent")
+    listing = {dirpath: dirnames for dirpath, dirnames, _ in walker.walk(str(tree))}
+    assert "up" in listing[f"{tree}/a/b"]  # Listed, as os.walk does, not entered
+    assert f"{tree}/a/b/up" not in listing
+    walker = Walker(follow_symlinks=True, mountinfo="/nonexistent")
+    assert walked(walker, tree) == [
+        ".",
+        "a",
+        "a/b",
+        "c",
+        "nfs",
+        "nfs/share",
+        "proc",
+        "proc/1",
+    ]
+    assert sorted(walker.loops) == [f"{tree}/a/b/up", f"{tree}/c/alias"]
+
+
+def test_slow_directories_are_skipped_and_kept(tree):
+    stuck = threading.Event()
+
+    def scandir(path):
+        if path.endswith("/nfs"):
+            stuck.wait()
+        return os.scandir(path)
+
+    db = MemoryDatabase()
+    with db.begin():
+        scan_directory(str(tree), db, walker=Walker(mountinfo="/nonexistent"))
+    assert db.all_file_count(f"{tree}/") == 4
+    walker = Walker(timeout=0.2, mountinfo="/nonexistent", scandir=scandir)
+    try:
+        (tree / "c" / "f.txt").unlink()
+        assert walked(walker, tree) == [".", "a", "a/b", "c", "proc", "proc/1"]
+        assert walker.timed_out == [f"{tree}/nfs"]
+        with db.begin():
+            scan_directory(str(tree), db, walker=walker)
+        assert db.all_file_count(f"{tree}/nfs/") == 1
+        assert db.all_file_count(f"{tree}/") == 3
+    finally:
+        stuck.set()
+
+
+def test_cli(tree, capsys):
+    main([str(tree), "--db-url", "memory://", "-x", "--skip-fs-types", ""])
+    assert "Total seen:       4" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tree), "--db-url", "memory://", "--dir-timeout", "1", "--async"])
+    with pytest.raises(SystemExit):
+        main(
+            [str(tree), "--db-url", "memory://", "--follow-symlinks", "--budget", "1m"]
+        )